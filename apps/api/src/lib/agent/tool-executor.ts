@@ -721,7 +721,8 @@ async function compileLatexFile(
       ctx.compilerUrl,
       ctx.compilerToken,
       images.length > 0 ? images : undefined,
-      additionalFiles.length > 0 ? additionalFiles : undefined
+      additionalFiles.length > 0 ? additionalFiles : undefined,
+      `${ctx.projectId}:${path}`
     );
 
     if (result.success) break;
@@ -39,6 +39,7 @@ interface AutoFixResult {
 /**
  * Full pipeline: compile → fix errors → iteratively refine warnings.
  * @param maxTokens — token budget for AI responses (should match original generation).
+ * @param workspaceId — compile in this server-side workspace (see compileLatex); images must be complete.
  */
 export async function compileWithAutoFix(
   initialSource: string,
@@ -48,10 +49,11 @@ export async function compileWithAutoFix(
   aiModel: string,
   maxTokens = 16000,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult> {
   // Wrap entire pipeline in a timeout to prevent infinite hangs
   return Promise.race([
-    compileWithAutoFixPipeline(initialSource, compilerUrl, compilerToken, aiProvider, aiModel, maxTokens, images),
+    compileWithAutoFixPipeline(initialSource, compilerUrl, compilerToken, aiProvider, aiModel, maxTokens, images, workspaceId),
     new Promise<AutoFixResult>((_, reject) =>
       setTimeout(() => reject(new Error("Pipeline de compilação excedeu o tempo limite (3 min)")), PIPELINE_TIMEOUT_MS),
     ),
@@ -66,6 +68,7 @@ async function compileWithAutoFixPipeline(
   aiModel: string,
   maxTokens = 16000,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult> {
   // Sanitize source before any compilation attempt
   const sanitized = sanitizeLatexSource(initialSource);
@@ -79,6 +82,7 @@ async function compileWithAutoFixPipeline(
     aiModel,
     maxTokens,
     images,
+    workspaceId,
   );
 
   if (!result.success) return result;
@@ -96,13 +100,14 @@ async function compileWithAutoFixPipeline(
       aiModel,
       maxTokens,
       images,
+      workspaceId,
     );
     if (completed) return completed;
     // If completion failed, continue with truncated but compilable version
   }
 
   // Phase 2: deterministic post-compilation Overfull fix (no AI needed)
-  const deterministicResult = await fixOverfullDeterministic(result, compilerUrl, compilerToken, images);
+  const deterministicResult = await fixOverfullDeterministic(result, compilerUrl, compilerToken, images, workspaceId);
 
   // Phase 3: targeted surgical AI refinement for remaining warnings
   return refineWarningsTargeted(
@@ -113,6 +118,7 @@ async function compileWithAutoFixPipeline(
     aiModel,
     maxTokens,
     images,
+    workspaceId,
   );
 }
 
@@ -128,6 +134,7 @@ async function compileAndFixErrors(
   aiModel: string,
   maxTokens = 16000,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult> {
   let source = initialSource;
 
@@ -137,6 +144,8 @@ async function compileAndFixErrors(
       compilerUrl,
       compilerToken,
       images,
+      undefined,
+      workspaceId,
     );
 
     if (result.success && result.pdfBase64) {
@@ -210,6 +219,7 @@ async function completeTruncatedContent(
   aiModel: string,
   maxTokens: number,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult | null> {
   try {
     const result = await aiProvider.generate({
@@ -255,6 +265,7 @@ REGRAS:
       aiModel,
       maxTokens,
       images,
+      workspaceId,
     );
 
     if (compileResult.success) {
@@ -345,6 +356,7 @@ async function fixOverfullDeterministic(
   compilerUrl: string,
   compilerToken: string,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult> {
   const significant = filterSignificantWarnings(result.warnings ?? []);
   const overfullWarnings = significant.filter(
@@ -448,7 +460,7 @@ async function fixOverfullDeterministic(
   if (!modified) return result;
 
   const newSource = sourceLines.join("\n");
-  const compileResult = await compileLatex(newSource, compilerUrl, compilerToken, images);
+  const compileResult = await compileLatex(newSource, compilerUrl, compilerToken, images, undefined, workspaceId);
 
   if (compileResult.success && compileResult.pdfBase64) {
     const newSignificant = filterSignificantWarnings(compileResult.warnings ?? []);
@@ -822,6 +834,7 @@ async function refineWarningsTargeted(
   aiModel: string,
   maxTokens = 16000,
   images?: CompileImage[],
+  workspaceId?: string,
 ): Promise<AutoFixResult> {
   if (!hasSignificantWarnings(initialResult.warnings)) {
     console.log("[auto-fix] Sem warnings significativos, pulando refinamento");
@@ -881,7 +894,7 @@ async function refineWarningsTargeted(
       );
 
       // Compile the patched source
-      const compileResult = await compileLatex(refinedSource, compilerUrl, compilerToken, images);
+      const compileResult = await compileLatex(refinedSource, compilerUrl, compilerToken, images, undefined, workspaceId);
 
       if (!compileResult.success) {
         // The surgical fix broke compilation — try compileAndFixErrors as fallback
@@ -894,6 +907,7 @@ async function refineWarningsTargeted(
           aiModel,
           maxTokens,
           images,
+          workspaceId,
         );
         if (!recovered.success) {
           console.log(`[auto-fix] Passo ${pass}: não recuperou, parando`);
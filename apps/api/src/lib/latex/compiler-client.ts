@@ -14,6 +14,9 @@ export interface CompileResult {
   pdfSizeBytes?: number;
   error?: string;
   warnings?: string[];
+  cacheHit?: boolean;
+  /** The compiler stayed saturated (429/503 with Retry-After) through every retry. */
+  busy?: boolean;
 }
 
 export interface GenerateAndCompileResult {
@@ -25,6 +28,21 @@ export interface GenerateAndCompileResult {
   warnings?: string[];
   attempts: number;
   aiModel?: string;
+  /** The server stayed saturated (429/503 with Retry-After) through every retry. */
+  busy?: boolean;
+}
+
+// The compile pool answers 429 (queue full) / 503 (queue timeout) with Retry-After
+const BUSY_MAX_RETRIES = 3;
+const BUSY_MAX_WAIT_MS = 15_000;
+
+/** How long to wait before retrying a saturated-compiler response; null for any other response. */
+function busyRetryDelay(res: Response): number | null {
+  if (res.status !== 429 && res.status !== 503) return null;
+  const retryAfter = res.headers.get("Retry-After");
+  if (retryAfter === null) return null;
+  const seconds = Number(retryAfter);
+  return Math.min(Number.isFinite(seconds) && seconds > 0 ? seconds * 1000 : 1000, BUSY_MAX_WAIT_MS);
 }
 
 export async function compileLatex(
@@ -33,35 +51,57 @@ export async function compileLatex(
   compilerToken: string,
   images?: CompileImage[],
   additionalFiles?: CompileFile[],
+  /**
+   * Reuse a persistent server-side workspace (inputs + .aux state) across recompiles.
+   * images and additionalFiles must then be the project's complete file set:
+   * workspace files not sent (deleted from the project) are removed.
+   */
+  projectId?: string,
 ): Promise<CompileResult> {
   if (!compilerUrl) {
     return { success: false, error: "LATEX_COMPILER_URL não configurado" };
   }
 
   let res: Response;
-  try {
-    const controller = new AbortController();
-    const timeout = setTimeout(() => controller.abort(), 60_000); // 60s max
-    res = await fetch(`${compilerUrl}/compile`, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-        Authorization: `Bearer ${compilerToken}`,
-      },
-      signal: controller.signal,
-      body: JSON.stringify({
-        latex_source: latexSource,
-        ...(images && images.length > 0 ? { images } : {}),
-        ...(additionalFiles && additionalFiles.length > 0 ? { additional_files: additionalFiles } : {}),
-      }),
-    });
-    clearTimeout(timeout);
-  } catch (err) {
-    const msg = err instanceof Error ? err.message : String(err);
-    return {
-      success: false,
-      error: `[ERRO DE REDE — NÃO RETENTAR] Compilador LaTeX indisponível. Informe à professora que o serviço de compilação está offline e peça para tentar novamente mais tarde. Erro técnico: ${msg}`,
-    };
+  for (let retry = 0; ; retry++) {
+    try {
+      const controller = new AbortController();
+      const timeout = setTimeout(() => controller.abort(), 60_000); // 60s max
+      res = await fetch(`${compilerUrl}/compile`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${compilerToken}`,
+        },
+        signal: controller.signal,
+        body: JSON.stringify({
+          latex_source: latexSource,
+          ...(images && images.length > 0 ? { images } : {}),
+          ...(additionalFiles && additionalFiles.length > 0 ? { additional_files: additionalFiles } : {}),
+          ...(projectId ? { project_id: projectId, replace_files: true } : {}),
+        }),
+      });
+      clearTimeout(timeout);
+    } catch (err) {
+      const msg = err instanceof Error ? err.message : String(err);
+      return {
+        success: false,
+        error: `[ERRO DE REDE — NÃO RETENTAR] Compilador LaTeX indisponível. Informe à professora que o serviço de compilação está offline e peça para tentar novamente mais tarde. Erro técnico: ${msg}`,
+      };
+    }
+
+    const delay = busyRetryDelay(res);
+    if (delay === null) break;
+    await res.body?.cancel();
+    if (retry === BUSY_MAX_RETRIES) {
+      return {
+        success: false,
+        busy: true,
+        error: "[COMPILADOR OCUPADO] O compilador LaTeX está sobrecarregado no momento. Tente compilar novamente em alguns segundos.",
+      };
+    }
+    console.log(`[compiler] busy (HTTP ${res.status}), retrying in ${delay}ms (${retry + 1}/${BUSY_MAX_RETRIES})`);
+    await new Promise((resolve) => setTimeout(resolve, delay));
   }
 
   if (!res.ok) {
@@ -78,6 +118,7 @@ export async function compileLatex(
     pdf_size_bytes?: number;
     error?: string;
     warnings?: string[];
+    cache_hit?: boolean;
   };
 
   return {
@@ -86,6 +127,7 @@ export async function compileLatex(
     pdfSizeBytes: data.pdf_size_bytes,
     error: data.error,
     warnings: data.warnings ?? undefined,
+    cacheHit: data.cache_hit ?? false,
   };
 }
 
@@ -114,22 +156,37 @@ export async function generateAndCompile(
 
   let res: Response;
   try {
-    res = await fetch(`${compilerUrl}/generate-and-compile`, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-        Authorization: `Bearer ${compilerToken}`,
-      },
-      signal: controller.signal,
-      body: JSON.stringify({
-        system_prompt: params.systemPrompt,
-        user_prompt: params.userPrompt,
-        preamble: params.preamble,
-        max_tokens: params.maxTokens,
-        ...(params.signatureBlock ? { signature_block: params.signatureBlock } : {}),
-        ...(params.images && params.images.length > 0 ? { images: params.images } : {}),
-      }),
-    });
+    for (let retry = 0; ; retry++) {
+      res = await fetch(`${compilerUrl}/generate-and-compile`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${compilerToken}`,
+        },
+        signal: controller.signal,
+        body: JSON.stringify({
+          system_prompt: params.systemPrompt,
+          user_prompt: params.userPrompt,
+          preamble: params.preamble,
+          max_tokens: params.maxTokens,
+          ...(params.signatureBlock ? { signature_block: params.signatureBlock } : {}),
+          ...(params.images && params.images.length > 0 ? { images: params.images } : {}),
+        }),
+      });
+      const delay = busyRetryDelay(res);
+      if (delay === null) break;
+      await res.body?.cancel();
+      if (retry === BUSY_MAX_RETRIES) {
+        return {
+          success: false,
+          busy: true,
+          error: "[COMPILADOR OCUPADO] O servidor de geração está sobrecarregado no momento. Tente novamente em alguns segundos.",
+          attempts: 0,
+        };
+      }
+      console.log(`[compiler] busy (HTTP ${res.status}), retrying in ${delay}ms (${retry + 1}/${BUSY_MAX_RETRIES})`);
+      await new Promise((resolve) => setTimeout(resolve, delay));
+    }
   } catch {
     // Server offline or connect timeout — caller should fallback
     return null;
@@ -138,7 +195,7 @@ export async function generateAndCompile(
   }
 
   if (res.status === 503) {
-    // Server up but Claude API not configured — fallback
+    // Server up but Claude API not configured (no Retry-After) — fallback
     return null;
   }
 
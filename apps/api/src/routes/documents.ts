@@ -617,7 +617,9 @@ documentRoutes.get("/:id/export/pdf", async (c) => {
     : new Date().toLocaleDateString("pt-BR");
 
   const fullLatex = buildSimplePdfLatex(doc.title, doc.content, studentName, date);
-  const result = await compileLatex(fullLatex, c.env.LATEX_COMPILER_URL, c.env.LATEX_COMPILER_TOKEN);
+  const result = await compileLatex(
+    fullLatex, c.env.LATEX_COMPILER_URL, c.env.LATEX_COMPILER_TOKEN, undefined, undefined, `document:${id}`,
+  );
 
   if (!result.success || !result.pdfBase64) {
     return c.json({ success: false, error: `Erro ao compilar PDF: ${result.error}` }, 500);
@@ -789,6 +791,8 @@ Retorne o código LaTeX COMPLETO (de \\begin{document} até \\end{document}), se
         provider,
         model,
         16000,
+        undefined,
+        `latex-doc:${newDocId}`,
       );
 
       if (compileResult.success && compileResult.pdfBase64) {
@@ -539,6 +539,7 @@ Use os dados das sessões fornecidos para gerar o relatório baseado em evidênc
         model,
         effectiveMaxTokens,
         images.length > 0 ? images : undefined,
+        `latex-doc:${docId}`,
       );
 
       if (compileResult.success && compileResult.pdfBase64) {
@@ -754,6 +755,7 @@ latexDocumentRoutes.post("/generate", async (c) => {
         model,
         effectiveMaxTokens,
         images.length > 0 ? images : undefined,
+        `latex-doc:${docId}`,
       );
 
       if (compileResult.success && compileResult.pdfBase64) {
@@ -1106,6 +1108,7 @@ latexDocumentRoutes.post("/:id/recompile", async (c) => {
             model,
             getMaxTokens(doc.sizeLevel),
             imagesParam,
+            `latex-doc:${id}`,
           );
         }
       }
@@ -1113,7 +1116,9 @@ latexDocumentRoutes.post("/:id/recompile", async (c) => {
       if (!compileResult) {
         console.log("[recompile] No AI provider, compiling without auto-fix");
         const sanitized = sanitizeLatexSource(latexSource);
-        const raw = await compileLatex(sanitized, c.env.LATEX_COMPILER_URL, c.env.LATEX_COMPILER_TOKEN, imagesParam);
+        const raw = await compileLatex(
+          sanitized, c.env.LATEX_COMPILER_URL, c.env.LATEX_COMPILER_TOKEN, imagesParam, undefined, `latex-doc:${id}`,
+        );
         compileResult = { ...raw, latexSource: sanitized, attempts: 1 };
       }
 
@@ -1298,6 +1303,7 @@ latexDocumentRoutes.post("/:id/edit-ai", async (c) => {
         model,
         getMaxTokens(doc.sizeLevel),
         images.length > 0 ? images : undefined,
+        `latex-doc:${id}`,
       );
 
       if (compileResult.success && compileResult.pdfBase64) {
@@ -1571,6 +1577,7 @@ latexDocumentRoutes.post("/:id/regenerate", async (c) => {
         model,
         regenMaxTokens,
         images.length > 0 ? images : undefined,
+        `latex-doc:${newDocId}`,
       );
 
       if (compileResult.success && compileResult.pdfBase64) {
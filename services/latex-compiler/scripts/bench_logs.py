@@ -0,0 +1,168 @@
+"""Benchmark the single-pass log scanner against the old multi-pass parsing.
+
+    python scripts/bench_logs.py [document.log ...]
+
+Real logs (e.g. from tikz-heavy documents) can be given as arguments; without
+arguments a synthetic log of about 60 MB is generated. For each log the old
+approach (read whole file, four MULTILINE regexes, readlines + error scan, a
+separate rerun scan) is timed against _scan_log, with peak Python memory.
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+_OLD_WARNING_PATTERNS = [
+    re.compile(r"^(Overfull \\[hv]box .+)$", re.MULTILINE),
+    re.compile(r"^(Underfull \\[hv]box .+)$", re.MULTILINE),
+    re.compile(r"^(LaTeX Warning: .+)$", re.MULTILINE),
+    re.compile(r"^(Package \S+ Warning: .+)$", re.MULTILINE),
+]
+
+
+def _old_parse_latex_errors(lines: list[str]) -> str:
+    """Parse LaTeX log lines into structured error messages with line numbers.
+
+    Example output:
+        ERRO na linha 42: Undefined control sequence \\palavraschaves
+        Contexto: l.42 \\palavraschaves{Educação, AEE}
+    """
+    errors: list[str] = []
+    i = 0
+    while i < len(lines) and len(errors) < 5:
+        line = lines[i].rstrip()
+        if line.startswith("!"):
+            error_msg = line[2:].strip()  # Remove "! "
+            line_num = None
+            context_lines = []
+
+            # Look ahead for line number (l.NNN) and context
+            for j in range(i + 1, min(i + 8, len(lines))):
+                ctx = lines[j].rstrip()
+                context_lines.append(ctx)
+                # Match "l.42 ..." or "l.42" at start of line
+                m = re.match(r"l\.(\d+)\s*(.*)", ctx)
+                if m:
+                    line_num = int(m.group(1))
+                    break
+
+            if line_num:
+                entry = f"ERRO na linha {line_num}: {error_msg}"
+            else:
+                entry = f"ERRO: {error_msg}"
+
+            # Add up to 3 lines of context
+            if context_lines:
+                ctx_str = "\n  ".join(context_lines[:3])
+                entry += f"\n  {ctx_str}"
+
+            errors.append(entry)
+            i += len(context_lines) + 1
+        else:
+            i += 1
+
+    if not errors:
+        return ""
+
+    result = "\n\n".join(errors)
+
+    # Add Beamer hints when error points to \end{frame} (common with TikZ/foreach errors)
+    if re.search(r"\\end\{frame\}", result):
+        result += "\n\nDICA: O erro aponta para \\end{frame}, mas a causa real provavelmente está ACIMA — procure por: \\foreach com muitas variáveis, \\fontsize, comandos TikZ complexos, ou \\fontspec (incompatível com pdflatex)."
+
+    return result
+
+
+def old_parse(log_path: str) -> tuple[int, int, bool]:
+    """What _compile_outcome and _log_requests_rerun used to do with a log."""
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        log_text = f.read()
+    warnings = []
+    for pat in _OLD_WARNING_PATTERNS:
+        for m in pat.finditer(log_text):
+            warnings.append(m.group(1).strip())
+            if len(warnings) >= 30:
+                break
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        lines = f.readlines()
+    errors = _old_parse_latex_errors(lines).count("ERRO")
+    rerun = False
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if server._RERUN_HINT.search(line) and server._KERNEL_LABEL_RERUN not in line:
+                rerun = True
+                break
+    return len(warnings), errors, rerun
+
+
+def new_parse(log_path: str) -> tuple[int, int, bool]:
+    server._scan_memo.clear()
+    scan = server._scan_log(log_path)
+    return len(scan.warnings()), min(len(scan.errors), server.MAX_ERRORS), scan.rerun_requested
+
+
+def synthetic_log(path: str, target_bytes: int = 60 * 1024 * 1024) -> None:
+    """A log shaped like a long tikz/longtable document: nested inputs, many bad boxes."""
+    block = (
+        "(./capitulo.tex\n"
+        "Overfull \\hbox (3.2pt too wide) in paragraph at lines 120--121\n"
+        "[]\\T1/cmr/m/n/10 Texto (com par\\^entese) na tabela []\n"
+        "\n"
+        "Underfull \\hbox (badness 10000) in paragraph at lines 130--131\n"
+        "\n"
+        "Package pgf Warning: Returning node center instead of a point on node border on input line 140.\n"
+        "\n"
+        "(/usr/share/texlive/texmf-dist/tex/generic/pgf/libraries/pgflibraryarrows.code.tex\n"
+        "File: pgflibraryarrows.code.tex 2023-01-15 v3.1.10 (3.1.10)\n"
+        ")\n"
+        "[12 <./images/figura.png>]\n"
+        ")\n"
+    )
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("This is pdfTeX, Version 3.141592653-2.6-1.40.25\n(./document.tex\n")
+        written = 0
+        while written < target_bytes:
+            f.write(block)
+            written += len(block)
+        f.write("! Undefined control sequence.\nl.4242 \\palavraschaves\n)\n")
+
+
+def measure(fn, log_path: str) -> tuple[float, int, tuple]:
+    """Wall time of a plain run, then peak memory of a second, traced run."""
+    started = time.perf_counter()
+    result = fn(log_path)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    fn(log_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def main() -> None:
+    paths = sys.argv[1:]
+    tmp = None
+    if not paths:
+        tmp = os.path.join(tempfile.gettempdir(), "aee-bench.log")
+        synthetic_log(tmp)
+        paths = [tmp]
+    try:
+        for path in paths:
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            print(f"{path} ({size_mb:.1f} MB)")
+            for name, fn in (("old", old_parse), ("scan", new_parse)):
+                seconds, peak, result = measure(fn, path)
+                print(f"  {name:5s} {seconds:7.2f}s  peak {peak / (1024 * 1024):8.1f} MB  "
+                      f"warnings={result[0]} errors={result[1]} rerun={result[2]}")
+    finally:
+        if tmp:
+            os.remove(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Local stand-in for the Anthropic Messages API, for running generate-and-compile offline.
+
+    python scripts/mock_anthropic.py [--port 8765] [--latency 0.02]
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=mock uvicorn server:app
+
+Serves POST /v1/messages, streamed (SSE) or not, in the shape the SDK expects.
+Prompt caching is simulated: each cache_control breakpoint caches the prompt
+prefix up to it for 5 minutes, and usage reports cache_creation_input_tokens /
+cache_read_input_tokens like the real API (tokens estimated as chars / 4).
+Cache hits also answer faster, so time-to-first-token can be compared.
+
+The reply is a LaTeX document body: for fix calls the body sent in the request
+(so the next compile sees the same document), otherwise a short canned body,
+or the contents of MOCK_RESPONSE_FILE. Fix calls that ask for search/replace
+hunks get one hunk per body line containing FAIL, dropping that word, and a
+reply without hunks when there is none (which makes the server fall back).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock Anthropic Messages API")
+
+CACHE_TTL_SECONDS = 300
+MIN_CACHEABLE_TOKENS = 1024
+# Simulated prefill cost per uncached input token, and delay between streamed chunks
+PREFILL_SECONDS_PER_TOKEN = 0.00005
+CHUNK_LATENCY_SECONDS = float(os.environ.get("MOCK_LATENCY_SECONDS", "0.02"))
+
+_CANNED_BODY = (
+    "\\begin{document}\n"
+    "\\section{Identificação}\n"
+    "Documento gerado pelo servidor simulado.\n"
+    "\\end{document}\n"
+)
+
+_prefix_cache: dict[str, float] = {}
+_stats = {"requests": 0, "cache_hits": 0, "cache_writes": 0}
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _blocks(content) -> list[dict]:
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return list(content)
+
+
+def _prompt_segments(body: dict) -> list[tuple[str, bool]]:
+    """The prompt as (text, ends_with_breakpoint) in cache order: system, then messages."""
+    segments = []
+    for block in _blocks(body.get("system") or []):
+        segments.append((block.get("text", ""), "cache_control" in block))
+    for message in body.get("messages", []):
+        for block in _blocks(message.get("content", "")):
+            segments.append((f"{message['role']}:" + block.get("text", ""), "cache_control" in block))
+    return segments
+
+
+def _usage(body: dict) -> dict:
+    """Input token accounting with simulated prompt caching."""
+    now = time.time()
+    for key in [k for k, t in _prefix_cache.items() if now - t > CACHE_TTL_SECONDS]:
+        del _prefix_cache[key]
+
+    segments = _prompt_segments(body)
+    total = sum(_tokens(text) for text, _ in segments)
+    h = hashlib.sha256(body.get("model", "").encode())
+    prefix_tokens = 0
+    read = 0
+    written = 0
+    for text, breakpoint in segments:
+        h.update(b"\0" + text.encode("utf-8"))
+        prefix_tokens += _tokens(text)
+        if not breakpoint or prefix_tokens < MIN_CACHEABLE_TOKENS:
+            continue
+        key = h.hexdigest()
+        if key in _prefix_cache:
+            read = prefix_tokens
+            written = 0
+        else:
+            written = prefix_tokens - read
+        _prefix_cache[key] = now
+    if read:
+        _stats["cache_hits"] += 1
+    if written:
+        _stats["cache_writes"] += 1
+    return {
+        "input_tokens": total - read - written,
+        "cache_creation_input_tokens": written,
+        "cache_read_input_tokens": read,
+    }
+
+
+def _patch_reply(document: str) -> str:
+    hunks = [
+        f"<<<<<<< BUSCAR\n{line}\n=======\n{line.replace('FAIL', '')}\n>>>>>>> SUBSTITUIR"
+        for line in dict.fromkeys(document.split("\n")) if "FAIL" in line
+    ]
+    return "\n\n".join(hunks) or "Nenhuma edição necessária."
+
+
+def _reply_text(body: dict) -> str:
+    path = os.environ.get("MOCK_RESPONSE_FILE")
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    # Only the messages: the fix system prompts mention \begin{document} too
+    prompt = "\n".join(
+        block.get("text", "") for message in body.get("messages", []) for block in _blocks(message.get("content", ""))
+    )
+    m = re.search(r"\\begin\{document\}.*\\end\{document\}", prompt, re.DOTALL)
+    system = "\n".join(block.get("text", "") for block in _blocks(body.get("system") or []))
+    if m and "<<<<<<< BUSCAR" in system:
+        return _patch_reply(m.group(0))
+    return m.group(0) if m else _CANNED_BODY
+
+
+def _message(body: dict, text: str, usage: dict, output_tokens: int) -> dict:
+    return {
+        "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "mock"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {**usage, "output_tokens": output_tokens},
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    body = await request.json()
+    _stats["requests"] += 1
+    usage = _usage(body)
+    text = _reply_text(body)
+    output_tokens = _tokens(text)
+    # Uncached input is what costs prefill time; cache reads are nearly free
+    prefill = (usage["input_tokens"] + usage["cache_creation_input_tokens"]) * PREFILL_SECONDS_PER_TOKEN
+
+    if not body.get("stream"):
+        await asyncio.sleep(prefill)
+        return JSONResponse(_message(body, text, usage, output_tokens))
+
+    async def events():
+        await asyncio.sleep(prefill)
+        start = _message(body, "", usage, 1)
+        start["content"] = []
+        start["stop_reason"] = None
+        yield _sse("message_start", {"type": "message_start", "message": start})
+        yield _sse("content_block_start", {
+            "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+        })
+        for i in range(0, len(text), 64):
+            await asyncio.sleep(CHUNK_LATENCY_SECONDS)
+            yield _sse("content_block_delta", {
+                "type": "content_block_delta", "index": 0,
+                "delta": {"type": "text_delta", "text": text[i:i + 64]},
+            })
+        yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+        yield _sse("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": output_tokens},
+        })
+        yield _sse("message_stop", {"type": "message_stop"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def stats():
+    return {**_stats, "cached_prefixes": len(_prefix_cache)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=CHUNK_LATENCY_SECONDS,
+                        help="seconds between streamed chunks")
+    args = parser.parse_args()
+    CHUNK_LATENCY_SECONDS = args.latency
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
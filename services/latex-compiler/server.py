@@ -1,35 +1,85 @@
 import os
 import re
+import asyncio
 import base64
+import errno
+import fcntl
+import gzip
+import hashlib
+import http.client
+import random
 import subprocess
+import threading
+import time
 import tempfile
 import shutil
+import signal
+import sqlite3
+import uuid
 import json as json_lib
-import urllib.request
-
-from fastapi import FastAPI, HTTPException, Header, BackgroundTasks, Response
+import logging
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Awaitable, Callable
+
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 app = FastAPI(title="AEE+ PRO LaTeX Compiler")
 
 AUTH_TOKEN = os.environ.get("COMPILER_AUTH_TOKEN", "")
 
+_log = logging.getLogger("aee-latex")
+
 
 class ImagePayload(BaseModel):
+    """Image for the document — inline base64, or sha256 of an asset uploaded to /assets."""
     filename: str
-    data_base64: str
+    data_base64: str = ""
+    sha256: str | None = None
 
 
 class FilePayload(BaseModel):
-    """Additional text file (e.g. .tex, .bib, .sty) to place alongside the main document."""
+    """Additional text file (e.g. .tex, .bib, .sty) to place alongside the main document.
+
+    Either inline `content` or the sha256 of an asset uploaded to /assets.
+    """
     filename: str
-    content: str
+    content: str = ""
+    sha256: str | None = None
 
 
 class CompileRequest(BaseModel):
     latex_source: str
     images: list[ImagePayload] | None = None
     additional_files: list[FilePayload] | None = None
+    # Persistent workspace: files not sent are kept from earlier compiles of the project,
+    # unless replace_files says images + additional_files are all of its files
+    project_id: str | None = None
+    removed_files: list[str] | None = None
+    replace_files: bool = False
+
+
+class PdfOptimization(BaseModel):
+    """What the PDF post-processing stage did (see _optimize_pdf)."""
+    level: str
+    size_before_bytes: int
+    size_after_bytes: int
+    seconds: float
+    streams_deduplicated: int = 0
+
+
+class LogDiagnostic(BaseModel):
+    severity: str  # "error", "warning" or "badbox"
+    message: str
+    file: str | None = None
+    line: int | None = None
+    package: str | None = None
+    overfull_pt: float | None = None
+    context: list[str] | None = None
 
 
 class CompileResponse(BaseModel):
@@ -38,80 +88,218 @@ class CompileResponse(BaseModel):
     pdf_size_bytes: int | None = None
     error: str | None = None
     warnings: list[str] | None = None
+    passes: int | None = None
+    cache_hit: bool = False
+    optimization: PdfOptimization | None = None
+    diagnostics: list[LogDiagnostic] | None = None
+    # Why it failed: tex_error, tex_capacity, no_pdf, timeout, cancelled, server_error
+    # or a job limit (cpu_limit, memory_limit, file_size_limit, open_files_limit, killed,
+    # system_memory, ram_file_limit)
+    error_code: str | None = None
 
 
-_WARNING_PATTERNS = [
-    re.compile(r"^(Overfull \\[hv]box .+)$", re.MULTILINE),
-    re.compile(r"^(Underfull \\[hv]box .+)$", re.MULTILINE),
-    re.compile(r"^(LaTeX Warning: .+)$", re.MULTILINE),
-    re.compile(r"^(Package \S+ Warning: .+)$", re.MULTILINE),
-]
+# ---------------------------------------------------------------------------
+# Log diagnostics — one streaming pass over the .log, bounded memory
+# ---------------------------------------------------------------------------
 
 MAX_WARNINGS = 30
+# Kept per kind; anything beyond is only counted
+MAX_DIAGNOSTICS_PER_KIND = 30
+MAX_ERRORS = 5
 
+_BADBOX = re.compile(r"^(Overfull|Underfull) \\[hv]box \((?:([\d.]+)pt too \w+|badness \d+)\)")
+_PACKAGE_MESSAGE = re.compile(r"^Package (\S+) (Warning|Error): ")
+_ERROR_LINE_NUMBER = re.compile(r"l\.(\d+)\s*(.*)")
+_WARNING_LINE_NUMBER = re.compile(r"(?:on input line|at lines?) (\d+)")
+# "(./document.tex", "(/usr/share/texmf/.../article.cls" — an input file being opened
+_FILE_OPEN = re.compile(r"\(([^\s()]*?(?:/|\.(?:tex|sty|cls|clo|cfg|def|fd|aux|toc|lof|lot|out|bbl|ldf)\b)[^\s()]*)")
+_MAX_FILE_DEPTH = 64
 
-def _extract_warnings(log_path: str) -> list[str]:
-    """Parse a LaTeX .log file and return relevant warning lines."""
-    if not os.path.exists(log_path):
-        return []
-    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-        log_text = f.read()
-    warnings: list[str] = []
-    for pat in _WARNING_PATTERNS:
-        for m in pat.finditer(log_text):
-            warnings.append(m.group(1).strip())
-            if len(warnings) >= MAX_WARNINGS:
-                return warnings
-    return warnings
+# Order in which warnings are reported (and truncated), most actionable first
+_WARNING_KINDS = ("overfull", "underfull", "latex", "package")
 
 
-def _parse_latex_errors(lines: list[str]) -> str:
-    """Parse LaTeX log lines into structured error messages with line numbers.
+class _LogScan:
+    """Structured diagnostics from a pdflatex log, fed one line at a time.
 
-    Example output:
-        ERRO na linha 42: Undefined control sequence \\palavraschaves
-        Contexto: l.42 \\palavraschaves{Educação, AEE}
+    Tracks the input file stack from TeX's "(file ... )" markers, so each
+    diagnostic knows which file it came from. Only MAX_DIAGNOSTICS_PER_KIND
+    entries per kind are kept, however long the log is.
     """
-    import re
 
-    errors: list[str] = []
-    i = 0
-    while i < len(lines) and len(errors) < 5:
-        line = lines[i].rstrip()
+    def __init__(self):
+        self.by_kind: dict[str, list[LogDiagnostic]] = {k: [] for k in ("error",) + _WARNING_KINDS}
+        self.counts: dict[str, int] = {k: 0 for k in self.by_kind}
+        self.rerun_requested = False
+        self._files: list[str | None] = []
+        self._pending: LogDiagnostic | None = None  # error still collecting its context
+        self._continues: LogDiagnostic | None = None  # package warning that may wrap
+
+    def _current_file(self) -> str | None:
+        for name in reversed(self._files):
+            if name:
+                return name.removeprefix("./")
+        return None
+
+    def _add(self, kind: str, diag: LogDiagnostic) -> None:
+        self.counts[kind] += 1
+        if len(self.by_kind[kind]) < MAX_DIAGNOSTICS_PER_KIND:
+            self.by_kind[kind].append(diag)
+
+    def _track_files(self, line: str) -> None:
+        if "(" not in line and ")" not in line:
+            return
+        pos = 0
+        while True:
+            opening = line.find("(", pos)
+            closing = line.find(")", pos)
+            if opening == -1 and closing == -1:
+                return
+            if opening != -1 and (closing == -1 or opening < closing):
+                m = _FILE_OPEN.match(line, opening)
+                if len(self._files) < _MAX_FILE_DEPTH:
+                    self._files.append(m.group(1) if m else None)
+                pos = m.end() if m else opening + 1
+            else:
+                if self._files:
+                    self._files.pop()
+                pos = closing + 1
+
+    def feed(self, line: str) -> None:
+        # Cheap substring/startswith tests first: most lines of a big log match nothing
+        if ("erun" in line or "ERUN" in line) and _RERUN_HINT.search(line) and _KERNEL_LABEL_RERUN not in line:
+            self.rerun_requested = True
+
+        if self._pending is not None:
+            # TeX prints the offending input as "l.42 <text>" a few lines after "! ..."
+            diag = self._pending
+            diag.context.append(line)
+            m = _ERROR_LINE_NUMBER.match(line)
+            if m:
+                diag.line = int(m.group(1))
+            if m or len(diag.context) >= 7:
+                self._pending = None
+            return
+
+        if self._continues is not None:
+            prefix = f"({self._continues.package})"
+            if line.startswith(prefix):
+                self._continues.message += " " + line[len(prefix):].strip()
+                lines = _WARNING_LINE_NUMBER.search(line)
+                if lines:
+                    self._continues.line = int(lines.group(1))
+                return
+            self._continues = None
+
         if line.startswith("!"):
-            error_msg = line[2:].strip()  # Remove "! "
-            line_num = None
-            context_lines = []
-
-            # Look ahead for line number (l.NNN) and context
-            for j in range(i + 1, min(i + 8, len(lines))):
-                ctx = lines[j].rstrip()
-                context_lines.append(ctx)
-                # Match "l.42 ..." or "l.42" at start of line
-                m = re.match(r"l\.(\d+)\s*(.*)", ctx)
-                if m:
-                    line_num = int(m.group(1))
-                    break
+            message = line[2:].strip()
+            m = _PACKAGE_MESSAGE.match(message)
+            self._pending = LogDiagnostic(severity="error", message=message, file=self._current_file(),
+                                          package=m.group(1) if m else None, context=[])
+            self._add("error", self._pending)
+            return
+
+        m = _BADBOX.match(line) if line.startswith(("Overfull", "Underfull")) else None
+        if m:
+            lines = _WARNING_LINE_NUMBER.search(line)
+            self._add(m.group(1).lower(), LogDiagnostic(
+                severity="badbox",
+                message=line.strip(),
+                file=self._current_file(),
+                line=int(lines.group(1)) if lines else None,
+                overfull_pt=float(m.group(2)) if m.group(2) else None,
+            ))
+            return
+
+        if line.startswith("LaTeX Warning: "):
+            lines = _WARNING_LINE_NUMBER.search(line)
+            self._add("latex", LogDiagnostic(
+                severity="warning", message=line.strip(), file=self._current_file(),
+                line=int(lines.group(1)) if lines else None,
+            ))
+            return
+
+        m = _PACKAGE_MESSAGE.match(line) if line.startswith("Package ") else None
+        if m and m.group(2) == "Warning":
+            lines = _WARNING_LINE_NUMBER.search(line)
+            diag = LogDiagnostic(severity="warning", message=line.strip(), file=self._current_file(),
+                                 line=int(lines.group(1)) if lines else None, package=m.group(1))
+            self._add("package", diag)
+            self._continues = diag
+            return
+
+        self._track_files(line)
+
+    @property
+    def errors(self) -> list[LogDiagnostic]:
+        return self.by_kind["error"]
+
+    def warnings(self) -> list[LogDiagnostic]:
+        """Warnings and bad boxes, most actionable kinds first, at most MAX_WARNINGS."""
+        ordered = [d for kind in _WARNING_KINDS for d in self.by_kind[kind]]
+        return ordered[:MAX_WARNINGS]
+
+    def diagnostics(self) -> list[LogDiagnostic]:
+        return self.errors + self.warnings()
+
+
+_scan_memo: dict[tuple, _LogScan] = {}
+_scan_memo_lock = threading.Lock()
+
+
+def _scan_log(log_path: str) -> _LogScan | None:
+    """Scan a log once; repeated calls for an unchanged file reuse the result."""
+    try:
+        st = os.stat(log_path)
+    except OSError:
+        return None
+    memo_key = (log_path, st.st_ino, st.st_mtime_ns, st.st_size)
+    with _scan_memo_lock:
+        scan = _scan_memo.get(memo_key)
+    if scan is not None:
+        return scan
+    scan = _LogScan()
+    try:
+        with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+            for raw in f:
+                scan.feed(raw.rstrip("\r\n"))
+    except OSError:
+        return None
+    with _scan_memo_lock:
+        if len(_scan_memo) >= 32:
+            _scan_memo.clear()
+        _scan_memo[memo_key] = scan
+    return scan
 
-            if line_num:
-                entry = f"ERRO na linha {line_num}: {error_msg}"
-            else:
-                entry = f"ERRO: {error_msg}"
 
-            # Add up to 3 lines of context
-            if context_lines:
-                ctx_str = "\n  ".join(context_lines[:3])
-                entry += f"\n  {ctx_str}"
+def _tex_error_code(scan: _LogScan | None) -> str:
+    """error_code of a failed pass: TeX ran out of its own memory, or any other error."""
+    if scan and scan.errors and scan.errors[0].message.startswith("TeX capacity exceeded"):
+        return "tex_capacity"
+    return "tex_error"
 
-            errors.append(entry)
-            i += len(context_lines) + 1
-        else:
-            i += 1
 
-    if not errors:
+def _format_latex_errors(scan: _LogScan | None) -> str:
+    """Render the first errors of a scanned log, with line numbers.
+
+    Example output:
+        ERRO na linha 42: Undefined control sequence \\palavraschaves
+        Contexto: l.42 \\palavraschaves{Educação, AEE}
+    """
+    if scan is None or not scan.errors:
         return ""
+    entries: list[str] = []
+    for diag in scan.errors[:MAX_ERRORS]:
+        if diag.line:
+            entry = f"ERRO na linha {diag.line}: {diag.message}"
+        else:
+            entry = f"ERRO: {diag.message}"
+        # Add up to 3 lines of context
+        if diag.context:
+            entry += "\n  " + "\n  ".join(diag.context[:3])
+        entries.append(entry)
 
-    result = "\n\n".join(errors)
+    result = "\n\n".join(entries)
 
     # Add Beamer hints when error points to \end{frame} (common with TikZ/foreach errors)
     if re.search(r"\\end\{frame\}", result):
@@ -123,151 +311,2768 @@ def _parse_latex_errors(lines: list[str]) -> str:
 MAX_IMAGES_TOTAL_BYTES = 10 * 1024 * 1024  # 10 MB
 
 
-def _prepare_images(images: list[ImagePayload] | None, tmpdir: str) -> bool:
-    """Decode images to tmpdir/images/. Returns True if images were written."""
+def _safe_image_name(filename: str) -> str:
+    """Sanitize filename — only allow alphanumeric, dash, underscore, dot."""
+    return re.sub(r"[^a-zA-Z0-9._-]", "_", filename)
+
+
+def _prepare_images(images: list[ImagePayload] | None, tmpdir: str,
+                    latex_source: str | None = None, quick: bool = False) -> bool:
+    """Place normalized images in tmpdir/images/. Returns True if images were written.
+
+    Inline base64 is size-checked from its encoded length before anything is
+    decoded. Every image goes through _normalized_image (sized for its use in
+    latex_source; only already normalized versions when quick) and is
+    hard-linked from the asset store.
+    """
     if not images:
         return False
     images_dir = os.path.join(tmpdir, "images")
     os.makedirs(images_dir, exist_ok=True)
     total_bytes = 0
     for img in images:
-        data = base64.b64decode(img.data_base64)
-        total_bytes += len(data)
+        if img.sha256:
+            total_bytes += _asset_size(img.sha256)
+        else:
+            total_bytes += len(img.data_base64) * 3 // 4
         if total_bytes > MAX_IMAGES_TOTAL_BYTES:
             raise ValueError(f"Total de imagens excede {MAX_IMAGES_TOTAL_BYTES // (1024*1024)}MB")
-        # Sanitize filename — only allow alphanumeric, dash, underscore, dot
-        safe_name = re.sub(r"[^a-zA-Z0-9._-]", "_", img.filename)
-        with open(os.path.join(images_dir, safe_name), "wb") as f:
-            f.write(data)
+    for img in _intern_images(images):
+        safe_name = _safe_image_name(img.filename)
+        box = _image_box(latex_source, safe_name)
+        sha256 = _normalized_image(img.sha256, safe_name, box, compute=not quick)
+        _link_asset(sha256, os.path.join(images_dir, safe_name))
     return True
 
 
 def _enable_real_graphicx(latex_source: str) -> str:
-    """Replace draft graphicx with real graphicx and add graphicspath."""
+    """Replace draft graphicx with real graphicx and add graphicspath.
+
+    Both go on the line of the original \\usepackage, so line numbers in the
+    compiled document.tex (log errors, diagnostics) match latex_source.
+    """
     # Use regex to handle optional comments/whitespace after the command
     result = re.sub(
         r"\\usepackage\[draft\]\{graphicx\}[^\n]*",
-        r"\\usepackage{graphicx}\n\\graphicspath{{./images/}}",
+        r"\\usepackage{graphicx}\\graphicspath{{./images/}}",
         latex_source,
     )
     return result
 
 
-@app.get("/health")
-def health():
-    return {"status": "ok"}
+# ---------------------------------------------------------------------------
+# Work directory pool — job tmpdirs on tmpfs, reset and reused between jobs
+# ---------------------------------------------------------------------------
 
+WORKDIR_RAM_ROOT = os.environ.get("WORKDIR_RAM_ROOT", "/dev/shm")
+WORKDIR_POOL_SIZE = int(os.environ.get("WORKDIR_POOL_SIZE", "8"))
+WORKDIR_RAM_MAX_BYTES = int(os.environ.get("WORKDIR_RAM_MAX_BYTES", str(256 * 1024 * 1024)))
+WORKDIR_RAM_MIN_FREE_BYTES = int(os.environ.get("WORKDIR_RAM_MIN_FREE_BYTES", str(32 * 1024 * 1024)))
+# Largest file a job may write in a RAM workdir (RLIMIT_FSIZE, below JOB_MAX_FILE_MB);
+# jobs expected to need more than this start on disk
+WORKDIR_RAM_JOB_MAX_BYTES = int(os.environ.get("WORKDIR_RAM_JOB_MAX_BYTES", str(96 * 1024 * 1024)))
+# Note: the asset store (ASSET_STORE_DIR) is on disk by default. Hard links can't
+# cross filesystems, so _link_asset copies assets into RAM workdirs; disk workdirs
+# in the same temp directory get hard links.
+
+_workdir_lock = threading.Lock()
+_workdir_root: str | None = None
+_workdir_free: list[str] = []
+_workdir_ram: set[str] = set()
+# Bytes each RAM slot in use counts against WORKDIR_RAM_MAX_BYTES: what its job
+# was expected to write, or what recent jobs wrote (measured on release)
+_workdir_reserved: dict[str, int] = {}
+_workdir_stats = {
+    "ram_jobs_total": 0,
+    "disk_fallback_total": 0,
+    "last_fallback_reason": "",
+    "typical_job_bytes": 0,
+}
+
+
+def _dir_bytes(path: str) -> int:
+    """Apparent size of everything under path (cheap on a single job dir)."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _dir_bytes(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
 
-@app.post("/compile", response_model=CompileResponse)
-def compile_latex(
-    req: CompileRequest,
+
+def _sweep_stale_workdirs(ram_root: str) -> None:
+    """Remove pools left in tmpfs by worker processes that no longer exist."""
+    try:
+        names = os.listdir(ram_root)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith("aee-work-"):
+            continue
+        try:
+            pid = int(name.removeprefix("aee-work-"))
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(ram_root, name), ignore_errors=True)
+        except PermissionError:
+            pass
+
+
+def _init_workdir_pool() -> None:
+    """Create this process's pool on first use (caller holds _workdir_lock)."""
+    global _workdir_root
+    if _workdir_root is not None or WORKDIR_POOL_SIZE <= 0:
+        return
+    if not (os.path.isdir(WORKDIR_RAM_ROOT) and os.access(WORKDIR_RAM_ROOT, os.W_OK)):
+        _log.warning(f"[workdir] {WORKDIR_RAM_ROOT} unavailable — all jobs use disk tmpdirs")
+        _workdir_root = ""
+        return
+    _sweep_stale_workdirs(WORKDIR_RAM_ROOT)
+    root = os.path.join(WORKDIR_RAM_ROOT, f"aee-work-{os.getpid()}")
+    for i in range(WORKDIR_POOL_SIZE):
+        path = os.path.join(root, f"w{i}")
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, mode=0o700)
+        _workdir_free.append(path)
+        _workdir_ram.add(path)
+    _workdir_root = root
+
+
+def _ram_unavailable_reason(expected_bytes: int, reserve: int) -> str | None:
+    """Why a job can't get a RAM workdir right now, or None if it can.
+
+    reserve is what the job would count against WORKDIR_RAM_MAX_BYTES. Caller
+    holds _workdir_lock; nothing here walks the pool.
+    """
+    if expected_bytes > WORKDIR_RAM_JOB_MAX_BYTES:
+        return "job too large for RAM"
+    if not _workdir_free:
+        return "pool exhausted"
+    try:
+        st = os.statvfs(_workdir_root)
+        if st.f_bavail * st.f_frsize < WORKDIR_RAM_MIN_FREE_BYTES:
+            return "tmpfs low on space"
+    except OSError:
+        return "tmpfs unavailable"
+    if sum(_workdir_reserved.values()) + reserve >= WORKDIR_RAM_MAX_BYTES:
+        return "pool size cap reached"
+    return None
+
+
+def _acquire_workdir(prefix: str, expected_bytes: int = 0) -> str:
+    """Hand out an empty work directory — on tmpfs when possible, else a disk tmpdir.
+
+    expected_bytes is what the job is known to write (inputs and output);
+    jobs in RAM are also held to WORKDIR_RAM_JOB_MAX_BYTES per file while
+    they run (see _limit_job). Pair with _release_workdir().
+    """
+    with _workdir_lock:
+        _init_workdir_pool()
+        if _workdir_root:
+            reserve = max(expected_bytes, _workdir_stats["typical_job_bytes"])
+            reason = _ram_unavailable_reason(expected_bytes, reserve)
+            if reason is None:
+                _workdir_stats["ram_jobs_total"] += 1
+                path = _workdir_free.pop()
+                _workdir_reserved[path] = reserve
+                return path
+            _workdir_stats["disk_fallback_total"] += 1
+            _workdir_stats["last_fallback_reason"] = reason
+            _log.info(f"[workdir] {reason} — falling back to disk for {prefix.rstrip('_')} job")
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+def _in_ram_workdir(path: str | None) -> bool:
+    return bool(path and _workdir_root) and path.startswith(_workdir_root + os.sep)
+
+
+def _reset_workdir(path: str) -> None:
+    """Empty a pooled directory in place (no rmdir/mkdir churn)."""
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+def _release_workdir(path: str) -> None:
+    if path not in _workdir_ram:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    used = _dir_bytes(path)
+    with _workdir_lock:
+        _workdir_reserved.pop(path, None)
+        # Moving average: a run of big jobs makes the next ones reserve more
+        typical = _workdir_stats["typical_job_bytes"]
+        _workdir_stats["typical_job_bytes"] = int(typical * 0.8 + used * 0.2)
+    try:
+        _reset_workdir(path)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.makedirs(path, mode=0o700)
+        except OSError:
+            _log.warning(f"[workdir] could not recreate {path} — dropping it from the pool")
+            return
+    with _workdir_lock:
+        _workdir_free.append(path)
+
+
+def _workdir_snapshot() -> dict:
+    with _workdir_lock:
+        return {
+            "ram_root": _workdir_root or None,
+            "ram_free": len(_workdir_free),
+            "ram_size": len(_workdir_ram),
+            "ram_reserved_bytes": sum(_workdir_reserved.values()),
+            "typical_job_bytes": _workdir_stats["typical_job_bytes"],
+            "ram_jobs_total": _workdir_stats["ram_jobs_total"],
+            "disk_fallback_total": _workdir_stats["disk_fallback_total"],
+            "last_fallback_reason": _workdir_stats["last_fallback_reason"] or None,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Asset store — images and additional files addressed by SHA-256
+# ---------------------------------------------------------------------------
+
+ASSET_STORE_DIR = os.environ.get("ASSET_STORE_DIR", os.path.join(tempfile.gettempdir(), "aee-assets"))
+ASSET_STORE_MAX_BYTES = int(os.environ.get("ASSET_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+MAX_ASSET_BYTES = MAX_IMAGES_TOTAL_BYTES
+# Whole multipart body of one POST /assets (several files at once)
+MAX_ASSET_UPLOAD_BYTES = int(os.environ.get("MAX_ASSET_UPLOAD_BYTES", str(4 * MAX_ASSET_BYTES)))
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_asset_evict_lock = threading.Lock()
+
+
+def _asset_path(sha256: str) -> str:
+    if not _SHA256_RE.match(sha256 or ""):
+        raise ValueError(f"sha256 inválido: {sha256!r}")
+    return os.path.join(ASSET_STORE_DIR, sha256)
+
+
+def _asset_size(sha256: str) -> int:
+    try:
+        return os.path.getsize(_asset_path(sha256))
+    except OSError:
+        raise ValueError(f"Asset {sha256} não encontrado — reenvie via POST /assets")
+
+
+def _store_asset(data: bytes) -> str:
+    """Store bytes under their SHA-256 (no-op if already present) and return the hash."""
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = _asset_path(sha256)
+    if os.path.exists(path):
+        os.utime(path)
+        return sha256
+    os.makedirs(ASSET_STORE_DIR, exist_ok=True)
+    staging = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(staging, "wb") as f:
+        f.write(data)
+    os.replace(staging, path)
+    _evict_assets()
+    return sha256
+
+
+def _link_asset(sha256: str, dest: str) -> None:
+    """Hard-link an asset into a work directory (copy when on another filesystem)."""
+    path = _asset_path(sha256)
+    try:
+        os.utime(path)
+        os.link(path, dest)
+    except FileNotFoundError:
+        raise ValueError(f"Asset {sha256} não encontrado — reenvie via POST /assets")
+    except OSError:
+        shutil.copyfile(path, dest)
+
+
+def _evict_assets() -> None:
+    """Drop least recently used assets beyond ASSET_STORE_MAX_BYTES.
+
+    Work directories hold hard links, so evicting an asset mid-compile is safe.
+    """
+    with _asset_evict_lock:
+        try:
+            names = [n for n in os.listdir(ASSET_STORE_DIR) if _SHA256_RE.match(n)]
+        except FileNotFoundError:
+            return
+        entries = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(ASSET_STORE_DIR, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        total = sum(e[2] for e in entries)
+        for _, name, size in sorted(entries):
+            if total <= ASSET_STORE_MAX_BYTES:
+                break
+            try:
+                os.remove(os.path.join(ASSET_STORE_DIR, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def _intern_images(images: list[ImagePayload] | None) -> list[ImagePayload] | None:
+    """Move inline base64 images into the asset store, returning hash references.
+
+    Lets repeated compiles of one job (auto-fix loop) link instead of re-decoding.
+    """
+    if not images:
+        return images
+    interned: list[ImagePayload] = []
+    for img in images:
+        if img.sha256 or not img.data_base64:
+            interned.append(img)
+            continue
+        sha256 = _store_asset(base64.b64decode(img.data_base64))
+        interned.append(ImagePayload(filename=img.filename, sha256=sha256))
+    return interned
+
+
+async def _read_body_capped(request: Request, limit: int, detail: str) -> bytes:
+    """Read the request body, answering 413 as soon as more than limit bytes arrive.
+
+    Counts what is actually received, so chunked bodies and a wrong
+    Content-Length are held to the same limit.
+    """
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail=detail)
+    chunks: list[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=detail)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _replayed_request(request: Request, body: bytes) -> Request:
+    """A copy of request whose body is the already read bytes (for form parsing)."""
+    async def receive() -> dict:
+        return {"type": "http.request", "body": body, "more_body": False}
+    return Request(request.scope, receive)
+
+
+@app.post("/assets")
+async def upload_assets(
+    request: Request,
     authorization: str = Header(default=""),
 ):
-    # Auth check
+    """Store raw bytes (the request body) or every file of a multipart form.
+
+    Returns the SHA-256 of each asset; compile requests can then send
+    `{"filename": ..., "sha256": ...}` instead of base64 data.
+    """
     if AUTH_TOKEN:
         token = authorization.removeprefix("Bearer ").strip()
         if token != AUTH_TOKEN:
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-    tmpdir = tempfile.mkdtemp(prefix="latex_")
-    tex_path = os.path.join(tmpdir, "document.tex")
-    pdf_path = os.path.join(tmpdir, "document.pdf")
+    uploads: list[tuple[str, bytes]] = []
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        body = await _read_body_capped(
+            request, MAX_ASSET_UPLOAD_BYTES, f"Upload excede {MAX_ASSET_UPLOAD_BYTES // (1024*1024)}MB"
+        )
+        async with _replayed_request(request, body).form() as form:
+            for _, value in form.multi_items():
+                if hasattr(value, "read"):
+                    uploads.append((value.filename or "", await value.read()))
+    else:
+        body = await _read_body_capped(
+            request, MAX_ASSET_BYTES, f"Asset excede {MAX_ASSET_BYTES // (1024*1024)}MB"
+        )
+        uploads.append((request.query_params.get("filename", ""), body))
+
+    assets = []
+    for filename, data in uploads:
+        if len(data) > MAX_ASSET_BYTES:
+            raise HTTPException(status_code=413, detail=f"Asset excede {MAX_ASSET_BYTES // (1024*1024)}MB")
+        sha256 = await run_in_threadpool(_store_asset, data)
+        assets.append({"filename": filename, "sha256": sha256, "size_bytes": len(data)})
+    return {"assets": assets}
+
 
+@app.get("/assets/{sha256}")
+def asset_exists(
+    sha256: str,
+    authorization: str = Header(default=""),
+):
+    """Let clients skip uploads the store already has."""
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
     try:
-        latex_source = req.latex_source
+        size = _asset_size(sha256)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"sha256": sha256, "size_bytes": size}
 
-        # Write additional files (e.g. \input{} referenced .tex, .bib, .sty)
-        if req.additional_files:
-            for af in req.additional_files:
-                # Sanitize filename to prevent path traversal
-                safe_name = os.path.basename(af.filename)
-                if not safe_name:
-                    continue
-                af_path = os.path.join(tmpdir, safe_name)
-                with open(af_path, "w", encoding="utf-8") as af_file:
-                    af_file.write(af.content)
 
-        # Decode images and enable real graphicx if images provided
+# ---------------------------------------------------------------------------
+# Image normalization — downscale to print DPI, flatten alpha, cached by hash
+# ---------------------------------------------------------------------------
+
+IMAGE_NORMALIZE = os.environ.get("IMAGE_NORMALIZE", "1") != "0"
+IMAGE_TARGET_DPI = int(os.environ.get("IMAGE_TARGET_DPI", "200"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aee-image-cache"))
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "2000"))
+
+# Text block of the AEE templates (A4, 2 cm margins), used when \includegraphics
+# gives no size and for \textwidth-relative sizes
+_TEXTWIDTH_IN = 17 / 2.54
+_TEXTHEIGHT_IN = 25 / 2.54
+_UNIT_IN = {"in": 1.0, "cm": 1 / 2.54, "mm": 1 / 25.4, "pt": 1 / 72.27, "bp": 1 / 72}
+_REL_IN = {"textwidth": _TEXTWIDTH_IN, "linewidth": _TEXTWIDTH_IN, "columnwidth": _TEXTWIDTH_IN,
+           "textheight": _TEXTHEIGHT_IN, "paperwidth": 21 / 2.54, "paperheight": 29.7 / 2.54}
+_INCLUDEGRAPHICS = re.compile(r"\\includegraphics\s*(?:\[([^\]]*)\])?\s*\{([^}]*)\}")
+_GRAPHICS_DIM = re.compile(r"\b(width|height)\s*=\s*([\d.]*)\s*(?:(in|cm|mm|pt|bp)\b|\\(\w+))")
+
+_image_cache_lock = threading.Lock()
+
+
+def _dimension_inches(number: str, unit: str | None, rel: str | None) -> float | None:
+    try:
+        value = float(number) if number else 1.0
+    except ValueError:
+        return None
+    if unit:
+        return value * _UNIT_IN[unit]
+    if rel in _REL_IN:
+        return value * _REL_IN[rel]
+    return None
+
+
+def _image_box(latex_source: str | None, filename: str) -> tuple[int, int]:
+    """Largest pixel size (w, h) the document can show the image at, at IMAGE_TARGET_DPI."""
+    width_in, height_in = _TEXTWIDTH_IN, _TEXTHEIGHT_IN
+    if latex_source:
+        stem = os.path.splitext(filename)[0]
+        widths: list[float] = []
+        heights: list[float] = []
+        sized_everywhere = True
+        for m in _INCLUDEGRAPHICS.finditer(latex_source):
+            ref = os.path.basename(m.group(2).strip())
+            if ref != filename and ref != stem:
+                continue
+            found = {}
+            for dim in _GRAPHICS_DIM.finditer(m.group(1) or ""):
+                inches = _dimension_inches(dim.group(2), dim.group(3), dim.group(4))
+                if inches:
+                    found[dim.group(1)] = inches
+            if not found:
+                sized_everywhere = False
+            widths.append(found.get("width", _TEXTWIDTH_IN))
+            heights.append(found.get("height", _TEXTHEIGHT_IN))
+        if widths and sized_everywhere:
+            width_in, height_in = max(widths), max(heights)
+    return (max(1, int(width_in * IMAGE_TARGET_DPI + 0.5)), max(1, int(height_in * IMAGE_TARGET_DPI + 0.5)))
+
+
+def _reencode_image(data: bytes, filename: str, box: tuple[int, int]) -> bytes | None:
+    """Downscale to fit box, apply EXIF rotation and flatten alpha onto white.
+
+    The format follows the filename's extension (the LaTeX source names the
+    file), JPEG at IMAGE_JPEG_QUALITY or optimized PNG. The DPI stored in the
+    file is scaled with the pixels, so an \\includegraphics without a size
+    (which pdfTeX sizes from pixels / DPI, 72 if unset) keeps its physical size.
+    Returns None when the original is already fine as it is.
+    """
+    import io
+    from PIL import Image, ImageOps
+
+    ext = os.path.splitext(filename)[1].lower()
+    fmt = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG"}.get(ext)
+    if fmt is None:
+        return None
+    with Image.open(io.BytesIO(data)) as im:
+        orientation = im.getexif().get(0x0112, 1)
+        dpi = tuple(float(d) or 72.0 for d in im.info.get("dpi", (72, 72)))
+        full = im.size  # before draft decoding shrinks it
+        if orientation in (5, 6, 7, 8):  # transposed: axes swap
+            full, dpi = full[::-1], dpi[::-1]
+        if fmt == "JPEG":
+            im.draft("RGB", box)  # decode large JPEGs at reduced scale
+        oversized = im.width > box[0] or im.height > box[1]
+        rotated = orientation != 1
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+        if not (oversized or rotated or has_alpha):
+            return None
+        im = ImageOps.exif_transpose(im)
+        if oversized:
+            im.thumbnail(box, Image.LANCZOS)
+        if has_alpha:
+            rgba = im.convert("RGBA")
+            im = Image.new("RGB", rgba.size, (255, 255, 255))
+            im.paste(rgba, mask=rgba.getchannel("A"))
+        elif fmt == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        dpi = (dpi[0] * im.width / full[0], dpi[1] * im.height / full[1])
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            im.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=False, dpi=dpi)
+        else:
+            im.save(out, "PNG", optimize=True, dpi=dpi)
+    encoded = out.getvalue()
+    # Flattening/rotation must stick even if the bytes grew; plain recompression must not
+    if not (rotated or has_alpha) and len(encoded) >= len(data):
+        return None
+    return encoded
+
+
+def _normalized_image(sha256: str, filename: str, box: tuple[int, int], compute: bool = True) -> str:
+    """Asset hash of the normalized version of asset sha256 (itself if unchanged).
+
+    Results are remembered in IMAGE_CACHE_DIR, so each image/size pair is
+    processed once; the bytes live in the asset store and share its eviction.
+    With compute=False only a remembered result is used — previews take the
+    original rather than wait for Pillow.
+    """
+    if not IMAGE_NORMALIZE:
+        return sha256
+    params = f"{sha256}\0{os.path.splitext(filename)[1].lower()}\0{box}\0{IMAGE_TARGET_DPI}\0{IMAGE_JPEG_QUALITY}"
+    key = hashlib.sha256(params.encode("utf-8")).hexdigest()
+    entry = os.path.join(IMAGE_CACHE_DIR, key)
+    try:
+        with open(entry, "r", encoding="ascii") as f:
+            cached = f.read().strip()
+        if cached == sha256 or os.path.exists(_asset_path(cached)):
+            os.utime(entry)
+            return cached
+    except (OSError, ValueError):
+        pass
+    if not compute:
+        return sha256
+
+    started = time.monotonic()
+    try:
+        with open(_asset_path(sha256), "rb") as f:
+            data = f.read()
+        encoded = _reencode_image(data, filename, box)
+    except ImportError:
+        _log.warning("[images] Pillow not installed — images are used as uploaded")
+        return sha256
+    except Exception as e:
+        # Let pdflatex/pandoc report unreadable images as before
+        _log.info(f"[images] {filename}: not normalized ({e})")
+        encoded = None
+    result = _store_asset(encoded) if encoded is not None else sha256
+    if encoded is not None:
+        _log.info(
+            f"[images] {filename}: {len(data) // 1024}KB -> {len(encoded) // 1024}KB "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    staging = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(staging, "w", encoding="ascii") as f:
+        f.write(result)
+    os.replace(staging, entry)
+    _evict_image_cache()
+    return result
+
+
+def _evict_image_cache() -> None:
+    """Keep at most IMAGE_CACHE_MAX_ENTRIES normalization results, dropping the oldest."""
+    with _image_cache_lock:
         try:
-            has_images = _prepare_images(req.images, tmpdir)
-        except ValueError as e:
-            return CompileResponse(success=False, error=str(e))
-        if has_images:
-            latex_source = _enable_real_graphicx(latex_source)
+            names = [n for n in os.listdir(IMAGE_CACHE_DIR) if _SHA256_RE.match(n)]
+        except FileNotFoundError:
+            return
+        if len(names) <= IMAGE_CACHE_MAX_ENTRIES:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(IMAGE_CACHE_DIR, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[: len(entries) - IMAGE_CACHE_MAX_ENTRIES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-        # Write .tex file
-        with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(latex_source)
 
-        # Run pdflatex twice (for table of contents / references)
-        for pass_num in range(2):
-            result = subprocess.run(
-                [
-                    "pdflatex",
-                    "-interaction=nonstopmode",
-                    "-halt-on-error",
-                    "-output-directory", tmpdir,
-                    tex_path,
-                ],
-                capture_output=True,
-                timeout=60,
-                cwd=tmpdir,
-            )
+# ---------------------------------------------------------------------------
+# Job limits — rlimits, own process group and optional cgroup per TeX/pandoc run
+# ---------------------------------------------------------------------------
 
-            # Decode stdout/stderr safely
-            stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
-            stderr = result.stderr.decode("utf-8", errors="replace") if result.stderr else ""
+# Per process, so each pdflatex pass gets its own allowance; 0 disables a limit
+JOB_CPU_SECONDS = int(os.environ.get("JOB_CPU_SECONDS", "40"))
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", "1024"))
+JOB_MAX_FILE_MB = int(os.environ.get("JOB_MAX_FILE_MB", "256"))
+JOB_MAX_OPEN_FILES = int(os.environ.get("JOB_MAX_OPEN_FILES", "256"))
+# Delegated cgroup v2 directory (e.g. /sys/fs/cgroup/aee); empty disables per-job cgroups
+JOB_CGROUP_ROOT = os.environ.get("JOB_CGROUP_ROOT", "")
+JOB_CGROUP_MAX_PIDS = int(os.environ.get("JOB_CGROUP_MAX_PIDS", "64"))
+JOB_CGROUP_CPU_MAX = os.environ.get("JOB_CGROUP_CPU_MAX", "100000 100000")  # quota/period: one core
+
+# error_code of a job stopped by a limit. The *_limit ones are the job's own
+# limits, so resending the same input fails the same way; "killed" (possibly the
+# kernel OOM killer), "system_memory" and "ram_file_limit" (would pass in a disk
+# workdir) depend on load and are not cached.
+_LIMIT_ERRORS = {
+    "cpu_limit": f"Compilation exceeded the CPU time limit ({JOB_CPU_SECONDS}s)",
+    "memory_limit": f"Compilation exceeded the memory limit ({JOB_MEMORY_MB}MB)",
+    "file_size_limit": f"Compilation tried to write a file over {JOB_MAX_FILE_MB}MB",
+    "open_files_limit": f"Compilation exceeded the open files limit ({JOB_MAX_OPEN_FILES})",
+    "killed": "Compilation was killed by the system",
+    "system_memory": "Compilation ran out of memory (server under memory pressure)",
+    "ram_file_limit": f"Compilation tried to write a file over {WORKDIR_RAM_JOB_MAX_BYTES // (1024 * 1024)}MB"
+                      f" in its in-memory work directory",
+}
+
+_job_cgroups: dict[int, str] = {}
+_job_lock = threading.Lock()
+_limit_stats = {code: 0 for code in _LIMIT_ERRORS}
+_cgroup_disabled_reason: str | None = None
+
+
+class _JobLimitExceeded(Exception):
+    """A TeX or pandoc run was stopped by one of the job limits."""
+
+    def __init__(self, code: str):
+        super().__init__(_LIMIT_ERRORS[code])
+        self.code = code
+
+
+def _job_file_limit(cwd: str | None) -> int:
+    """RLIMIT_FSIZE for a job running in cwd: tighter in a RAM workdir."""
+    limit = JOB_MAX_FILE_MB * 1024 * 1024
+    if _in_ram_workdir(cwd) and WORKDIR_RAM_JOB_MAX_BYTES > 0:
+        limit = min(limit, WORKDIR_RAM_JOB_MAX_BYTES) if limit > 0 else WORKDIR_RAM_JOB_MAX_BYTES
+    return limit
+
+
+def _limit_job(pid: int, address_space: bool = True, cwd: str | None = None) -> None:
+    """Apply the rlimits (and cgroup, if configured) to a job that just started.
+
+    Set from the parent with prlimit rather than in preexec_fn, which isn't
+    safe with the server's threads; pdflatex and pandoc don't fork that early.
+    """
+    import resource
+
+    mb = 1024 * 1024
+    file_limit = _job_file_limit(cwd)
+    limits = [
+        (resource.RLIMIT_CPU, JOB_CPU_SECONDS, JOB_CPU_SECONDS + 5),  # SIGXCPU, then SIGKILL
+        (resource.RLIMIT_FSIZE, file_limit, file_limit),
+        (resource.RLIMIT_NOFILE, JOB_MAX_OPEN_FILES, JOB_MAX_OPEN_FILES),
+    ]
+    if address_space:
+        limits.append((resource.RLIMIT_AS, JOB_MEMORY_MB * mb, JOB_MEMORY_MB * mb))
+    for res, soft, hard in limits:
+        if soft <= 0:
+            continue
+        try:
+            _, current_hard = resource.prlimit(pid, res)
+            if current_hard != resource.RLIM_INFINITY:
+                hard = min(hard, current_hard)
+            resource.prlimit(pid, res, (min(soft, hard), hard))
+        except (OSError, ValueError) as e:
+            _log.warning(f"[limits] could not set limit {res} on pid {pid}: {e}")
+    if JOB_CGROUP_ROOT and _cgroup_disabled_reason is None:
+        _cgroup_attach(pid)
+
+
+def _cgroup_attach(pid: int) -> None:
+    global _cgroup_disabled_reason
+    path = os.path.join(JOB_CGROUP_ROOT, f"job-{pid}")
+    try:
+        os.mkdir(path)
+        settings = {
+            "memory.max": str(JOB_MEMORY_MB * 1024 * 1024),
+            "memory.swap.max": "0",
+            "pids.max": str(JOB_CGROUP_MAX_PIDS),
+            "cpu.max": JOB_CGROUP_CPU_MAX,
+        }
+        for name, value in settings.items():
+            try:
+                with open(os.path.join(path, name), "w") as f:
+                    f.write(value)
+            except OSError:
+                pass  # controller not enabled for the subtree
+        with open(os.path.join(path, "cgroup.procs"), "w") as f:
+            f.write(str(pid))
+    except OSError as e:
+        # Not delegated or not cgroup v2: keep going with rlimits only
+        _cgroup_disabled_reason = str(e)
+        _log.warning(f"[limits] per-job cgroups disabled ({JOB_CGROUP_ROOT}): {e}")
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        return
+    with _job_lock:
+        _job_cgroups[pid] = path
+
+
+def _release_job(pid: int) -> bool:
+    """Remove an exited job's cgroup. Returns True if the job was OOM-killed in it."""
+    with _job_lock:
+        path = _job_cgroups.pop(pid, None)
+    if path is None:
+        return False
+    oom = False
+    try:
+        with open(os.path.join(path, "memory.events"), "r") as f:
+            for line in f:
+                name, _, value = line.partition(" ")
+                if name == "oom_kill" and int(value) > 0:
+                    oom = True
+    except (OSError, ValueError):
+        pass
+    for _ in range(20):
+        try:
+            os.rmdir(path)
+            break
+        except FileNotFoundError:
+            break
+        except OSError:
+            time.sleep(0.05)  # killed children are still exiting
+    return oom
 
-            if result.returncode != 0:
-                # Extract structured error info from log
-                log_path = os.path.join(tmpdir, "document.log")
-                error_log = ""
-                if os.path.exists(log_path):
-                    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                        lines = f.readlines()
-                    error_log = _parse_latex_errors(lines)
-                if not error_log:
-                    error_log = stdout[-2000:] if stdout else stderr[-2000:]
-
-                return CompileResponse(
-                    success=False,
-                    error=error_log[:3000],
+
+def _mem_available_mb() -> int | None:
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _check_job_limits(result: subprocess.CompletedProcess, oom: bool, address_space: bool = True,
+                      cwd: str | None = None) -> None:
+    """Raise _JobLimitExceeded if a finished run was stopped by a limit.
+
+    oom is the job cgroup's own OOM kill. A failed allocation without it is
+    only blamed on the job's RLIMIT_AS when the machine still has that much
+    memory available; otherwise it was memory pressure from other work.
+    """
+    code = None
+    if oom:
+        code = "memory_limit"
+    elif result.returncode == -signal.SIGXCPU:
+        code = "cpu_limit"
+    elif result.returncode == -signal.SIGXFSZ:
+        code = "file_size_limit"
+    elif result.returncode == -signal.SIGKILL:
+        code = "killed"  # CPU hard limit or the kernel; our own kills raise before this
+    else:
+        tail = (result.stdout or b"")[-4000:] + (result.stderr or b"")[-4000:]
+        if b"memory exhausted" in tail or b"Cannot allocate memory" in tail:
+            available = _mem_available_mb()
+            own_limit = address_space and JOB_MEMORY_MB > 0 and available is not None and available >= JOB_MEMORY_MB
+            code = "memory_limit" if own_limit else "system_memory"
+        elif b"Too many open files" in tail:
+            code = "open_files_limit"
+        elif b"File too large" in tail:
+            code = "file_size_limit"
+    if code == "file_size_limit" and _job_file_limit(cwd) < JOB_MAX_FILE_MB * 1024 * 1024:
+        code = "ram_file_limit"
+    if code is not None:
+        with _job_lock:
+            _limit_stats[code] += 1
+        _log.warning(f"[limits] {os.path.basename(result.args[0])} stopped: {code}")
+        raise _JobLimitExceeded(code)
+
+
+# Set per thread (see _abort_jobs_on): runs started by that thread are killed once it is set
+_job_abort = threading.local()
+
+
+@contextmanager
+def _abort_jobs_on(event: threading.Event):
+    """Make TeX/pandoc runs of the current thread stop with _CompileCancelled once event is set."""
+    _job_abort.event = event
+    try:
+        yield
+    finally:
+        _job_abort.event = None
+
+
+def _run_job(cmd: list[str], cwd: str, timeout: float, address_space: bool = True) -> subprocess.CompletedProcess:
+    """subprocess.run for TeX and pandoc: own session, job limits, group kill on timeout."""
+    abort = getattr(_job_abort, "event", None)
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        _limit_job(proc.pid, address_space, cwd)
+        if abort is None:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                if abort.is_set():
+                    raise _CompileCancelled()
+                try:
+                    stdout, stderr = proc.communicate(timeout=max(0.0, min(_DISCONNECT_POLL_SECONDS, deadline - time.monotonic())))
+                    break
+                except subprocess.TimeoutExpired:
+                    if time.monotonic() >= deadline:
+                        raise
+    except BaseException:
+        _kill_process_group(proc.pid)
+        proc.communicate()
+        raise
+    finally:
+        oom = _release_job(proc.pid)
+    result = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    _check_job_limits(result, oom, address_space, cwd)
+    return result
+
+
+def _limits_snapshot() -> dict:
+    with _job_lock:
+        exceeded = dict(_limit_stats)
+    return {
+        "cpu_seconds": JOB_CPU_SECONDS,
+        "memory_mb": JOB_MEMORY_MB,
+        "max_file_mb": JOB_MAX_FILE_MB,
+        "max_open_files": JOB_MAX_OPEN_FILES,
+        "cgroups": bool(JOB_CGROUP_ROOT) and _cgroup_disabled_reason is None,
+        "exceeded_total": exceeded,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Preamble format cache — dump the preamble once, compile bodies against it
+# ---------------------------------------------------------------------------
+
+FMT_CACHE_DIR = os.environ.get("FMT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aee-fmt-cache"))
+FMT_CACHE_MAX_ENTRIES = int(os.environ.get("FMT_CACHE_MAX_ENTRIES", "24"))
+FMT_DUMP_TIMEOUT = 60
+
+_fmt_locks: dict[str, threading.Lock] = {}
+_fmt_locks_guard = threading.Lock()
+_tex_version: str | None = None
+
+
+def _get_tex_version() -> str:
+    """First line of `pdftex --version` — formats are only valid for the binary that dumped them."""
+    global _tex_version
+    if _tex_version is None:
+        try:
+            out = subprocess.run(["pdftex", "--version"], capture_output=True, timeout=10)
+            _tex_version = out.stdout.decode("utf-8", errors="replace").split("\n", 1)[0]
+        except Exception:
+            _tex_version = "unknown"
+    return _tex_version
+
+
+def _split_preamble(latex_source: str) -> str | None:
+    """Return everything before \\begin{document}, or None if there is no body marker."""
+    idx = latex_source.find("\\begin{document}")
+    if idx <= 0:
+        return None
+    return latex_source[:idx]
+
+
+def _preamble_key(preamble: str, extra_files: dict[str, str] | None = None) -> str:
+    """Hash the preamble plus any local files it may \\input or \\usepackage."""
+    h = hashlib.sha256()
+    h.update(_get_tex_version().encode("utf-8"))
+    h.update(b"\0")
+    h.update(preamble.encode("utf-8"))
+    for name in sorted(extra_files or {}):
+        h.update(b"\0" + name.encode("utf-8") + b"\0")
+        h.update(extra_files[name].encode("utf-8"))
+    return "aeefmt_" + h.hexdigest()[:24]
+
+
+def _fmt_lock(key: str) -> threading.Lock:
+    with _fmt_locks_guard:
+        lock = _fmt_locks.get(key)
+        if lock is None:
+            lock = _fmt_locks[key] = threading.Lock()
+        return lock
+
+
+def _evict_fmt_cache() -> None:
+    """Keep at most FMT_CACHE_MAX_ENTRIES formats, dropping the least recently used.
+
+    Per-key locks of formats no longer cached go too (unless held), so
+    _fmt_locks stays about as small as the cache.
+    """
+    try:
+        names = [name for name in os.listdir(FMT_CACHE_DIR) if name.endswith((".fmt", ".fail"))]
+    except FileNotFoundError:
+        names = []
+    entries = []
+    for name in names:
+        path = os.path.join(FMT_CACHE_DIR, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue  # evicted or replaced by another worker meanwhile
+    if len(entries) > FMT_CACHE_MAX_ENTRIES:
+        entries.sort()
+        for _, path in entries[: len(entries) - FMT_CACHE_MAX_ENTRIES]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        entries = entries[len(entries) - FMT_CACHE_MAX_ENTRIES:]
+    kept = {os.path.splitext(os.path.basename(path))[0] for _, path in entries}
+    with _fmt_locks_guard:
+        for key in [k for k, lock in _fmt_locks.items() if k not in kept and not lock.locked()]:
+            del _fmt_locks[key]
+
+
+def _prepare_format(tmpdir: str, tex_name: str, latex_source: str,
+                    extra_files: dict[str, str] | None = None) -> str | None:
+    """Make a dumped preamble format available in tmpdir and return its name.
+
+    The format is built with mylatexformat inside the job's tmpdir (so local
+    .sty/.tex files and images resolve), then moved into FMT_CACHE_DIR keyed by
+    the preamble hash. A document compiled with it skips its own preamble.
+    Returns None when the preamble cannot be dumped — callers then compile normally.
+    """
+    if FMT_CACHE_MAX_ENTRIES <= 0:
+        return None
+    preamble = _split_preamble(latex_source)
+    if preamble is None:
+        return None
+
+    key = _preamble_key(preamble, extra_files)
+    fmt_cached = os.path.join(FMT_CACHE_DIR, key + ".fmt")
+    fail_marker = os.path.join(FMT_CACHE_DIR, key + ".fail")
+    os.makedirs(FMT_CACHE_DIR, exist_ok=True)
+
+    with _fmt_lock(key):
+        if os.path.exists(fail_marker):
+            os.utime(fail_marker)
+            return None
+        if not os.path.exists(fmt_cached):
+            try:
+                result = _run_job(
+                    ["pdftex", "-ini", "-interaction=nonstopmode", "-halt-on-error",
+                     f"-jobname={key}", "&pdflatex", "mylatexformat.ltx", tex_name],
+                    tmpdir, FMT_DUMP_TIMEOUT,
                 )
+                built = os.path.join(tmpdir, key + ".fmt")
+                ok = result.returncode == 0 and os.path.exists(built)
+                # Only pdftex giving up on the preamble by itself is worth remembering
+                deterministic = result.returncode > 0
+            except (subprocess.TimeoutExpired, _JobLimitExceeded, OSError) as e:
+                _log.info(f"[fmt] preamble {key} not dumped this time ({type(e).__name__}) — compiling without format")
+                return None
+            if not ok:
+                _log.info(f"[fmt] preamble {key} could not be dumped — compiling without format")
+                if deterministic:
+                    open(fail_marker, "w").close()
+                _evict_fmt_cache()
+                return None
+            # Atomic publish: other workers may be building the same key concurrently
+            staging = fmt_cached + f".{os.getpid()}.tmp"
+            shutil.move(built, staging)
+            os.replace(staging, fmt_cached)
+            for ext in (".log",):
+                try:
+                    os.remove(os.path.join(tmpdir, key + ext))
+                except OSError:
+                    pass
+            _log.info(f"[fmt] dumped preamble format {key}")
+            _evict_fmt_cache()
+        else:
+            os.utime(fmt_cached)
 
-        # Check PDF exists
-        if not os.path.exists(pdf_path):
-            return CompileResponse(
-                success=False,
-                error="PDF was not generated (file not found after compilation)",
-            )
+        if not _link_format(fmt_cached, os.path.join(tmpdir, key + ".fmt")):
+            return None
+    return key
 
-        # Extract warnings from log
-        log_path = os.path.join(tmpdir, "document.log")
-        warnings = _extract_warnings(log_path) or None
 
-        # Read PDF and encode as base64
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
+def _link_format(fmt_cached: str, local: str) -> bool:
+    """Make a cached format visible in a work directory without copying if possible."""
+    if os.path.lexists(local):
+        if os.path.exists(local):
+            return True
+        os.remove(local)  # dangling symlink to an evicted format
+    try:
+        os.link(fmt_cached, local)
+        return True
+    except OSError:
+        pass
+    try:
+        # Workdirs on tmpfs can't hard-link to the disk cache; a symlink
+        # avoids copying the format (TeX opens it once, at startup)
+        os.symlink(fmt_cached, local)
+        return True
+    except OSError:
+        pass
+    try:
+        shutil.copyfile(fmt_cached, local)
+        return True
+    except OSError:
+        return False
+
+
+def _is_format_load_error(output: str) -> bool:
+    """True when pdflatex failed because the format itself was unusable."""
+    return (
+        "I can't find the format file" in output
+        or "Fatal format file error" in output
+        or ("---! " in output and ".fmt" in output)
+    )
+
+
+def _pdflatex_cmd(tmpdir: str, tex_name: str, fmt: str | None = None,
+                  jobname: str | None = None, draftmode: bool = False) -> list[str]:
+    cmd = ["pdflatex"]
+    if fmt:
+        cmd.append(f"-fmt={fmt}")
+    if jobname:
+        cmd.append(f"-jobname={jobname}")
+    if draftmode:
+        cmd.append("-draftmode")  # typeset and write aux/log, but no PDF
+    cmd += [
+        "-interaction=nonstopmode",
+        "-halt-on-error",
+        "-output-directory", tmpdir,
+        os.path.join(tmpdir, tex_name),
+    ]
+    return cmd
+
+
+def _run_pdflatex(tmpdir: str, tex_name: str, timeout: int,
+                  fmt: str | None = None) -> subprocess.CompletedProcess:
+    """Run a single pdflatex pass on tmpdir/tex_name, optionally against a dumped format."""
+    return _run_job(_pdflatex_cmd(tmpdir, tex_name, fmt), tmpdir, timeout)
+
+
+def _run_pdflatex_with_fallback(tmpdir: str, tex_name: str, timeout: int,
+                                fmt: str | None) -> tuple[subprocess.CompletedProcess, str | None]:
+    """Run one pass; if the cached format won't load, retry (and continue) without it."""
+    result = _run_pdflatex(tmpdir, tex_name, timeout, fmt)
+    if fmt and result.returncode != 0:
+        out = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
+        if _is_format_load_error(out):
+            _log.warning(f"[fmt] format {fmt} failed to load — falling back to plain compile")
+            return _run_pdflatex(tmpdir, tex_name, timeout, None), None
+    return result, fmt
+
+
+# ---------------------------------------------------------------------------
+# Rerun decision — run only as many pdflatex passes as the document needs
+# ---------------------------------------------------------------------------
+
+MAX_LATEX_PASSES = int(os.environ.get("MAX_LATEX_PASSES", "3"))
+
+# Auxiliary outputs that are read back on the next pass
+_RERUN_AUX_EXTS = (".toc", ".lof", ".lot", ".out")
+# .aux lines whose content changes the typeset output on the next pass. Every
+# \\newlabel counts: labels are also read through \\hyperref[..], \\nameref* and
+# preamble macros, so which ones the document uses can't be told from its source.
+_AUX_SIGNIFICANT_PREFIXES = ("\\newlabel", "\\bibcite", "\\pgfsyspdfmark", "\\LT@", "\\gdef \\LT@",
+                             "\\zref@newlabel")
+_KERNEL_LABEL_RERUN = "Label(s) may have changed"
+_RERUN_HINT = re.compile(r"\brerun\b", re.IGNORECASE)
+
+
+def _rerun_snapshot(tmpdir: str, jobname: str) -> dict[str, str | None]:
+    """Hash every auxiliary input that the next pass would read."""
+    snap: dict[str, str | None] = {}
+    for ext in _RERUN_AUX_EXTS:
+        path = os.path.join(tmpdir, jobname + ext)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        snap[ext] = hashlib.sha256(data).hexdigest() if data.strip() else None
+
+    significant: list[str] = []
+    try:
+        with open(os.path.join(tmpdir, jobname + ".aux"), "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.startswith(_AUX_SIGNIFICANT_PREFIXES):
+                    significant.append(line.rstrip())
+    except OSError:
+        pass
+    snap[".aux"] = hashlib.sha256("\n".join(significant).encode("utf-8")).hexdigest() if significant else None
+    return snap
+
+
+def _log_requests_rerun(tmpdir: str, jobname: str) -> bool:
+    """True if a package (longtable, rerunfilecheck, ...) asked for another run.
+
+    The kernel's "Label(s) may have changed" is ignored here — the .aux
+    snapshot already tracks every \\newlabel.
+    """
+    scan = _scan_log(os.path.join(tmpdir, jobname + ".log"))
+    return bool(scan and scan.rerun_requested)
+
+
+def _run_latex_passes(tmpdir: str, tex_name: str, timeout: int,
+                      fmt: str | None) -> tuple[subprocess.CompletedProcess, int]:
+    """Run pdflatex until cross-references settle (latexmk-style), up to MAX_LATEX_PASSES.
+
+    Returns the last pass result and the number of passes run. Stops early on
+    the first failing pass.
+    """
+    jobname = os.path.splitext(tex_name)[0]
+    before = _rerun_snapshot(tmpdir, jobname)
+    passes = 0
+    while True:
+        result, fmt = _run_pdflatex_with_fallback(tmpdir, tex_name, timeout, fmt)
+        passes += 1
+        if result.returncode != 0 or passes >= MAX_LATEX_PASSES:
+            return result, passes
+        after = _rerun_snapshot(tmpdir, jobname)
+        if after == before and not _log_requests_rerun(tmpdir, jobname):
+            return result, passes
+        before = after
+
+
+# ---------------------------------------------------------------------------
+# Async TeX engine — kill the whole process group on disconnect or deadline
+# ---------------------------------------------------------------------------
+
+COMPILE_DEADLINE_SECONDS = float(os.environ.get("COMPILE_DEADLINE_SECONDS", "60"))
+_DISCONNECT_POLL_SECONDS = 0.5
+
+
+class _CompileCancelled(Exception):
+    """The HTTP client went away before the compile finished."""
+
+
+def _kill_process_group(pid: int) -> None:
+    """SIGKILL a TeX process and every child it spawned (it leads its own session).
+
+    With a job cgroup, children that left the process group are killed too.
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    with _job_lock:
+        cgroup = _job_cgroups.get(pid)
+    if cgroup:
+        try:
+            with open(os.path.join(cgroup, "cgroup.kill"), "w") as f:
+                f.write("1")
+        except OSError:
+            pass
+
+
+async def _run_tex_async(cmd: list[str], cwd: str, deadline: float,
+                         is_cancelled: Callable[[], Awaitable[bool]] | None = None) -> subprocess.CompletedProcess:
+    """Run cmd in its own process group, polling for client disconnect.
+
+    deadline is an absolute time.monotonic() value. Raises
+    subprocess.TimeoutExpired past the deadline and _CompileCancelled when
+    is_cancelled() reports the client is gone; in both cases the process
+    group is killed before returning.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    _limit_job(proc.pid, cwd=cwd)
+    return await _await_tex(proc, cmd, deadline, is_cancelled, cwd)
+
+
+async def _await_tex(proc: asyncio.subprocess.Process, cmd: list[str], deadline: float,
+                     is_cancelled: Callable[[], Awaitable[bool]] | None = None,
+                     cwd: str | None = None) -> subprocess.CompletedProcess:
+    """Collect an already started TeX process under the rules of _run_tex_async.
+
+    Raises _JobLimitExceeded when the process was stopped by a job limit.
+    """
+    comm = asyncio.ensure_future(proc.communicate())
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(cmd, COMPILE_DEADLINE_SECONDS)
+            done, _ = await asyncio.wait({comm}, timeout=min(_DISCONNECT_POLL_SECONDS, remaining))
+            if done:
+                stdout, stderr = comm.result()
+                result = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+                break
+            if is_cancelled is not None and await is_cancelled():
+                raise _CompileCancelled()
+    finally:
+        if proc.returncode is None:
+            _kill_process_group(proc.pid)
+            comm.cancel()
+            await proc.wait()
+        oom = _release_job(proc.pid)
+    _check_job_limits(result, oom, cwd=cwd)
+    return result
+
+
+async def _run_latex_passes_async(tmpdir: str, tex_name: str, deadline: float, fmt: str | None,
+                                  latex_source: str,
+                                  is_cancelled: Callable[[], Awaitable[bool]] | None = None,
+                                  warm: "_WarmTex | None" = None,
+                                  max_passes: int = MAX_LATEX_PASSES,
+                                  draftmode: bool = False,
+                                  ) -> tuple[subprocess.CompletedProcess, int]:
+    """Async twin of _run_latex_passes, sharing its rerun decision.
+
+    With warm, the first pass runs on that parked process (tmpdir must be its
+    directory); any further passes start pdflatex normally.
+    """
+    jobname = os.path.splitext(tex_name)[0]
+    before = _rerun_snapshot(tmpdir, jobname)
+    passes = 0
+    while True:
+        if passes == 0 and warm is not None:
+            result = await _run_warm_tex(warm, latex_source, deadline, is_cancelled)
+        else:
+            result = await _run_tex_async(
+                _pdflatex_cmd(tmpdir, tex_name, fmt, draftmode=draftmode), tmpdir, deadline, is_cancelled
+            )
+        if fmt and result.returncode != 0:
+            out = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
+            if _is_format_load_error(out):
+                _log.warning(f"[fmt] format {fmt} failed to load — falling back to plain compile")
+                fmt = None
+                result = await _run_tex_async(
+                    _pdflatex_cmd(tmpdir, tex_name, None, draftmode=draftmode), tmpdir, deadline, is_cancelled
+                )
+        passes += 1
+        if result.returncode != 0 or passes >= max_passes:
+            return result, passes
+        after = _rerun_snapshot(tmpdir, jobname)
+        if after == before and not _log_requests_rerun(tmpdir, jobname):
+            return result, passes
+        before = after
+
+
+# ---------------------------------------------------------------------------
+# Warm pdflatex pool — processes parked on a loaded preamble format
+# ---------------------------------------------------------------------------
+
+# Parked processes per preamble format; 0 disables the pool
+WARM_POOL_PER_PREAMBLE = int(os.environ.get("WARM_POOL_PER_PREAMBLE", "0"))
+WARM_POOL_MAX_PROCESSES = int(os.environ.get("WARM_POOL_MAX_PROCESSES", "4"))
+WARM_POOL_IDLE_SECONDS = float(os.environ.get("WARM_POOL_IDLE_SECONDS", "300"))
+
+# FIFO the parked pdflatex is blocked on; the request's source is streamed into it
+_WARM_INPUT = "aee-warm-input.tex"
+
+
+class _WarmTex:
+    """A pdflatex that has loaded format `key` and is waiting to open its input FIFO."""
+
+    def __init__(self, key: str, proc: asyncio.subprocess.Process, cmd: list[str], tmpdir: str):
+        self.key = key
+        self.proc = proc
+        self.cmd = cmd
+        self.tmpdir = tmpdir
+        self.parked_at = time.monotonic()
+
+
+# Only touched from the event loop, so no lock
+_warm_pool: dict[str, list[_WarmTex]] = {}
+_warm_refilling: set[str] = set()
+_warm_tasks: set[asyncio.Future] = set()
+_warm_stats = {"hits_total": 0, "misses_total": 0, "spawned_total": 0, "evicted_total": 0}
+
+
+def _format_extra_files(req: CompileRequest) -> dict[str, str]:
+    """Additional files as they enter the preamble format key."""
+    return {os.path.basename(af.filename): af.sha256 or af.content for af in (req.additional_files or [])}
+
+
+def _warm_key(req: CompileRequest, cm: "_CompileMode") -> str | None:
+    """Format key this request will compile against, when the warm pool is on."""
+    if WARM_POOL_PER_PREAMBLE <= 0 or cm.draftmode:
+        return None
+    extra_files = _format_extra_files(req)
+    if _WARM_INPUT in extra_files:
+        return None
+    source = _enable_real_graphicx(req.latex_source) if req.images and not cm.quick else req.latex_source
+    preamble = _split_preamble(source)
+    if preamble is None:
+        return None
+    return _preamble_key(preamble, extra_files)
+
+
+def _spawn_background(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _warm_tasks.add(task)
+    task.add_done_callback(_warm_tasks.discard)
+
+
+def _take_warm_tex(key: str | None) -> _WarmTex | None:
+    """Claim a parked process for key. Each process serves exactly one job."""
+    if key is None:
+        return None
+    _evict_idle_warm()
+    parked = _warm_pool.get(key, [])
+    while parked:
+        warm = parked.pop(0)
+        if warm.proc.returncode is None:
+            _warm_stats["hits_total"] += 1
+            return warm
+        _spawn_background(_close_warm(warm))
+    _warm_stats["misses_total"] += 1
+    return None
+
+
+async def _close_warm(warm: _WarmTex) -> None:
+    _kill_process_group(warm.proc.pid)
+    await warm.proc.wait()
+    _release_job(warm.proc.pid)
+    await run_in_threadpool(_release_workdir, warm.tmpdir)
+
+
+def _evict_idle_warm() -> None:
+    """Kill processes parked longer than WARM_POOL_IDLE_SECONDS."""
+    cutoff = time.monotonic() - WARM_POOL_IDLE_SECONDS
+    for key in list(_warm_pool):
+        keep = []
+        for warm in _warm_pool[key]:
+            if warm.parked_at < cutoff or warm.proc.returncode is not None:
+                _warm_stats["evicted_total"] += 1
+                _spawn_background(_close_warm(warm))
+            else:
+                keep.append(warm)
+        if keep:
+            _warm_pool[key] = keep
+        else:
+            del _warm_pool[key]
+
+
+def _evict_lru_warm(exclude: str) -> bool:
+    """Make room under WARM_POOL_MAX_PROCESSES by dropping the longest-parked process."""
+    candidates = [w for key, parked in _warm_pool.items() if key != exclude for w in parked]
+    if not candidates:
+        return False
+    oldest = min(candidates, key=lambda w: w.parked_at)
+    _warm_pool[oldest.key].remove(oldest)
+    if not _warm_pool[oldest.key]:
+        del _warm_pool[oldest.key]
+    _warm_stats["evicted_total"] += 1
+    _spawn_background(_close_warm(oldest))
+    return True
+
+
+def _stage_warm_dir(key: str, tmpdir: str) -> bool:
+    fmt_cached = os.path.join(FMT_CACHE_DIR, key + ".fmt")
+    if not os.path.exists(fmt_cached) or not _link_format(fmt_cached, os.path.join(tmpdir, key + ".fmt")):
+        return False
+    os.mkfifo(os.path.join(tmpdir, _WARM_INPUT), 0o600)
+    return True
+
+
+async def _spawn_warm_tex(key: str) -> _WarmTex | None:
+    """Start pdflatex on format key; it loads the format and blocks opening the FIFO."""
+    tmpdir = await run_in_threadpool(_acquire_workdir, "warm_")
+    try:
+        if not await run_in_threadpool(_stage_warm_dir, key, tmpdir):
+            await run_in_threadpool(_release_workdir, tmpdir)
+            return None
+        cmd = _pdflatex_cmd(tmpdir, _WARM_INPUT, key, jobname="document")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=tmpdir,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        _limit_job(proc.pid, cwd=tmpdir)
+    except OSError as e:
+        _log.warning(f"[warm] could not start pdflatex for {key}: {e}")
+        await run_in_threadpool(_release_workdir, tmpdir)
+        return None
+    _warm_stats["spawned_total"] += 1
+    asyncio.get_running_loop().call_later(WARM_POOL_IDLE_SECONDS + 1, _evict_idle_warm)
+    return _WarmTex(key, proc, cmd, tmpdir)
+
+
+async def _refill_warm(key: str) -> None:
+    """Top the pool for key back up to WARM_POOL_PER_PREAMBLE parked processes."""
+    if key in _warm_refilling:
+        return
+    _warm_refilling.add(key)
+    try:
+        while len(_warm_pool.get(key, [])) < WARM_POOL_PER_PREAMBLE:
+            total = sum(len(parked) for parked in _warm_pool.values())
+            if total >= WARM_POOL_MAX_PROCESSES and not _evict_lru_warm(exclude=key):
+                return
+            warm = await _spawn_warm_tex(key)
+            if warm is None:
+                return
+            _warm_pool.setdefault(key, []).append(warm)
+    finally:
+        _warm_refilling.discard(key)
+
+
+def _feed_fifo(path: str, data: bytes, stop: threading.Event) -> None:
+    """Write data into the FIFO once pdflatex has it open; give up when stop is set."""
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            # ENXIO: no reader yet (pdflatex still loading its format)
+            if e.errno != errno.ENXIO or stop.is_set():
+                return
+            time.sleep(0.005)
+    try:
+        os.set_blocking(fd, True)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    except BrokenPipeError:
+        pass  # pdflatex stopped reading (error or killed)
+    finally:
+        os.close(fd)
+
+
+async def _run_warm_tex(warm: _WarmTex, latex_source: str, deadline: float,
+                        is_cancelled: Callable[[], Awaitable[bool]] | None = None) -> subprocess.CompletedProcess:
+    """Run one pass on a parked process by streaming the source into its FIFO."""
+    stop = threading.Event()
+    feeder = asyncio.ensure_future(run_in_threadpool(
+        _feed_fifo, os.path.join(warm.tmpdir, _WARM_INPUT), latex_source.encode("utf-8"), stop,
+    ))
+    try:
+        return await _await_tex(warm.proc, warm.cmd, deadline, is_cancelled, warm.tmpdir)
+    finally:
+        stop.set()
+        await asyncio.gather(feeder, return_exceptions=True)
+
+
+@app.on_event("shutdown")
+async def _shutdown_warm_pool() -> None:
+    """Parked processes lead their own sessions — don't leave them behind on exit."""
+    for parked in _warm_pool.values():
+        for warm in parked:
+            _kill_process_group(warm.proc.pid)
+    _warm_pool.clear()
+
+
+def _warm_snapshot() -> dict:
+    return {
+        "per_preamble": WARM_POOL_PER_PREAMBLE,
+        "max_processes": WARM_POOL_MAX_PROCESSES,
+        "parked": sum(len(parked) for parked in _warm_pool.values()),
+        "preambles": sum(1 for parked in _warm_pool.values() if parked),
+        **_warm_stats,
+    }
+
+
+# ---------------------------------------------------------------------------
+# PDF post-optimization — object streams, stream dedup, linearization
+# ---------------------------------------------------------------------------
+
+# off: pdflatex output as is; fast: object streams + linearize;
+# max: also deduplicate identical streams and recompress Flate data
+PDF_OPTIMIZE_LEVELS = ("off", "fast", "max")
+PDF_OPTIMIZE_LEVEL = os.environ.get("PDF_OPTIMIZE_LEVEL", "off")
+
+
+def _optimize_level(requested: str) -> str:
+    level = (requested or PDF_OPTIMIZE_LEVEL).lower()
+    if level not in PDF_OPTIMIZE_LEVELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown optimize level {level!r} (use {', '.join(PDF_OPTIMIZE_LEVELS)})",
+        )
+    return level
+
+
+def _dedupe_pdf_streams(pdf) -> int:
+    """Point every reference to a byte-identical stream at one copy.
+
+    Dossiers embed the same fonts and logos once per included PDF; the
+    orphaned copies are dropped when the file is written.
+    """
+    import pikepdf
+
+    canonical: dict[str, pikepdf.Object] = {}
+    duplicates: dict[tuple[int, int], pikepdf.Object] = {}
+    for obj in pdf.objects:
+        if not isinstance(obj, pikepdf.Stream):
+            continue
+        # /Length may itself be an indirect object, so leave it out of the identity
+        attrs = pikepdf.Dictionary({k: v for k, v in obj.stream_dict.items() if k != "/Length"})
+        h = hashlib.sha256(attrs.unparse())
+        h.update(b"\0" + obj.read_raw_bytes())
+        first = canonical.setdefault(h.hexdigest(), obj)
+        if first.objgen != obj.objgen:
+            duplicates[obj.objgen] = first
+    if not duplicates:
+        return 0
+
+    def relink(container) -> None:
+        if isinstance(container, pikepdf.Array):
+            items = list(enumerate(container))
+        elif isinstance(container, (pikepdf.Dictionary, pikepdf.Stream)):
+            items = list(container.items())
+        else:
+            return
+        for k, value in items:
+            if not isinstance(value, pikepdf.Object):
+                continue  # numbers, names and strings come back as Python values
+            if value.is_indirect:
+                target = duplicates.get(value.objgen)
+                if target is not None:
+                    container[k] = target
+            else:
+                relink(value)
+
+    for obj in pdf.objects:
+        relink(obj)
+    relink(pdf.trailer)
+    return len(duplicates)
+
+
+def _optimize_pdf(pdf_path: str, level: str) -> PdfOptimization | None:
+    """Rewrite pdf_path in place at the given level; None when skipped or failed."""
+    if level == "off":
+        return None
+    try:
+        import pikepdf
+    except ImportError:
+        _log.warning("[pdfopt] pikepdf not installed — PDFs are served as pdflatex wrote them")
+        return None
+
+    started = time.monotonic()
+    before = os.path.getsize(pdf_path)
+    optimized = pdf_path + ".opt"
+    try:
+        with pikepdf.open(pdf_path) as pdf:
+            deduplicated = _dedupe_pdf_streams(pdf) if level == "max" else 0
+            pdf.save(
+                optimized,
+                linearize=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                compress_streams=True,
+                recompress_flate=level == "max",
+            )
+    except Exception as e:
+        _log.warning(f"[pdfopt] {os.path.basename(pdf_path)} left as is: {e}")
+        try:
+            os.remove(optimized)
+        except OSError:
+            pass
+        return None
+    os.replace(optimized, pdf_path)
+    report = PdfOptimization(
+        level=level,
+        size_before_bytes=before,
+        size_after_bytes=os.path.getsize(pdf_path),
+        seconds=round(time.monotonic() - started, 3),
+        streams_deduplicated=deduplicated,
+    )
+    _log.info(
+        f"[pdfopt] {level}: {report.size_before_bytes} -> {report.size_after_bytes} bytes "
+        f"in {report.seconds}s ({deduplicated} streams deduplicated)"
+    )
+    return report
+
+
+# ---------------------------------------------------------------------------
+# Compile result cache — content-addressed, on disk, shared by all workers
+# ---------------------------------------------------------------------------
+
+COMPILE_CACHE_DIR = os.environ.get(
+    "COMPILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aee-compile-cache")
+)
+COMPILE_CACHE_MAX_ENTRIES = int(os.environ.get("COMPILE_CACHE_MAX_ENTRIES", "500"))
+COMPILE_CACHE_MAX_BYTES = int(os.environ.get("COMPILE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+COMPILE_CACHE_TTL_SECONDS = int(os.environ.get("COMPILE_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+# Failures decided by the inputs alone; anything else (timeouts, cancellations,
+# server errors, load-dependent limits, missing assets) is not remembered
+_CACHEABLE_ERROR_CODES = frozenset({"tex_error", "tex_capacity", "no_pdf", "cpu_limit", "memory_limit",
+                                    "file_size_limit", "open_files_limit"})
+
+_compile_cache_lock = threading.Lock()
+
+
+def _normalize_source(latex_source: str) -> str:
+    """Normalize line endings and trailing blanks — TeX ignores both."""
+    lines = latex_source.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).rstrip() + "\n"
+
+
+def _payload_sha256(data_base64: str) -> str:
+    """sha256 of the decoded bytes, so equal images hash alike however they were encoded."""
+    try:
+        data = base64.b64decode(data_base64)
+    except ValueError:
+        data = data_base64.encode("ascii", errors="replace")  # rejected later when written
+    return hashlib.sha256(data).hexdigest()
+
+
+def _compile_cache_key(
+    latex_source: str,
+    images: list[ImagePayload] | None = None,
+    additional_files: list[FilePayload] | None = None,
+    namespace: str = "",
+) -> str:
+    """Hash the normalized source and every input file that can affect the PDF.
+
+    namespace separates callers whose responses differ for the same inputs
+    (error texts, fields); /compile uses the bare key.
+    """
+    h = hashlib.sha256()
+    h.update(_get_tex_version().encode("utf-8") + b"\0")
+    if namespace:
+        h.update(b"ns\0" + namespace.encode("utf-8") + b"\0")
+    h.update(_normalize_source(latex_source).encode("utf-8"))
+    if images:
+        # Normalization rewrites the images the PDF embeds
+        h.update(f"\0imgcfg\0{IMAGE_NORMALIZE}\0{IMAGE_TARGET_DPI}\0{IMAGE_JPEG_QUALITY}".encode("ascii"))
+    for img in sorted(images or [], key=lambda i: i.filename):
+        h.update(b"\0img\0" + img.filename.encode("utf-8") + b"\0")
+        # An asset hash already identifies the bytes — no need to touch the data
+        h.update((img.sha256 or _payload_sha256(img.data_base64)).encode("ascii", errors="replace"))
+    for af in sorted(additional_files or [], key=lambda f: f.filename):
+        h.update(b"\0file\0" + af.filename.encode("utf-8") + b"\0")
+        h.update((af.sha256 or af.content).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _compile_cache_paths(key: str) -> tuple[str, str]:
+    return (
+        os.path.join(COMPILE_CACHE_DIR, key + ".json"),
+        os.path.join(COMPILE_CACHE_DIR, key + ".pdf"),
+    )
+
+
+def _compile_cache_get(key: str, include_pdf: bool = True) -> CompileResponse | None:
+    """Return the cached response for key (refreshing its LRU stamp), or None.
+
+    With include_pdf=False the PDF stays on disk, at _compile_cache_paths(key)[1].
+    """
+    if COMPILE_CACHE_MAX_ENTRIES <= 0:
+        return None
+    meta_path, pdf_path = _compile_cache_paths(key)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json_lib.load(f)
+        if time.time() - meta.get("created_at", 0) > COMPILE_CACHE_TTL_SECONDS:
+            _compile_cache_remove(key)
+            return None
+        pdf_b64 = None
+        if meta.get("success"):
+            if include_pdf:
+                with open(pdf_path, "rb") as f:
+                    pdf_b64 = base64.b64encode(f.read()).decode("ascii")
+            elif not os.path.exists(pdf_path):
+                return None
+        os.utime(meta_path)
+    except (OSError, ValueError):
+        return None
+    return CompileResponse(
+        success=meta.get("success", False),
+        pdf_base64=pdf_b64,
+        pdf_size_bytes=meta.get("pdf_size_bytes"),
+        error=meta.get("error"),
+        warnings=meta.get("warnings"),
+        passes=meta.get("passes"),
+        cache_hit=True,
+        optimization=meta.get("optimization"),
+        diagnostics=meta.get("diagnostics"),
+        error_code=meta.get("error_code"),
+    )
+
+
+def _compile_cache_put(key: str, resp: CompileResponse, pdf_file: str | None = None) -> None:
+    """Store a deterministic compile outcome (success or TeX error).
+
+    When pdf_file is given the finished PDF is moved into the cache instead of
+    being decoded again from resp.pdf_base64.
+    """
+    if COMPILE_CACHE_MAX_ENTRIES <= 0:
+        return
+    if not resp.success and resp.error_code not in _CACHEABLE_ERROR_CODES:
+        return
+    meta_path, pdf_path = _compile_cache_paths(key)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+        if resp.success and pdf_file and os.path.exists(pdf_file):
+            shutil.move(pdf_file, pdf_path + suffix)
+            os.replace(pdf_path + suffix, pdf_path)
+        elif resp.success and resp.pdf_base64:
+            with open(pdf_path + suffix, "wb") as f:
+                f.write(base64.b64decode(resp.pdf_base64))
+            os.replace(pdf_path + suffix, pdf_path)
+        meta = {
+            "success": resp.success,
+            "pdf_size_bytes": resp.pdf_size_bytes,
+            "error": resp.error,
+            "warnings": resp.warnings,
+            "passes": resp.passes,
+            "optimization": resp.optimization.model_dump() if resp.optimization else None,
+            "diagnostics": [d.model_dump() for d in resp.diagnostics] if resp.diagnostics else None,
+            "error_code": resp.error_code,
+            "created_at": time.time(),
+        }
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json_lib.dump(meta, f)
+        os.replace(meta_path + suffix, meta_path)
+    except OSError as e:
+        _log.warning(f"[cache] could not store compile result {key[:12]}: {e}")
+        return
+    _evict_compile_cache()
+
+
+def _compile_cache_put_pdf(key: str, resp: BaseModel, pdf_file: str) -> None:
+    """_compile_cache_put for a response whose PDF still lives only in pdf_file.
+
+    When the cache doesn't take the file (disabled, or the write failed), the
+    PDF is base64-encoded into resp so the reply still carries it.
+    """
+    _compile_cache_put(key, resp, pdf_file)
+    if resp.success and not resp.pdf_base64 and os.path.exists(pdf_file):
+        with open(pdf_file, "rb") as f:
+            resp.pdf_base64 = base64.b64encode(f.read()).decode("ascii")
+
+
+def _compile_cache_remove(key: str) -> None:
+    for path in _compile_cache_paths(key):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _evict_compile_cache() -> None:
+    """Drop expired entries, then least recently used ones beyond the entry/byte limits."""
+    with _compile_cache_lock:
+        try:
+            names = [n for n in os.listdir(COMPILE_CACHE_DIR) if n.endswith(".json")]
+        except FileNotFoundError:
+            return
+        now = time.time()
+        entries: list[tuple[float, str, int]] = []
+        for name in names:
+            key = name[: -len(".json")]
+            meta_path, pdf_path = _compile_cache_paths(key)
+            try:
+                st = os.stat(meta_path)
+            except OSError:
+                continue
+            size = st.st_size
+            if os.path.exists(pdf_path):
+                size += os.path.getsize(pdf_path)
+            entries.append((st.st_mtime, key, size))
+
+        entries.sort()
+        total = sum(e[2] for e in entries)
+        count = len(entries)
+        for mtime, key, size in entries:
+            expired = now - mtime > COMPILE_CACHE_TTL_SECONDS
+            if not expired and count <= COMPILE_CACHE_MAX_ENTRIES and total <= COMPILE_CACHE_MAX_BYTES:
+                break
+            _compile_cache_remove(key)
+            count -= 1
+            total -= size
+
+
+def _with_compile_cache(key: str, compile_fn: Callable[[], CompileResponse]) -> CompileResponse:
+    """Serve key from the result cache, or run compile_fn and remember its outcome."""
+    cached = _compile_cache_get(key)
+    if cached is not None:
+        _log.info(f"[cache] hit {key[:12]} (success={cached.success})")
+        return cached
+    resp = compile_fn()
+    _compile_cache_put(key, resp)
+    return resp
+
+
+# ---------------------------------------------------------------------------
+# Compile worker pool — bound concurrent TeX/pandoc jobs, shed load when full
+# ---------------------------------------------------------------------------
+
+# Slots are per uvicorn worker process, so split the CPUs between them.
+COMPILE_CONCURRENCY = int(os.environ.get("COMPILE_CONCURRENCY", "0")) or max(
+    1, (os.cpu_count() or 1) // max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+)
+COMPILE_MAX_QUEUE = int(os.environ.get("COMPILE_MAX_QUEUE", "8"))
+COMPILE_QUEUE_TIMEOUT = float(os.environ.get("COMPILE_QUEUE_TIMEOUT", "45"))
+
+_pool_cond = threading.Condition()
+_pool_active = 0
+_pool_waiting = 0
+_pool_stats = {
+    "jobs_total": 0,
+    "rejected_total": 0,
+    "wait_seconds_sum": 0.0,
+    "wait_seconds_max": 0.0,
+    "last_wait_seconds": 0.0,
+    "run_seconds_sum": 0.0,
+}
+
+
+def _retry_after_seconds() -> int:
+    """Rough time until a queued job would start, from the mean job duration."""
+    jobs = _pool_stats["jobs_total"]
+    mean_run = _pool_stats["run_seconds_sum"] / jobs if jobs else 5.0
+    backlog = (_pool_waiting + 1) / COMPILE_CONCURRENCY
+    return max(1, int(mean_run * backlog + 0.999))
+
+
+def _reject_busy(status_code: int, detail: str) -> HTTPException:
+    _pool_stats["rejected_total"] += 1
+    _log.warning(f"[pool] rejecting job ({detail}): active={_pool_active} waiting={_pool_waiting}")
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(_retry_after_seconds())},
+    )
+
+
+def _acquire_compile_slot(reject_when_full: bool = True) -> float:
+    """Block until one of COMPILE_CONCURRENCY slots is free; return seconds waited.
+
+    Request handlers get a fast 429 when COMPILE_MAX_QUEUE jobs are already
+    waiting, and a 503 if no slot frees up within COMPILE_QUEUE_TIMEOUT.
+    Background work (reject_when_full=False) always waits its turn.
+    """
+    global _pool_active, _pool_waiting
+    start = time.monotonic()
+    with _pool_cond:
+        if _pool_active >= COMPILE_CONCURRENCY:
+            if reject_when_full and _pool_waiting >= COMPILE_MAX_QUEUE:
+                raise _reject_busy(429, "Compiler busy — queue full")
+            _pool_waiting += 1
+            try:
+                deadline = start + COMPILE_QUEUE_TIMEOUT
+                while _pool_active >= COMPILE_CONCURRENCY:
+                    if reject_when_full:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise _reject_busy(503, "Compiler busy — timed out waiting in queue")
+                        _pool_cond.wait(timeout=remaining)
+                    else:
+                        _pool_cond.wait()
+            finally:
+                _pool_waiting -= 1
+        _pool_active += 1
+        waited = time.monotonic() - start
+        _pool_stats["jobs_total"] += 1
+        _pool_stats["wait_seconds_sum"] += waited
+        _pool_stats["last_wait_seconds"] = waited
+        _pool_stats["wait_seconds_max"] = max(_pool_stats["wait_seconds_max"], waited)
+    return waited
+
+
+def _release_compile_slot(run_seconds: float) -> None:
+    global _pool_active
+    with _pool_cond:
+        _pool_active -= 1
+        _pool_stats["run_seconds_sum"] += run_seconds
+        _pool_cond.notify()
+
+
+@contextmanager
+def _compile_slot(reject_when_full: bool = True):
+    """Hold a compile slot for the duration of a TeX/pandoc job."""
+    waited = _acquire_compile_slot(reject_when_full)
+    started = time.monotonic()
+    try:
+        yield waited
+    finally:
+        _release_compile_slot(time.monotonic() - started)
+
+
+def _pooled(fn, *args, reject_when_full: bool = True):
+    """Run fn(*args) while holding a compile slot."""
+    with _compile_slot(reject_when_full=reject_when_full):
+        return fn(*args)
+
+
+def _pool_snapshot() -> dict:
+    with _pool_cond:
+        jobs = _pool_stats["jobs_total"]
+        return {
+            "capacity": COMPILE_CONCURRENCY,
+            "active": _pool_active,
+            "queue_depth": _pool_waiting,
+            "max_queue": COMPILE_MAX_QUEUE,
+            "jobs_total": jobs,
+            "rejected_total": _pool_stats["rejected_total"],
+            "last_wait_seconds": round(_pool_stats["last_wait_seconds"], 3),
+            "mean_wait_seconds": round(_pool_stats["wait_seconds_sum"] / jobs, 3) if jobs else 0.0,
+            "max_wait_seconds": round(_pool_stats["wait_seconds_max"], 3),
+        }
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "pool": _pool_snapshot(), "workdirs": _workdir_snapshot(), "warm": _warm_snapshot(),
+            "limits": _limits_snapshot(), "jobs": _job_queue_snapshot(), "callbacks": _callback_snapshot(),
+            "llm": _llm_snapshot(), "local_fixes": _local_fix_snapshot()}
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of this worker's compile queue (scraped by Fly)."""
+    snap = _pool_snapshot()
+    workdirs = _workdir_snapshot()
+    warm = _warm_snapshot()
+    with _pool_cond:
+        wait_sum = _pool_stats["wait_seconds_sum"]
+    lines = [
+        "# TYPE aee_compile_active gauge",
+        f"aee_compile_active {snap['active']}",
+        "# TYPE aee_compile_capacity gauge",
+        f"aee_compile_capacity {snap['capacity']}",
+        "# TYPE aee_compile_queue_depth gauge",
+        f"aee_compile_queue_depth {snap['queue_depth']}",
+        "# TYPE aee_compile_last_wait_seconds gauge",
+        f"aee_compile_last_wait_seconds {snap['last_wait_seconds']}",
+        "# TYPE aee_compile_wait_seconds summary",
+        f"aee_compile_wait_seconds_sum {wait_sum:.3f}",
+        f"aee_compile_wait_seconds_count {snap['jobs_total']}",
+        "# TYPE aee_compile_rejected_total counter",
+        f"aee_compile_rejected_total {snap['rejected_total']}",
+        "# TYPE aee_workdir_ram_free gauge",
+        f"aee_workdir_ram_free {workdirs['ram_free']}",
+        "# TYPE aee_workdir_ram_jobs_total counter",
+        f"aee_workdir_ram_jobs_total {workdirs['ram_jobs_total']}",
+        "# TYPE aee_workdir_disk_fallback_total counter",
+        f"aee_workdir_disk_fallback_total {workdirs['disk_fallback_total']}",
+        "# TYPE aee_warm_parked gauge",
+        f"aee_warm_parked {warm['parked']}",
+        "# TYPE aee_warm_hits_total counter",
+        f"aee_warm_hits_total {warm['hits_total']}",
+        "# TYPE aee_warm_misses_total counter",
+        f"aee_warm_misses_total {warm['misses_total']}",
+        "# TYPE aee_job_limit_exceeded_total counter",
+    ]
+    for code, count in _limits_snapshot()["exceeded_total"].items():
+        lines.append(f'aee_job_limit_exceeded_total{{code="{code}"}} {count}')
+    lines.append("# TYPE aee_generate_jobs gauge")
+    jobs = _job_queue_snapshot()
+    for status in ("queued", "running", "done", "failed", "cancelled"):
+        lines.append(f'aee_generate_jobs{{status="{status}"}} {jobs[status]}')
+    lines.append("# TYPE aee_generate_dedup_total counter")
+    for outcome in ("attached", "reused"):
+        lines.append(f'aee_generate_dedup_total{{outcome="{outcome}"}} {jobs[f"dedup_{outcome}_total"]}')
+    lines.append("# TYPE aee_callbacks gauge")
+    callbacks = _callback_snapshot()
+    for status in ("pending", "delivered", "pulled", "failed"):
+        lines.append(f'aee_callbacks{{status="{status}"}} {callbacks[status]}')
+    llm = _llm_snapshot()
+    lines.append("# TYPE aee_llm_calls_total counter")
+    lines.append(f"aee_llm_calls_total {llm['calls_total']}")
+    lines.append("# TYPE aee_llm_tokens_total counter")
+    for kind in ("input", "cache_creation_input", "cache_read_input", "output"):
+        lines.append(f'aee_llm_tokens_total{{kind="{kind}"}} {llm[kind + "_tokens_total"]}')
+    lines.append("# TYPE aee_llm_fix_patches_total counter")
+    for outcome in ("applied", "rejected"):
+        lines.append(f'aee_llm_fix_patches_total{{outcome="{outcome}"}} {llm[f"fix_patches_{outcome}_total"]}')
+    lines.append("# TYPE aee_llm_fix_candidates_total counter")
+    for outcome in ("started", "won"):
+        lines.append(f'aee_llm_fix_candidates_total{{outcome="{outcome}"}} {llm[f"fix_candidates_{outcome}_total"]}')
+    local_fixes = _local_fix_snapshot()
+    lines.append("# TYPE aee_local_fix_failures_total counter")
+    lines.append(f"aee_local_fix_failures_total {local_fixes['failures_total']}")
+    lines.append("# TYPE aee_local_fix_unmatched_total counter")
+    lines.append(f"aee_local_fix_unmatched_total {local_fixes['unmatched_total']}")
+    lines.append("# TYPE aee_local_fix_rule_total counter")
+    for rule, counts in local_fixes["rules"].items():
+        for outcome, count in counts.items():
+            lines.append(f'aee_local_fix_rule_total{{rule="{rule}",outcome="{outcome}"}} {count}')
+    return Response(content="\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# ---------------------------------------------------------------------------
+# Binary PDF responses — opt-in application/pdf with Range support
+# ---------------------------------------------------------------------------
+
+_PDF_CHUNK_BYTES = 64 * 1024
+_MAX_WARNINGS_HEADER_BYTES = 4096
+_RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+_CACHE_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _wants_pdf(request: Request, output: str) -> bool:
+    """Binary mode is chosen with ?output=pdf or an Accept header that prefers PDF."""
+    if output:
+        return output.lower() == "pdf"
+    accept = request.headers.get("accept", "")
+    return "application/pdf" in accept and "application/json" not in accept
+
+
+def _pdf_meta_headers(key: str, resp: BaseModel) -> dict[str, str]:
+    """Compile metadata that travels in headers when the body is the raw PDF."""
+    headers = {
+        "X-Pdf-Key": key,
+        "X-Pdf-Size": str(resp.pdf_size_bytes or 0),
+        "X-Compile-Cache": "hit" if getattr(resp, "cache_hit", False) else "miss",
+    }
+    if resp.passes:
+        headers["X-Compile-Passes"] = str(resp.passes)
+    optimization = getattr(resp, "optimization", None)
+    if optimization is not None:
+        headers["X-Pdf-Optimize"] = optimization.level
+        headers["X-Pdf-Size-Before"] = str(optimization.size_before_bytes)
+        headers["X-Pdf-Optimize-Seconds"] = str(optimization.seconds)
+    warnings = getattr(resp, "warnings", None) or []
+    headers["X-Compile-Warning-Count"] = str(len(warnings))
+    # ensure_ascii keeps the header latin-1 safe; drop it rather than exceed proxy limits
+    encoded = json_lib.dumps(warnings, ensure_ascii=True)
+    if len(encoded) <= _MAX_WARNINGS_HEADER_BYTES:
+        headers["X-Compile-Warnings"] = encoded
+    return headers
+
+
+def _pdf_file_response(request: Request, path: str, headers: dict[str, str]) -> Response:
+    """Stream a PDF from disk, honouring a single `Range: bytes=` request."""
+    # Open before returning: an eviction that unlinks the file can't break the stream
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    start, end = 0, size - 1
+    status = 200
+    m = _RANGE_HEADER.match(request.headers.get("range", "").strip())
+    if m and (m.group(1) or m.group(2)):
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        else:
+            start = max(0, size - int(m.group(2)))
+        if start >= size or start > end:
+            f.close()
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Length"] = str(end - start + 1)
+
+    def _chunks():
+        with f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(_PDF_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(_chunks(), status_code=status, media_type="application/pdf", headers=headers)
+
+
+def _binary_reply(request: Request, key: str, resp: BaseModel) -> Response:
+    """Answer a binary-mode request: the PDF itself, or the JSON error with 422."""
+    if not resp.success:
+        return JSONResponse(resp.model_dump(), status_code=422)
+    headers = _pdf_meta_headers(key, resp)
+    if resp.pdf_base64:
+        # Not in the result cache (disabled or not storable) — the PDF only exists in memory
+        return Response(content=base64.b64decode(resp.pdf_base64), media_type="application/pdf", headers=headers)
+    if key:
+        try:
+            return _pdf_file_response(request, _compile_cache_paths(key)[1], headers)
+        except FileNotFoundError:
+            pass  # evicted since the compile stored it
+    _log.warning(f"[cache] PDF {key[:12]} gone before the reply")
+    return JSONResponse(
+        {"success": False, "error": "PDF no longer available — compile again", "error_code": "server_error"},
+        status_code=503,
+    )
+
+
+@app.get("/pdf/{key}")
+def get_pdf(
+    key: str,
+    request: Request,
+    authorization: str = Header(default=""),
+):
+    """Serve a compiled PDF by its X-Pdf-Key, with Range support for progressive viewers."""
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    if not _CACHE_KEY_RE.match(key):
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        return _pdf_file_response(request, _compile_cache_paths(key)[1], {"X-Pdf-Key": key})
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="PDF expired or not found")
+
+
+# ---------------------------------------------------------------------------
+# Preview mode — single pass, draft graphics, optional page/section range
+# ---------------------------------------------------------------------------
+
+_COMPILE_MODES = ("final", "preview", "validate")
+_RANGE_SPEC = re.compile(r"^\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?$")
+_SECTION_START = re.compile(r"^[ \t]*\\section\*?\s*[\[{]", re.MULTILINE)
+
+
+class _CompileMode:
+    """How /compile runs: the full pipeline (final) or a quick preview/validate pass."""
+
+    def __init__(self, mode: str = "final", pages: tuple[int, int | None] | None = None,
+                 sections: tuple[int, int | None] | None = None, optimize: str = "off"):
+        self.mode = mode
+        self.pages = pages
+        self.sections = sections
+        self.optimize = "off" if mode == "validate" else optimize
+
+    @property
+    def quick(self) -> bool:
+        return self.mode != "final"
+
+    @property
+    def draftmode(self) -> bool:
+        return self.mode == "validate"
+
+    @property
+    def max_passes(self) -> int:
+        return 1 if self.quick else MAX_LATEX_PASSES
+
+    def cache_key(self, key: str) -> str | None:
+        """Result cache key for this mode; validate runs produce no PDF and aren't cached."""
+        if self.draftmode:
+            return None
+        if not self.quick and self.optimize == "off":
+            return key
+        variant = f"{key}\0{self.mode}\0{self.pages}\0{self.sections}\0{self.optimize}"
+        return hashlib.sha256(variant.encode("utf-8")).hexdigest()
+
+
+_FINAL = _CompileMode(optimize=PDF_OPTIMIZE_LEVEL)
+
+
+def _parse_range(spec: str, what: str) -> tuple[int, int | None] | None:
+    """Parse "3", "2-5" or "4-" (open-ended) into (first, last)."""
+    if not spec:
+        return None
+    m = _RANGE_SPEC.match(spec)
+    if not m or int(m.group(1)) < 1:
+        raise HTTPException(status_code=400, detail=f"Invalid {what} range: {spec!r}")
+    first = int(m.group(1))
+    if m.group(2) is None:
+        return first, first
+    last = int(m.group(3)) if m.group(3) else None
+    if last is not None and last < first:
+        raise HTTPException(status_code=400, detail=f"Invalid {what} range: {spec!r}")
+    return first, last
+
+
+def _compile_mode(mode: str, pages: str, sections: str, optimize: str = "") -> _CompileMode:
+    mode = (mode or "final").lower()
+    if mode not in _COMPILE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode {mode!r} (use {', '.join(_COMPILE_MODES)})")
+    page_range = _parse_range(pages, "page")
+    section_range = _parse_range(sections, "section")
+    if mode == "final" and (page_range or section_range):
+        raise HTTPException(status_code=400, detail="pages/sections require mode=preview")
+    return _CompileMode(mode, page_range, section_range, _optimize_level(optimize))
+
+
+def _crop_sections(body: str, first: int, last: int | None) -> str:
+    """Keep the front matter plus \\section number first..last of the body."""
+    end_doc = body.rfind("\\end{document}")
+    if end_doc == -1:
+        end_doc = len(body)
+    matches = list(_SECTION_START.finditer(body, 0, end_doc))
+    if not matches:
+        return body
+    starts = [m.start() for m in matches]
+    bounds = starts + [end_doc]
+    kept = body[:starts[0]]
+    if first <= len(starts):
+        stop = len(starts) if last is None else min(last, len(starts))
+        # Keep the original numbering of the sections shown
+        numbered = sum(1 for m in matches[:first - 1] if "*" not in m.group(0))
+        kept += f"\\setcounter{{section}}{{{numbered}}}\n" + body[starts[first - 1]:bounds[stop]]
+    return kept + body[end_doc:]
+
+
+def _apply_preview(latex_source: str, cm: _CompileMode) -> str:
+    """Crop the body to cm.sections and drop pages outside cm.pages at shipout.
+
+    Everything is injected after \\begin{document}, so the preamble (and its
+    dumped format) is the same as for the full compile.
+    """
+    marker = "\\begin{document}"
+    idx = latex_source.find(marker)
+    if idx == -1:
+        return latex_source
+    idx += len(marker)
+    head, body = latex_source[:idx], latex_source[idx:]
+    if cm.sections:
+        body = _crop_sections(body, *cm.sections)
+    if cm.pages:
+        first, last = cm.pages
+        out = f"\\ifnum\\value{{page}}<{first}\\relax\\aeePreviewKeepfalse\\fi"
+        if last is not None:
+            out += f"\\ifnum\\value{{page}}>{last}\\relax\\aeePreviewKeepfalse\\fi"
+        # The shipout hook needs a 2020-10 kernel; older ones get \shipout
+        # wrapped so a dropped page is boxed into a scratch register instead
+        body = (
+            "\n\\newif\\ifaeePreviewKeep"
+            "\\ifdefined\\DiscardShipoutBox"
+            f"\\AddToHook{{shipout/before}}{{\\aeePreviewKeeptrue{out}"
+            "\\ifaeePreviewKeep\\else\\DiscardShipoutBox\\fi}"
+            "\\else\\newbox\\aeePreviewDropped\\let\\aeePreviewShipout\\shipout"
+            f"\\def\\shipout{{\\aeePreviewKeeptrue{out}"
+            "\\ifaeePreviewKeep\\expandafter\\aeePreviewShipout"
+            "\\else\\expandafter\\setbox\\expandafter\\aeePreviewDropped\\fi}"
+            "\\fi"
+        ) + body
+    return head + body
+
+
+@app.post("/compile", response_model=CompileResponse)
+async def compile_latex(
+    req: CompileRequest,
+    request: Request,
+    output: str = "",
+    mode: str = "",
+    pages: str = "",
+    sections: str = "",
+    optimize: str = "",
+    authorization: str = Header(default=""),
+):
+    """Compile LaTeX to PDF.
+
+    Returns JSON with pdf_base64 by default. With ?output=pdf or
+    `Accept: application/pdf` the body is the PDF itself (metadata in X-*
+    headers) and the same bytes stay fetchable with Range from /pdf/{key}.
+
+    ?mode=preview runs a single pass with draft graphics, optionally limited
+    to ?pages=2-4 and/or ?sections=3 (or "3-"); ?mode=validate also skips
+    writing the PDF (-draftmode) and only reports errors and warnings.
+    ?optimize=fast|max post-processes the PDF (default PDF_OPTIMIZE_LEVEL).
+    """
+    # Auth check
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+    cm = _compile_mode(mode, pages, sections, optimize)
+    binary = _wants_pdf(request, output) and not cm.draftmode
+    if req.project_id:
+        return await _compile_project(req, request, binary, cm)
+
+    key = cm.cache_key(_compile_cache_key(req.latex_source, req.images, req.additional_files))
+    cached = await run_in_threadpool(_compile_cache_get, key, not binary) if key else None
+    if cached is not None:
+        _log.info(f"[cache] hit {key[:12]} (success={cached.success})")
+        return _binary_reply(request, key, cached) if binary else cached
+
+    # Queue for a slot off the event loop; a client that left meanwhile is dropped
+    await run_in_threadpool(_acquire_compile_slot, True)
+    started = time.monotonic()
+    try:
+        # Binary replies stream the cached file, so skip base64 unless caching is off
+        encode_pdf = not binary or COMPILE_CACHE_MAX_ENTRIES <= 0
+        resp = await _compile_request(req, request.is_disconnected, key, encode_pdf, cm)
+    finally:
+        _release_compile_slot(time.monotonic() - started)
+    return _binary_reply(request, key, resp) if binary else resp
+
+
+def _write_compile_inputs(req: CompileRequest, tmpdir: str, cm: _CompileMode = _FINAL) -> str:
+    """Write additional files, images and document.tex; return the final source.
+
+    Raises ValueError when the images exceed MAX_IMAGES_TOTAL_BYTES or a
+    referenced asset is missing from the store.
+    """
+    latex_source = req.latex_source
+
+    # Write additional files (e.g. \input{} referenced .tex, .bib, .sty)
+    if req.additional_files:
+        for af in req.additional_files:
+            # Sanitize filename to prevent path traversal
+            safe_name = os.path.basename(af.filename)
+            if not safe_name:
+                continue
+            af_path = os.path.join(tmpdir, safe_name)
+            if af.sha256:
+                _link_asset(af.sha256, af_path)
+                continue
+            with open(af_path, "w", encoding="utf-8") as af_file:
+                af_file.write(af.content)
+
+    # Decode images and enable real graphicx if images provided (previews stay draft)
+    has_images = _prepare_images(req.images, tmpdir, latex_source, quick=cm.quick)
+    if has_images and not cm.quick:
+        latex_source = _enable_real_graphicx(latex_source)
+    if cm.quick:
+        latex_source = _apply_preview(latex_source, cm)
+
+    # Write .tex file
+    with open(os.path.join(tmpdir, "document.tex"), "w", encoding="utf-8") as f:
+        f.write(latex_source)
+    return latex_source
+
+
+def _compile_outcome(tmpdir: str, result: subprocess.CompletedProcess, passes: int,
+                     encode_pdf: bool = True, draftmode: bool = False,
+                     optimize: str = "off") -> CompileResponse:
+    """Turn the last pdflatex pass in tmpdir into a CompileResponse.
+
+    With encode_pdf=False the PDF is left in tmpdir and pdf_base64 stays empty.
+    A draftmode run writes no PDF, so success is just a clean exit.
+    """
+    pdf_path = os.path.join(tmpdir, "document.pdf")
+    log_path = os.path.join(tmpdir, "document.log")
+
+    # Decode stdout/stderr safely
+    stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
+    stderr = result.stderr.decode("utf-8", errors="replace") if result.stderr else ""
+
+    scan = _scan_log(log_path)
+    diagnostics = scan.diagnostics() if scan else None
+
+    if result.returncode != 0:
+        # Extract structured error info from log
+        error_log = _format_latex_errors(scan)
+        if not error_log:
+            error_log = stdout[-2000:] if stdout else stderr[-2000:]
+
+        return CompileResponse(
+            success=False,
+            error=error_log[:3000],
+            passes=passes,
+            diagnostics=diagnostics or None,
+            error_code=_tex_error_code(scan),
+        )
+
+    warnings = [d.message for d in scan.warnings()] if scan else []
+    if draftmode:
+        return CompileResponse(
+            success=True,
+            warnings=warnings or None,
+            passes=passes,
+            diagnostics=diagnostics or None,
+        )
+
+    # Check PDF exists
+    if not os.path.exists(pdf_path):
+        return CompileResponse(
+            success=False,
+            error="PDF was not generated (file not found after compilation)",
+            error_code="no_pdf",
+        )
+
+    optimization = _optimize_pdf(pdf_path, optimize)
+
+    if not encode_pdf:
+        return CompileResponse(
+            success=True,
+            pdf_size_bytes=os.path.getsize(pdf_path),
+            warnings=warnings or None,
+            passes=passes,
+            optimization=optimization,
+            diagnostics=diagnostics or None,
+        )
+
+    # Read PDF and encode as base64
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    return CompileResponse(
+        success=True,
+        pdf_base64=base64.b64encode(pdf_bytes).decode("ascii"),
+        pdf_size_bytes=len(pdf_bytes),
+        warnings=warnings or None,
+        optimization=optimization,
+        passes=passes,
+        diagnostics=diagnostics or None,
+    )
+
+
+async def _compile_request(req: CompileRequest,
+                           is_cancelled: Callable[[], Awaitable[bool]] | None = None,
+                           cache_key: str | None = None,
+                           encode_pdf: bool = True,
+                           cm: _CompileMode = _FINAL) -> CompileResponse:
+    """Compile a /compile request in a fresh tmpdir, aborting if the client leaves.
+
+    Blocking file work runs in the threadpool; pdflatex runs on the async
+    engine so a disconnect or COMPILE_DEADLINE_SECONDS kills it immediately.
+    With cache_key the outcome (and PDF file) is stored in the result cache.
+    """
+    # A parked pdflatex for this preamble brings its own (already staged) tmpdir
+    warm = _take_warm_tex(_warm_key(req, cm))
+    tmpdir = warm.tmpdir if warm is not None else await run_in_threadpool(_acquire_workdir, "latex_")
+    deadline = time.monotonic() + COMPILE_DEADLINE_SECONDS
+    fmt = warm.key if warm is not None else None
+
+    try:
+        try:
+            latex_source = await run_in_threadpool(_write_compile_inputs, req, tmpdir, cm)
+        except ValueError as e:
+            return CompileResponse(success=False, error=str(e))
+
+        if warm is None:
+            # Dump (or reuse) the preamble as a format so each pass skips package loading
+            extra_files = _format_extra_files(req)
+            fmt = await run_in_threadpool(_prepare_format, tmpdir, "document.tex", latex_source, extra_files)
+
+        return await _compile_written(tmpdir, latex_source, fmt, deadline, is_cancelled,
+                                      cache_key, encode_pdf, warm, cm)
+    except Exception as e:
+        return _engine_error_response(e)
+    finally:
+        if warm is not None and warm.proc.returncode is None:
+            # Inputs were rejected before the first pass — the process is spent anyway
+            _kill_process_group(warm.proc.pid)
+            await warm.proc.wait()
+        await run_in_threadpool(_release_workdir, tmpdir)
+        if fmt and WARM_POOL_PER_PREAMBLE > 0:
+            _spawn_background(_refill_warm(fmt))
+
+
+async def _compile_written(tmpdir: str, latex_source: str, fmt: str | None, deadline: float,
+                           is_cancelled: Callable[[], Awaitable[bool]] | None = None,
+                           cache_key: str | None = None, encode_pdf: bool = True,
+                           warm: _WarmTex | None = None,
+                           cm: _CompileMode = _FINAL) -> CompileResponse:
+    """Run the passes on an already written tmpdir/document.tex and build the response."""
+    if is_cancelled is not None and await is_cancelled():
+        raise _CompileCancelled()
+
+    # Run pdflatex until references/ToC settle (usually 1–2 passes; previews stop after one)
+    result, passes = await _run_latex_passes_async(
+        tmpdir, "document.tex", deadline, fmt, latex_source, is_cancelled, warm,
+        cm.max_passes, cm.draftmode,
+    )
+    resp = await run_in_threadpool(
+        _compile_outcome, tmpdir, result, passes, encode_pdf, cm.draftmode, cm.optimize
+    )
+    if cache_key:
+        pdf_file = os.path.join(tmpdir, "document.pdf")
+        await run_in_threadpool(_compile_cache_put_pdf, cache_key, resp, pdf_file)
+    return resp
+
+
+def _engine_error_response(e: Exception) -> CompileResponse:
+    """Map a cancelled, timed out, limited or crashed compile to its CompileResponse."""
+    if isinstance(e, _CompileCancelled):
+        _log.info("[compile] client disconnected — killed pdflatex")
+        return CompileResponse(
+            success=False,
+            error="Compilation cancelled (client disconnected)",
+            error_code="cancelled",
+        )
+    if isinstance(e, subprocess.TimeoutExpired):
+        return CompileResponse(
+            success=False,
+            error=f"Compilation timed out ({int(COMPILE_DEADLINE_SECONDS)}s limit)",
+            error_code="timeout",
+        )
+    if isinstance(e, _JobLimitExceeded):
+        return CompileResponse(success=False, error=str(e), error_code=e.code)
+    return CompileResponse(
+        success=False,
+        error=f"Server error: {str(e)}",
+        error_code="server_error",
+    )
+
+
+# ---------------------------------------------------------------------------
+# Project workspaces — keep inputs and aux state between editor recompiles
+# ---------------------------------------------------------------------------
+
+WORKSPACE_DIR = os.environ.get("WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "aee-workspaces"))
+WORKSPACE_MAX_ENTRIES = int(os.environ.get("WORKSPACE_MAX_ENTRIES", "64"))
+WORKSPACE_TTL_SECONDS = int(os.environ.get("WORKSPACE_TTL_SECONDS", str(6 * 3600)))
+
+_WORKSPACE_MANIFEST = ".aee-manifest.json"
+_WORKSPACE_LOCK = ".aee-lock"
+_WORKSPACE_GOOD_AUX = ".aee-good-aux"
+# State the next compile reads back; restored from the last good run after a failure
+_WORKSPACE_AUX_EXTS = (".aux",) + _RERUN_AUX_EXTS
+
+
+def _workspace_path(project_id: str) -> str:
+    digest = hashlib.sha256(project_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(WORKSPACE_DIR, digest)
+
+
+def _lock_workspace(path: str) -> int:
+    """Create (if needed) and exclusively lock a workspace, shared by all workers."""
+    lock_path = os.path.join(path, _WORKSPACE_LOCK)
+    while True:
+        os.makedirs(path, exist_ok=True)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # Evicted while we waited? Then lock the fresh directory instead
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def _unlock_workspace(fd: int) -> None:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _read_manifest(path: str) -> dict[str, str]:
+    try:
+        with open(os.path.join(path, _WORKSPACE_MANIFEST), "r", encoding="utf-8") as f:
+            return json_lib.load(f).get("files", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(path: str, files: dict[str, str]) -> None:
+    staging = os.path.join(path, _WORKSPACE_MANIFEST + ".tmp")
+    with open(staging, "w", encoding="utf-8") as f:
+        json_lib.dump({"files": files}, f)
+    os.replace(staging, os.path.join(path, _WORKSPACE_MANIFEST))
+
+
+def _sync_workspace(req: CompileRequest, path: str, cm: _CompileMode = _FINAL) -> tuple[str, dict[str, str]]:
+    """Apply the request's changes to the workspace and write document.tex.
+
+    Files the request doesn't mention stay as they are (with replace_files,
+    they are removed); unchanged files are not rewritten. Returns the final
+    source and the manifest ({name: sha256}).
+
+    Everything that can reject the request (sizes, missing assets, image
+    normalization) runs before the workspace is touched; new contents are
+    staged and renamed into place, and the manifest is saved even when a step
+    fails, so it never lists a file that isn't there.
+    """
+    files = _read_manifest(path)
+
+    # name -> (sha256, asset to link or None, text to write)
+    wanted: dict[str, tuple[str, str | None, str]] = {}
+    for af in req.additional_files or []:
+        safe_name = os.path.basename(af.filename)
+        if not safe_name or safe_name.startswith(".aee-"):
+            continue
+        if af.sha256:
+            _asset_size(af.sha256)
+            wanted[safe_name] = (af.sha256, af.sha256, "")
+        else:
+            wanted[safe_name] = (hashlib.sha256(af.content.encode("utf-8")).hexdigest(), None, af.content)
+    if req.images:
+        total_bytes = sum(
+            _asset_size(img.sha256) if img.sha256 else len(img.data_base64) * 3 // 4 for img in req.images
+        )
+        if total_bytes > MAX_IMAGES_TOTAL_BYTES:
+            raise ValueError(f"Total de imagens excede {MAX_IMAGES_TOTAL_BYTES // (1024*1024)}MB")
+        for img in _intern_images(req.images):
+            safe_name = _safe_image_name(img.filename)
+            sha256 = _normalized_image(img.sha256, safe_name, _image_box(req.latex_source, safe_name),
+                                       compute=not cm.quick)
+            wanted["images/" + safe_name] = (sha256, sha256, "")
+
+    removed = [rel for name in req.removed_files or []
+               for rel in (os.path.basename(name), "images/" + _safe_image_name(name))]
+    if req.replace_files:
+        removed += [rel for rel in files if rel not in wanted]
+    try:
+        for rel in removed:
+            if rel in files and rel not in wanted:
+                try:
+                    os.remove(os.path.join(path, rel))
+                except FileNotFoundError:
+                    pass
+                del files[rel]
+
+        staging = os.path.join(path, ".aee-staging")
+        for rel, (sha256, asset, text) in wanted.items():
+            if files.get(rel) == sha256:
+                continue
+            if os.path.lexists(staging):
+                os.remove(staging)
+            if asset:
+                _link_asset(asset, staging)
+            else:
+                with open(staging, "w", encoding="utf-8") as f:
+                    f.write(text)
+            os.makedirs(os.path.dirname(os.path.join(path, rel)), exist_ok=True)
+            os.replace(staging, os.path.join(path, rel))
+            files[rel] = sha256
+    finally:
+        _write_manifest(path, files)
+
+    latex_source = req.latex_source
+    if cm.quick:
+        latex_source = _apply_preview(latex_source, cm)
+    elif any(rel.startswith("images/") for rel in files):
+        latex_source = _enable_real_graphicx(latex_source)
+    with open(os.path.join(path, "document.tex"), "w", encoding="utf-8") as f:
+        f.write(latex_source)
+    return latex_source, files
+
+
+def _workspace_cache_key(latex_source: str, files: dict[str, str]) -> str:
+    """Result cache key over everything the workspace compile will read."""
+    h = hashlib.sha256()
+    h.update(_get_tex_version().encode("utf-8") + b"\0")
+    h.update(_normalize_source(latex_source).encode("utf-8"))
+    for rel in sorted(files):
+        h.update(b"\0ws\0" + rel.encode("utf-8") + b"\0" + files[rel].encode("ascii"))
+    return h.hexdigest()
+
+
+def _keep_aux_state(path: str, success: bool) -> None:
+    """Snapshot aux files after a good run; roll them back after a failed one.
+
+    A run stopped by -halt-on-error can leave a truncated .aux that would break
+    the next compile of the project.
+    """
+    good = os.path.join(path, _WORKSPACE_GOOD_AUX)
+    os.makedirs(good, exist_ok=True)
+    for ext in _WORKSPACE_AUX_EXTS:
+        live = os.path.join(path, "document" + ext)
+        saved = os.path.join(good, "document" + ext)
+        try:
+            if success:
+                if os.path.exists(live):
+                    shutil.copyfile(live, saved)
+                elif os.path.exists(saved):
+                    os.remove(saved)
+            elif os.path.exists(saved):
+                shutil.copyfile(saved, live)
+            elif os.path.exists(live):
+                os.remove(live)
+        except OSError:
+            pass
+
+
+def _evict_workspaces(keep: str) -> None:
+    """Drop expired workspaces and the least recently used beyond WORKSPACE_MAX_ENTRIES."""
+    try:
+        names = os.listdir(WORKSPACE_DIR)
+    except FileNotFoundError:
+        return
+    entries = []
+    for name in names:
+        path = os.path.join(WORKSPACE_DIR, name)
+        if path == keep:
+            continue
+        try:
+            entries.append((os.stat(os.path.join(path, _WORKSPACE_MANIFEST)).st_mtime, path))
+        except OSError:
+            entries.append((0.0, path))
+    entries.sort()
+    now = time.time()
+    excess = len(entries) + 1 - WORKSPACE_MAX_ENTRIES
+    for mtime, path in entries:
+        if excess <= 0 and now - mtime <= WORKSPACE_TTL_SECONDS:
+            continue
+        try:
+            fd = os.open(os.path.join(path, _WORKSPACE_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue  # in use
+        shutil.rmtree(path, ignore_errors=True)
+        _unlock_workspace(fd)
+        excess -= 1
+
+
+async def _compile_project(req: CompileRequest, request: Request, binary: bool,
+                           cm: _CompileMode = _FINAL):
+    """/compile for a project workspace: incremental inputs, aux state kept between runs.
+
+    Compiles of one project are serialized (across workers) by a file lock.
+    Preview runs see the saved aux state but never replace it.
+    """
+    path = _workspace_path(req.project_id)
+    fd = await run_in_threadpool(_lock_workspace, path)
+    try:
+        try:
+            latex_source, files = await run_in_threadpool(_sync_workspace, req, path, cm)
+        except ValueError as e:
+            resp = CompileResponse(success=False, error=str(e))
+            return _binary_reply(request, "", resp) if binary else resp
+        await run_in_threadpool(_evict_workspaces, path)
+
+        key = cm.cache_key(_workspace_cache_key(latex_source, files))
+        cached = await run_in_threadpool(_compile_cache_get, key, not binary) if key else None
+        if cached is not None:
+            _log.info(f"[cache] hit {key[:12]} (project, success={cached.success})")
+            return _binary_reply(request, key, cached) if binary else cached
+
+        await run_in_threadpool(_acquire_compile_slot, True)
+        started = time.monotonic()
+        try:
+            encode_pdf = not binary or COMPILE_CACHE_MAX_ENTRIES <= 0
+            extra_files = {rel: sha for rel, sha in files.items() if not rel.startswith("images/")}
+            fmt = await run_in_threadpool(_prepare_format, path, "document.tex", latex_source, extra_files)
+            deadline = time.monotonic() + COMPILE_DEADLINE_SECONDS
+            try:
+                resp = await _compile_written(path, latex_source, fmt, deadline, request.is_disconnected,
+                                              key, encode_pdf, cm=cm)
+            except Exception as e:
+                resp = _engine_error_response(e)
+            await run_in_threadpool(_keep_aux_state, path, resp.success and not cm.quick)
+        finally:
+            _release_compile_slot(time.monotonic() - started)
+        return _binary_reply(request, key, resp) if binary else resp
+    finally:
+        await run_in_threadpool(_unlock_workspace, fd)
+
+
+@app.get("/workspaces/{project_id}")
+def workspace_manifest(
+    project_id: str,
+    authorization: str = Header(default=""),
+):
+    """Files the server holds for a project (name → sha256), so clients can send only changes."""
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    path = _workspace_path(project_id)
+    if not os.path.isdir(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"project_id": project_id, "files": _read_manifest(path)}
 
-        return CompileResponse(
-            success=True,
-            pdf_base64=base64.b64encode(pdf_bytes).decode("ascii"),
-            pdf_size_bytes=len(pdf_bytes),
-            warnings=warnings,
-        )
 
-    except subprocess.TimeoutExpired:
-        return CompileResponse(
-            success=False,
-            error="Compilation timed out (60s limit)",
-        )
-    except Exception as e:
-        return CompileResponse(
-            success=False,
-            error=f"Server error: {str(e)}",
-        )
+@app.delete("/workspaces/{project_id}")
+def delete_workspace(
+    project_id: str,
+    authorization: str = Header(default=""),
+):
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    path = _workspace_path(project_id)
+    if not os.path.isdir(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    fd = _lock_workspace(path)
+    try:
+        shutil.rmtree(path, ignore_errors=True)
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        _unlock_workspace(fd)
+    return {"deleted": True}
 
 
 class ConvertDocxResponse(BaseModel):
@@ -275,6 +3080,7 @@ class ConvertDocxResponse(BaseModel):
     docx_base64: str | None = None
     docx_size_bytes: int | None = None
     error: str | None = None
+    error_code: str | None = None  # as in CompileResponse
 
 
 _UNTITLED_ENVS = ["datacard", "materialbox"]
@@ -753,7 +3559,12 @@ def convert_to_docx(
         if token != AUTH_TOKEN:
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-    tmpdir = tempfile.mkdtemp(prefix="docx_")
+    return _pooled(_convert_docx_request, req)
+
+
+def _convert_docx_request(req: CompileRequest) -> ConvertDocxResponse:
+    """Run the pandoc conversion for /convert-docx in a fresh tmpdir."""
+    tmpdir = _acquire_workdir("docx_")
     tex_path = os.path.join(tmpdir, "document.tex")
     docx_path = os.path.join(tmpdir, "document.docx")
 
@@ -762,7 +3573,7 @@ def convert_to_docx(
 
         # Decode images for pandoc conversion
         try:
-            has_images = _prepare_images(req.images, tmpdir)
+            has_images = _prepare_images(req.images, tmpdir, latex_source)
         except ValueError as e:
             return ConvertDocxResponse(success=False, error=str(e))
         if has_images:
@@ -774,7 +3585,8 @@ def convert_to_docx(
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(clean_latex)
 
-        result = subprocess.run(
+        # No address-space limit: the GHC runtime reserves far more than it uses
+        result = _run_job(
             [
                 "pandoc",
                 tex_path,
@@ -783,9 +3595,9 @@ def convert_to_docx(
                 "-o", docx_path,
                 "--wrap=preserve",
             ],
-            capture_output=True,
-            timeout=60,
-            cwd=tmpdir,
+            tmpdir,
+            60,
+            address_space=False,
         )
 
         if result.returncode != 0:
@@ -817,14 +3629,18 @@ def convert_to_docx(
         return ConvertDocxResponse(
             success=False,
             error="Conversion timed out (60s limit)",
+            error_code="timeout",
         )
+    except _JobLimitExceeded as e:
+        return ConvertDocxResponse(success=False, error=str(e), error_code=e.code)
     except Exception as e:
         return ConvertDocxResponse(
             success=False,
             error=f"Server error: {str(e)}",
+            error_code="server_error",
         )
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        _release_workdir(tmpdir)
 
 
 # ---------------------------------------------------------------------------
@@ -834,9 +3650,6 @@ def convert_to_docx(
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 CLAUDE_MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-6")
 
-import logging
-_log = logging.getLogger("aee-latex")
-
 
 class GenerateAndCompileRequest(BaseModel):
     system_prompt: str
@@ -849,9 +3662,13 @@ class GenerateAndCompileRequest(BaseModel):
     doc_id: str = ""
     callback_url: str = ""
     callback_token: str = ""
+    callback_encoding: str = ""  # json, gzip or multipart (default CALLBACK_ENCODING)
     # Fallback credentials — used if service ANTHROPIC_API_KEY is out of credits
     fallback_api_key: str = ""
     fallback_model: str = ""
+    # Generate again even if the same request for this doc_id finished recently;
+    # an active job for the doc_id is superseded instead of answering 409
+    force: bool = False
 
 
 class GenerateAndCompileResponse(BaseModel):
@@ -863,6 +3680,7 @@ class GenerateAndCompileResponse(BaseModel):
     warnings: list[str] | None = None
     attempts: int = 0
     ai_model: str | None = None
+    error_code: str | None = None  # of the last compile attempt, as in CompileResponse
 
 
 def _extract_latex_body(raw: str) -> str:
@@ -926,120 +3744,1354 @@ def _sanitize_latex(source: str) -> str:
 def _compile_in_tmpdir(
     latex_source: str,
     images: list[ImagePayload] | None = None,
+) -> CompileResponse:
+    """Compile LaTeX in a fresh tmpdir, reusing a cached result for identical inputs."""
+    # The PDF is post-processed at PDF_OPTIMIZE_LEVEL, which _FINAL's key covers
+    key = _FINAL.cache_key(_compile_cache_key(latex_source, images, namespace="tmpdir"))
+    return _with_compile_cache(
+        key, lambda: _pooled(_compile_in_tmpdir_uncached, latex_source, images, reject_when_full=False)
+    )
+
+
+def _compile_in_tmpdir_uncached(
+    latex_source: str,
+    images: list[ImagePayload] | None = None,
 ) -> CompileResponse:
     """Compile LaTeX in a fresh tmpdir. Handles cleanup."""
-    tmpdir = tempfile.mkdtemp(prefix="gencomp_")
+    tmpdir = _acquire_workdir("gencomp_")
     try:
         tex_path = os.path.join(tmpdir, "document.tex")
         pdf_path = os.path.join(tmpdir, "document.pdf")
 
         source = latex_source
         try:
-            has_images = _prepare_images(images, tmpdir)
-        except ValueError as e:
-            return CompileResponse(success=False, error=str(e))
-        if has_images:
-            source = _enable_real_graphicx(source)
-
-        with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(source)
+            has_images = _prepare_images(images, tmpdir, source)
+        except ValueError as e:
+            return CompileResponse(success=False, error=str(e))
+        if has_images:
+            source = _enable_real_graphicx(source)
+
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(source)
+
+        fmt = _prepare_format(tmpdir, "document.tex", source)
+        result, passes = _run_latex_passes(tmpdir, "document.tex", 60, fmt)
+        scan = _scan_log(os.path.join(tmpdir, "document.log"))
+        diagnostics = scan.diagnostics() if scan else None
+        if result.returncode != 0:
+            stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
+            stderr = result.stderr.decode("utf-8", errors="replace") if result.stderr else ""
+            error_log = _format_latex_errors(scan) or (stdout[-2000:] if stdout else stderr[-2000:])
+            return CompileResponse(success=False, error=error_log[:3000], passes=passes,
+                                   diagnostics=diagnostics or None, error_code=_tex_error_code(scan))
+
+        if not os.path.exists(pdf_path):
+            return CompileResponse(success=False, error="PDF not generated", error_code="no_pdf")
+
+        warnings = [d.message for d in scan.warnings()] if scan else None
+        optimization = _optimize_pdf(pdf_path, PDF_OPTIMIZE_LEVEL)
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+
+        return CompileResponse(
+            success=True,
+            pdf_base64=base64.b64encode(pdf_bytes).decode("ascii"),
+            pdf_size_bytes=len(pdf_bytes),
+            warnings=warnings or None,
+            passes=passes,
+            optimization=optimization,
+            diagnostics=diagnostics or None,
+        )
+    except subprocess.TimeoutExpired:
+        return CompileResponse(success=False, error="Compilation timed out (60s)", error_code="timeout")
+    except _CompileCancelled:
+        return CompileResponse(success=False, error="Compilation cancelled", error_code="cancelled")
+    except _JobLimitExceeded as e:
+        return CompileResponse(success=False, error=str(e), error_code=e.code)
+    except Exception as e:
+        return CompileResponse(success=False, error=f"Server error: {str(e)}", error_code="server_error")
+    finally:
+        _release_workdir(tmpdir)
+
+
+_NOISE_WARNINGS = [
+    "Label(s) may have changed",
+    "There were multiply-defined labels",
+    "destination with the same identifier",
+    "Rerun to get",
+]
+
+
+def _filter_significant_warnings(warnings: list[str]) -> list[str]:
+    """Keep only warnings worth fixing; drop noise-only entries."""
+    return [w for w in warnings if not any(n in w for n in _NOISE_WARNINGS)]
+
+
+AUTOFIX_WARNINGS_SYSTEM = """Você é um especialista em LaTeX. O código abaixo compilou com sucesso, mas gerou os avisos listados.
+
+REGRAS — corrija os avisos SEM alterar o conteúdo do documento:
+1. Overfull \\hbox: reduza largura de colunas ou envolva tabular em \\adjustbox{max width=\\linewidth}{...}.
+2. Overfull \\vbox (tabela longa): converta \\begin{tabular} para \\begin{longtable} adicionando \\endfirsthead/\\endhead.
+3. Font shape undefined (T1/cmss/b/n, TS1/...): substitua caracteres ² por \\textsuperscript{2}, ³ por \\textsuperscript{3}.
+4. enumitem "Negative labelwidth": troque leftmargin=0pt por leftmargin=1.5em em description.
+5. Underfull \\hbox: aumente larguras de colunas estreitas ou adicione \\raggedright na coluna.
+6. LaTeX Font Warning "not available ... substituted": adicione \\normalfont ou troque \\bfseries por \\mdseries naquele contexto.
+7. NUNCA altere o conteúdo textual (seções, itens, dados).
+8. NUNCA coloque longtable dentro de adjustbox, tcolorbox ou qualquer grupo.
+
+Retorne o código LaTeX COMPLETO corrigido (de \\begin{document} até \\end{document}), sem explicações, sem fence blocks."""
+
+
+AUTOFIX_SYSTEM = """Você é um especialista em LaTeX. O código abaixo falhou na compilação com pdflatex.
+
+REGRAS DE CORREÇÃO:
+1. Corrija os erros mantendo o conteúdo e estilo.
+2. Se o documento está TRUNCADO (texto cortado), COMPLETE o conteúdo faltante.
+3. NUNCA use \\begin{axis}/pgfplots — substitua por tabelas com booktabs.
+4. NUNCA coloque longtable dentro de adjustbox, tcolorbox ou qualquer grupo.
+5. NUNCA use condicionais TeX (\\ifnum, \\ifcase, \\else, \\fi, \\or).
+6. NUNCA use \\foreach com rnd ou \\pgfmathparse inline em cores.
+7. NUNCA use \\multirowcell — use \\multirow{N}{*}{texto}.
+8. Todas as tcolorbox (infobox, alertbox, etc.) já são breakable — NÃO adicione breakable.
+9. \\rowcolor DEVE ser o PRIMEIRO comando de uma linha de tabela (nunca após &).
+10. Para tabelas que transbordam: envolva tabular em \\adjustbox{max width=\\linewidth}{...}.
+11. Se usar tabularx, SEMPRE inclua pelo menos uma coluna X.
+12. NUNCA use colunas X em longtable — X é exclusivo de tabularx.
+
+Retorne o código LaTeX corrigido COMPLETO (de \\begin{document} até \\end{document}), sem explicações, sem fence blocks."""
+
+
+# ---------------------------------------------------------------------------
+# Job progress — stage events per doc_id, streamed to clients as SSE
+# ---------------------------------------------------------------------------
+
+# Event logs live on disk so a stream opened on any worker sees the job
+PROGRESS_DIR = os.environ.get("PROGRESS_DIR", os.path.join(tempfile.gettempdir(), "aee-progress"))
+PROGRESS_TTL_SECONDS = int(os.environ.get("PROGRESS_TTL_SECONDS", "3600"))
+PROGRESS_POLL_SECONDS = float(os.environ.get("PROGRESS_POLL_SECONDS", "0.25"))
+PROGRESS_KEEPALIVE_SECONDS = float(os.environ.get("PROGRESS_KEEPALIVE_SECONDS", "15"))
+# Minimum interval between generation token-count events
+PROGRESS_TOKEN_INTERVAL = float(os.environ.get("PROGRESS_TOKEN_INTERVAL", "0.5"))
+
+_PROGRESS_TERMINAL = ("completed", "failed", "cancelled")
+
+
+class _JobCancelled(Exception):
+    """The client asked to stop the job (DELETE /jobs/{doc_id})."""
+
+
+def _progress_paths(doc_id: str) -> tuple[str, str]:
+    """(event log, cancel marker) for a job."""
+    digest = hashlib.sha256(doc_id.encode("utf-8")).hexdigest()[:32]
+    base = os.path.join(PROGRESS_DIR, digest)
+    return base + ".jsonl", base + ".cancel"
+
+
+class _JobProgress:
+    """Appends stage events of one job to its log; a no-op without doc_id.
+
+    A job started again for the same doc_id (force) replaces the log; the
+    previous run sees that as superseded() and stops at its next check.
+    """
+
+    def __init__(self, doc_id: str):
+        self.doc_id = doc_id
+        self.seq = 0
+        self.started = time.monotonic()
+        self.log_path, self.cancel_path = _progress_paths(doc_id) if doc_id else (None, None)
+        self._lock = threading.Lock()  # speculative checks emit from their own thread
+        self._inode: int | None = None  # of the log this run writes to
+
+    def start(self) -> None:
+        """Begin a fresh log (a new job for a doc_id replaces the previous one's)."""
+        if not self.log_path:
+            return
+        os.makedirs(PROGRESS_DIR, exist_ok=True)
+        _evict_progress()
+        try:
+            os.remove(self.cancel_path)
+        except FileNotFoundError:
+            pass
+        staging = f"{self.log_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        open(staging, "w").close()
+        os.replace(staging, self.log_path)  # new inode: open streams start over
+        self._inode = os.stat(self.log_path).st_ino
+        self.emit("queued")
+
+    def superseded(self) -> bool:
+        """True once another run of this doc_id has started its own log."""
+        if self._inode is None:
+            return False
+        try:
+            return os.stat(self.log_path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def emit(self, event: str, **data) -> None:
+        if not self.log_path or self.superseded():
+            return
+        with self._lock:
+            self.seq += 1
+            line = json_lib.dumps({
+                "seq": self.seq,
+                "event": event,
+                "elapsed": round(time.monotonic() - self.started, 2),
+                **data,
+            }, ensure_ascii=False)
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                _log.warning(f"[progress] doc_id={self.doc_id!r} event {event} not recorded: {e}")
+
+    def resume(self, event: str) -> None:
+        """Continue a log begun by start(), possibly in another worker process."""
+        if not self.log_path:
+            return
+        try:
+            with open(self.log_path, "rb") as f:
+                self.seq = sum(1 for _ in f)
+        except FileNotFoundError:
+            os.makedirs(PROGRESS_DIR, exist_ok=True)
+        self.emit(event)
+        try:
+            self._inode = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            pass
+
+    def check_cancelled(self) -> None:
+        if self.cancel_path and (os.path.exists(self.cancel_path) or self.superseded()):
+            raise _JobCancelled()
+
+
+_NO_PROGRESS = _JobProgress("")
+
+
+def _evict_progress() -> None:
+    """Drop event logs and cancel markers older than PROGRESS_TTL_SECONDS."""
+    try:
+        names = os.listdir(PROGRESS_DIR)
+    except FileNotFoundError:
+        return
+    cutoff = time.time() - PROGRESS_TTL_SECONDS
+    for name in names:
+        path = os.path.join(PROGRESS_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Anthropic clients — long-lived per key, stable prompt prefixes cached
+# ---------------------------------------------------------------------------
+
+# Clients kept per API key (service key plus users' fallback keys). The SDK
+# reads ANTHROPIC_BASE_URL, e.g. to point at scripts/mock_anthropic.py when offline.
+ANTHROPIC_CLIENT_POOL_SIZE = int(os.environ.get("ANTHROPIC_CLIENT_POOL_SIZE", "8"))
+
+_anthropic_clients: dict[str, object] = {}
+_anthropic_lock = threading.Lock()
+_llm_usage = {
+    "calls_total": 0,
+    "input_tokens_total": 0,
+    "cache_creation_input_tokens_total": 0,
+    "cache_read_input_tokens_total": 0,
+    "output_tokens_total": 0,
+    "fix_patches_applied_total": 0,
+    "fix_patches_rejected_total": 0,
+    "fix_candidates_started_total": 0,
+    "fix_candidates_won_total": 0,
+}
+
+
+def _anthropic_client(api_key: str):
+    """Shared client for api_key, so jobs reuse its TLS connections."""
+    import anthropic
+
+    key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    with _anthropic_lock:
+        client = _anthropic_clients.pop(key, None)
+        if client is None:
+            client = anthropic.Anthropic(api_key=api_key)
+            # Least recently used first; dropped clients close when the last job using them ends
+            while len(_anthropic_clients) >= max(1, ANTHROPIC_CLIENT_POOL_SIZE):
+                _anthropic_clients.pop(next(iter(_anthropic_clients)))
+        _anthropic_clients[key] = client
+    return client
+
+
+def _cached_text(text: str) -> dict:
+    """A text block ending a cacheable prompt prefix."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def _fix_prompt(problem_label: str, problem: str, source: str, excerpts: str = "") -> list[dict]:
+    """User content of a fix call, with the source's preamble first as its own cached block.
+
+    The preamble is the same in every fix call of a job (and in every job of a
+    template), so together with the fixed system prompt it is a reusable prefix.
+    """
+    split = source.find("\\begin{document}")
+    if split == -1:
+        return [{"type": "text", "text": f"{problem_label}:\n{problem}\n\nCÓDIGO LATEX:\n{source}"}]
+    tail = f"\n\n{excerpts}" if excerpts else ""
+    return [
+        _cached_text(f"CÓDIGO LATEX — PREÂMBULO:\n{source[:split]}"),
+        {"type": "text", "text": f"CÓDIGO LATEX — DOCUMENTO:\n{source[split:]}\n\n{problem_label}:\n{problem}{tail}"},
+    ]
+
+
+def _record_usage(usage, stage: str) -> dict:
+    counts = {
+        "input_tokens": usage.input_tokens or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "output_tokens": usage.output_tokens or 0,
+    }
+    with _anthropic_lock:
+        _llm_usage["calls_total"] += 1
+        for name, n in counts.items():
+            _llm_usage[name + "_total"] += n
+    _log.info(
+        f"[llm] {stage}: input={counts['input_tokens']} cache_read={counts['cache_read_input_tokens']} "
+        f"cache_write={counts['cache_creation_input_tokens']} output={counts['output_tokens']}"
+    )
+    return counts
+
+
+def _llm_snapshot() -> dict:
+    with _anthropic_lock:
+        return {"clients": len(_anthropic_clients), **_llm_usage}
+
+
+def _stream_text(stream, progress: _JobProgress, stage: str,
+                 on_text: Callable[[str], None] | None = None) -> str:
+    """Consume a Claude message stream, reporting its size as it grows.
+
+    Checks for cancellation between chunks, so a cancelled job stops paying
+    for tokens right away (leaving the with-block closes the connection).
+    on_text, if given, sees every chunk as it arrives.
+    """
+    chars = 0
+    last_emit = time.monotonic()
+    for text in stream.text_stream:
+        chars += len(text)
+        progress.check_cancelled()
+        if on_text:
+            on_text(text)
+        if time.monotonic() - last_emit >= PROGRESS_TOKEN_INTERVAL:
+            # Exact usage only arrives with the final message; ~4 chars per token until then
+            progress.emit(f"{stage}_progress", output_chars=chars, output_tokens_est=chars // 4)
+            last_emit = time.monotonic()
+    message = stream.get_final_message()
+    progress.emit(f"{stage}_done", output_chars=chars, **_record_usage(message.usage, stage))
+    return stream.get_final_text()
+
+
+def _timed_compile(progress: _JobProgress, attempt: int, stage: str,
+                   latex_source: str, images: list[ImagePayload] | None) -> CompileResponse:
+    progress.check_cancelled()
+    with _gen_compile_slots:
+        progress.emit("compile_started", attempt=attempt, stage=stage)
+        started = time.monotonic()
+        result = _compile_in_tmpdir(latex_source, images)
+    progress.emit(
+        "compile_finished",
+        attempt=attempt,
+        stage=stage,
+        success=bool(result.success and result.pdf_base64),
+        seconds=round(time.monotonic() - started, 2),
+        error=(result.error or "")[:500] or None,
+        warnings=len(result.warnings or []),
+    )
+    return result
+
+
+async def _tail_progress(request: Request, log_path: str, after: int):
+    """Yield SSE frames for events with seq > after until the job ends."""
+    inode = None
+    offset = 0
+    pending = b""
+    last_sent = time.monotonic()
+    while True:
+        try:
+            st = os.stat(log_path)
+        except FileNotFoundError:
+            yield "event: failed\ndata: {\"error\": \"job log expired\"}\n\n"
+            return
+        if st.st_ino != inode:
+            # A new job replaced the log; its seq numbers restart at 1
+            inode, offset, pending, after = st.st_ino, 0, b"", 0 if inode is not None else after
+        if st.st_size > offset:
+            with open(log_path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+            offset += len(chunk)
+            *lines, pending = (pending + chunk).split(b"\n")
+            for raw in lines:
+                try:
+                    event = json_lib.loads(raw)
+                except ValueError:
+                    continue
+                if event["seq"] > after:
+                    after = event["seq"]
+                    yield f"id: {event['seq']}\nevent: {event['event']}\ndata: {raw.decode('utf-8')}\n\n"
+                    last_sent = time.monotonic()
+                if event["event"] in _PROGRESS_TERMINAL:
+                    return
+        if await request.is_disconnected():
+            return
+        if time.monotonic() - last_sent >= PROGRESS_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(PROGRESS_POLL_SECONDS)
+
+
+# ---------------------------------------------------------------------------
+# Local fix rules — deterministic rewrites for well-known pdflatex errors
+# ---------------------------------------------------------------------------
+
+# Rules run on a failed compile before Claude is asked; each matches an error
+# signature in the formatted log errors and rewrites the document body. Same
+# knowledge as _sanitize_latex and apps/api/src/lib/latex/sanitizer.ts, but
+# applied only when the log shows the construct actually broke the build.
+LOCAL_FIX = os.environ.get("LOCAL_FIX", "1") != "0"
+LOCAL_FIX_MAX_ROUNDS = int(os.environ.get("LOCAL_FIX_MAX_ROUNDS", "3"))
+
+# Characters outside utf8.def that models like to emit; anything else reported
+# as "not set up for use with LaTeX" is dropped
+_UNICODE_REPLACEMENTS = {
+    "\u2192": r"\ensuremath{\rightarrow}",
+    "\u2190": r"\ensuremath{\leftarrow}",
+    "\u2194": r"\ensuremath{\leftrightarrow}",
+    "\u21d2": r"\ensuremath{\Rightarrow}",
+    "\u2264": r"\ensuremath{\leq}",
+    "\u2265": r"\ensuremath{\geq}",
+    "\u2260": r"\ensuremath{\neq}",
+    "\u2248": r"\ensuremath{\approx}",
+    "\u2212": "-",
+    "\u2022": r"\textbullet{}",
+    "\u2026": r"\ldots{}",
+    "\u200b": "",
+}
+_TCOLORBOX_ENVS = ("infobox", "alertbox", "successbox", "sessaobox", "datacard", "atividadebox", "dicabox", "materialbox")
+_X_COLUMN = re.compile(r"(?<![A-Za-z\\])X(?![A-Za-z])")
+_P_COLUMN = re.compile(r"(?<![A-Za-z\\])p\{\s*([\d.]*)\s*(?:(in|cm|mm|pt|bp)\b|\\(\w+))\s*\}")
+
+_ERROR_ENTRY_LINE = re.compile(r"ERRO na linha (\d+):")
+
+_local_fix_lock = threading.Lock()
+_local_fix_counts = {"failures_total": 0, "unmatched_total": 0}
+
+
+def _reported_line(m: re.Match) -> int | None:
+    """Line of the _format_latex_errors entry the signature match m falls in."""
+    entry = m.string.rfind("ERRO", 0, m.start() + 1)
+    line = _ERROR_ENTRY_LINE.match(m.string, entry) if entry != -1 else None
+    return int(line.group(1)) if line else None
+
+
+def _env_spans(body: str, env_pattern: str) -> list[tuple[int, int]]:
+    """(start, end) of every \\begin{env}...\\end{env} matching env_pattern, nested ones included."""
+    spans: list[tuple[int, int]] = []
+    opened: list[int] = []
+    for env in re.finditer(r"\\(begin|end)\{(" + env_pattern + r")\}", body):
+        if env.group(1) == "begin":
+            opened.append(env.start())
+        elif opened:
+            spans.append((opened.pop(), env.end()))
+    return spans
+
+
+def _span_at_line(body: str, spans: list[tuple[int, int]], line: int | None) -> tuple[int, int] | None:
+    """The innermost span on body line `line` (1-based), else the closest one ending before it.
+
+    TeX reports an error at or after the construct that caused it (a box only
+    typesets its content at its \\end), never before.
+    """
+    lines = body.split("\n")
+    if line is None or not 1 <= line <= len(lines):
+        return None
+    start = sum(len(text) + 1 for text in lines[:line - 1])
+    end = start + len(lines[line - 1])
+    on_line = [span for span in spans if span[0] <= end and span[1] >= start]
+    if on_line:
+        return max(on_line)
+    before = [span for span in spans if span[1] <= start]
+    return max(before, key=lambda span: span[1]) if before else None
+
+
+def _replace_colspecs(body: str, env_pattern: str, fix: Callable[[str], str], at: int | None = None) -> str:
+    """Apply fix to the column spec of every \\begin{env} matching env_pattern.
+
+    env_pattern may name tabularx/tabular*, whose width argument is skipped.
+    With at, only the environment beginning at that offset is touched.
+    """
+    out = []
+    pos = 0
+    for m in re.finditer(r"\\begin\{(" + env_pattern + r")\}(?:\[[^\]]*\])?\s*", body):
+        if m.start() < pos or (at is not None and m.start() != at):
+            continue
+        start = m.end()
+        if m.group(1) in ("tabularx", "tabular*"):
+            _, start = _extract_brace_arg(body, start)
+            while start < len(body) and body[start].isspace():
+                start += 1
+        colspec, end = _extract_brace_arg(body, start)
+        if end == start:
+            continue
+        out.append(body[pos:start] + "{" + fix(colspec) + "}")
+        pos = end
+    out.append(body[pos:])
+    return "".join(out)
+
+
+def _rule_x_columns(body: str, m: re.Match, line: int | None) -> str:
+    """X is a tabularx column type; in the longtable/tabular at the error it becomes p{4cm}."""
+    span = _span_at_line(body, _env_spans(body, r"longtable|tabular"), line)
+    if span is None:
+        return body
+    return _replace_colspecs(body, r"longtable|tabular", lambda spec: _X_COLUMN.sub("p{4cm}", spec), at=span[0])
+
+
+def _rule_tabularx_without_x(body: str, m: re.Match, line: int | None) -> str:
+    """tabularx needs an X column: in the table at the error, the widest p{} column becomes X."""
+    def fix(spec: str) -> str:
+        bare = re.sub(r"[|\s]", "", re.sub(r"\{[^}]*\}", "", re.sub(r"[><!@]\{[^}]*\}", "", spec)))
+        widths = [(_dimension_inches(p.group(1), p.group(2), p.group(3)) or 0, p) for p in _P_COLUMN.finditer(spec)]
+        if "X" in bare or not widths:
+            return spec
+        _, widest = max(widths, key=lambda w: w[0])
+        return spec[:widest.start()] + "X" + spec[widest.end():]
+    span = _span_at_line(body, _env_spans(body, r"tabularx"), line)
+    if span is None:
+        return body
+    return _replace_colspecs(body, r"tabularx", fix, at=span[0])
+
+
+def _rule_misplaced_rowcolor(body: str, m: re.Match, line: int | None) -> str:
+    """\\rowcolor must open a row; in the table at the error, one after a cell turns into \\cellcolor.
+
+    Every cell of that row gets the color. A stray \\hline gives the same
+    error; with no misplaced \\rowcolor the body is left alone.
+    """
+    span = _span_at_line(body, _env_spans(body, r"longtable|tabularx|tabular\*?"), line)
+    if span is None:
+        return body
+    start, end = span
+    lines = body[start:end].split("\n")
+    for i, text in enumerate(lines):
+        color = re.search(r"\\rowcolor(?:\[[^\]]*\])?\{([^}]+)\}", text)
+        # Only after a cell of the same row: "\rowcolor{x} A & B \\" is fine
+        if not color or "&" not in text[:color.start()].rsplit("\\\\", 1)[-1]:
+            continue
+        cleaned = re.sub(r"\\rowcolor(?:\[[^\]]*\])?\{[^}]*\}\s*", "", text)
+        cells = []
+        for cell in cleaned.split("&"):
+            stripped = cell.lstrip()
+            if stripped and stripped != "\\\\" and "\\cellcolor" not in cell:
+                cell = cell[:len(cell) - len(stripped)] + f"\\cellcolor{{{color.group(1)}}}" + stripped
+            cells.append(cell)
+        lines[i] = "&".join(cells)
+    return body[:start] + "\n".join(lines) + body[end:]
+
+
+def _rule_multirowcell(body: str, m: re.Match, line: int | None) -> str:
+    """\\multirowcell is not loaded; \\multirow{N}{*}{...} does the same."""
+    return re.sub(r"\\multirowcell\{(\d+)\}(?:\[[^\]]*\])*\{", r"\\multirow{\1}{*}{", body)
+
+
+def _rule_longtable_in_group(body: str, m: re.Match, line: int | None) -> str:
+    """longtable cannot sit inside a box or group: the nested one at the error becomes tabular.
+
+    Head/foot markers are dropped, the rows they close are kept.
+    """
+    stack: list[str] = []
+    nested: list[tuple[int, int]] = []  # spans of \begin{longtable}...\end{longtable}
+    opened: list[int] = []
+    for env in re.finditer(r"\\(begin|end)\{([^}]+)\}", body):
+        name = env.group(2)
+        if env.group(1) == "begin":
+            if name == "longtable" and any(e != "document" for e in stack):
+                opened.append(env.start())
+            stack.append(name)
+        else:
+            if name == "longtable" and opened and stack and stack[-1] == "longtable":
+                nested.append((opened.pop(), env.end()))
+            if stack and stack[-1] == name:
+                stack.pop()
+    span = _span_at_line(body, nested, line)
+    if span is None:
+        return body
+    start, end = span
+    table = body[start:end]
+    table = table.replace("\\begin{longtable}", "\\begin{tabular}", 1)
+    table = table[: table.rfind("\\end{longtable}")] + "\\end{tabular}"
+    table = re.sub(r"\\(?:endhead|endfirsthead|endfoot|endlastfoot)\b[ \t]*", "", table)
+    return body[:start] + table + body[end:]
+
+
+def _rule_unicode(body: str, m: re.Match, line: int | None) -> str:
+    """Characters pdflatex has no glyph for get a LaTeX equivalent or are dropped."""
+    for code in set(re.findall(r"\(U\+([0-9A-Fa-f]{4,6})\)", m.string)):
+        char = chr(int(code, 16))
+        body = body.replace(char, _UNICODE_REPLACEMENTS.get(char, ""))
+    return body
+
+
+# (name, error signature, rewrite); applied in this order. A rewrite gets the
+# body, the signature match and the body line of the error entry it matched.
+_LOCAL_FIX_RULES: list[tuple[str, re.Pattern, Callable[[str, re.Match, int | None], str]]] = [
+    ("unicode_char", re.compile(r"Unicode character .*\(U\+[0-9A-Fa-f]{4,6}\)"), _rule_unicode),
+    ("multirowcell", re.compile(r"\\multirowcell"), _rule_multirowcell),
+    ("misplaced_rowcolor", re.compile(r"Misplaced \\noalign"), _rule_misplaced_rowcolor),
+    ("longtable_in_group", re.compile(r"longtable not in 1-column mode"), _rule_longtable_in_group),
+    ("x_column_outside_tabularx", re.compile(r"Illegal pream-token \(X\)"), _rule_x_columns),
+    ("tabularx_without_x", re.compile(r"Package tabularx \w+: X [Cc]olumns"), _rule_tabularx_without_x),
+]
+
+_local_fix_stats: dict[str, dict[str, int]] = {name: {"applied": 0, "fixed": 0} for name, _, _ in _LOCAL_FIX_RULES}
+
+
+def _apply_local_fixes(source: str, error: str, record: bool = True) -> tuple[str, list[str]]:
+    """Run the rules whose signature matches error over the body of source.
+
+    Returns the rewritten source and the names of the rules that changed it;
+    record=False leaves the hit-rate counters alone.
+    """
+    split = source.find("\\begin{document}")
+    if split == -1:
+        return source, []
+    body = source[split:]
+    # Error lines count from the top of the document, rule lines from \begin{document}
+    preamble_lines = source.count("\n", 0, split)
+    applied = []
+    for name, signature, rewrite in _LOCAL_FIX_RULES:
+        m = signature.search(error)
+        if not m:
+            continue
+        line = _reported_line(m)
+        rewritten = rewrite(body, m, line - preamble_lines if line else None)
+        if rewritten != body:
+            body = rewritten
+            applied.append(name)
+    if not record:
+        return source[:split] + body, applied
+    with _local_fix_lock:
+        _local_fix_counts["failures_total"] += 1
+        if not applied:
+            _local_fix_counts["unmatched_total"] += 1
+        for name in applied:
+            _local_fix_stats[name]["applied"] += 1
+    return source[:split] + body, applied
+
+
+def _compile_with_local_fixes(progress: _JobProgress, attempt: int, latex_source: str,
+                              images: list[ImagePayload] | None) -> tuple[CompileResponse, str]:
+    """Compile; while TeX fails on an error a local rule knows, rewrite and recompile.
+
+    Returns the last result and the source it was compiled from. A rule counts
+    as having fixed its error when the recompile no longer shows its signature.
+    """
+    result = _timed_compile(progress, attempt, "compile", latex_source, images)
+    for _ in range(LOCAL_FIX_MAX_ROUNDS if LOCAL_FIX else 0):
+        if result.success or result.error_code != "tex_error":
+            break
+        fixed, applied = _apply_local_fixes(latex_source, result.error or "")
+        if not applied:
+            break
+        _log.info(f"[local-fix] attempt {attempt}: applied {', '.join(applied)}")
+        progress.emit("local_fix_applied", attempt=attempt, rules=applied)
+        result = _timed_compile(progress, attempt, "local_fix", fixed, images)
+        latex_source = fixed
+        with _local_fix_lock:
+            for name, signature, _ in _LOCAL_FIX_RULES:
+                if name in applied and (result.success or not signature.search(result.error or "")):
+                    _local_fix_stats[name]["fixed"] += 1
+    return result, latex_source
+
+
+def _local_fix_snapshot() -> dict:
+    with _local_fix_lock:
+        return {
+            "enabled": LOCAL_FIX,
+            **_local_fix_counts,
+            "rules": {name: dict(counts) for name, counts in _local_fix_stats.items()},
+        }
+
+
+# ---------------------------------------------------------------------------
+# Patch-based fixes — Claude returns search/replace hunks, not the whole body
+# ---------------------------------------------------------------------------
+
+# "patch" asks for hunks first and regenerates the body only if they do not
+# apply; "full" always regenerates the body (the previous behaviour)
+AUTOFIX_MODE = os.environ.get("AUTOFIX_MODE", "patch")
+AUTOFIX_PATCH_MAX_TOKENS = int(os.environ.get("AUTOFIX_PATCH_MAX_TOKENS", "4000"))
+# Source lines shown around each line the log points at
+AUTOFIX_EXCERPT_CONTEXT = 3
+AUTOFIX_MAX_EXCERPTS = 8
+
+_PATCH_FORMAT = """Responda SOMENTE com edições pontuais — NÃO reescreva o documento. Cada edição é um bloco:
+
+<<<<<<< BUSCAR
+linhas copiadas EXATAMENTE do documento (sem os números de linha), o suficiente para serem únicas
+=======
+linhas que as substituem
+>>>>>>> SUBSTITUIR
+
+Use quantos blocos forem necessários, na ordem em que aparecem no documento. NÃO edite o preâmbulo nem \\begin{document}/\\end{document}. Sem explicações, sem fence blocks."""
+
+# Same rules as the full-document prompts, only the answer format differs
+AUTOFIX_PATCH_SYSTEM = AUTOFIX_SYSTEM.rsplit("\n\n", 1)[0] + "\n\n" + _PATCH_FORMAT
+AUTOFIX_WARNINGS_PATCH_SYSTEM = AUTOFIX_WARNINGS_SYSTEM.rsplit("\n\n", 1)[0] + "\n\n" + _PATCH_FORMAT
+
+_FIX_HUNK = re.compile(
+    r"^<{5,}\s*BUSCAR[^\n]*\n(.*?)^={5,}[^\n]*\n(.*?)^>{5,}\s*SUBSTITUIR[^\n]*$",
+    re.DOTALL | re.MULTILINE,
+)
+_EXCERPT_LINE_NUMBER = re.compile(r"^\s*\d+\| ?")
+
+
+class _PatchRejected(Exception):
+    pass
+
+
+def _diagnostic_excerpts(source: str, diagnostics: list[LogDiagnostic] | None,
+                         severities: tuple[str, ...]) -> str:
+    """Numbered body lines around the lines the log reports, for the patch prompt."""
+    lines = source.split("\n")
+    body_start = source.count("\n", 0, max(0, source.find("\\begin{document}"))) + 1
+    ranges: list[list[int]] = []
+    for diag in diagnostics or []:
+        if diag.severity not in severities or not diag.line:
+            continue
+        if diag.file and os.path.basename(diag.file) != "document.tex":
+            continue
+        lo = max(body_start, diag.line - AUTOFIX_EXCERPT_CONTEXT)
+        hi = min(len(lines), diag.line + AUTOFIX_EXCERPT_CONTEXT)
+        if lo <= hi:
+            ranges.append([lo, hi])
+    if not ranges:
+        return ""
+    ranges.sort()
+    merged = [ranges[0]]
+    for lo, hi in ranges[1:]:
+        if lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    chunks = [
+        "\n".join(f"{n:5d}| {lines[n - 1]}" for n in range(lo, hi + 1))
+        for lo, hi in merged[:AUTOFIX_MAX_EXCERPTS]
+    ]
+    return "TRECHOS APONTADOS NO LOG (número da linha | código):\n" + "\n  ...\n".join(chunks)
+
+
+def _locate_hunk(body: str, search: str) -> tuple[int, int]:
+    """(start, end) of the single occurrence of search in body.
+
+    Falls back to a line-wise match that ignores indentation, trailing spaces
+    and copied excerpt line numbers; raises _PatchRejected when search is
+    missing or ambiguous.
+    """
+    count = body.count(search)
+    if count == 1:
+        start = body.find(search)
+        return start, start + len(search)
+    if count > 1:
+        raise _PatchRejected("ambiguous search block")
+
+    wanted = [_EXCERPT_LINE_NUMBER.sub("", line).strip() for line in search.split("\n")]
+    while wanted and not wanted[-1]:
+        wanted.pop()
+    if not wanted:
+        raise _PatchRejected("empty search block")
+    body_lines = body.split("\n")
+    stripped = [line.strip() for line in body_lines]
+    matches = [
+        i for i in range(len(stripped) - len(wanted) + 1)
+        if stripped[i:i + len(wanted)] == wanted
+    ]
+    if len(matches) != 1:
+        raise _PatchRejected("ambiguous search block" if matches else "search block not found")
+    first = matches[0]
+    start = sum(len(line) + 1 for line in body_lines[:first])
+    end = start + sum(len(line) + 1 for line in body_lines[first:first + len(wanted)]) - 1
+    return start, end
+
+
+def _apply_fix_hunks(body: str, reply: str) -> tuple[str, int]:
+    """Apply the search/replace hunks in reply to body; returns (new body, hunks applied).
+
+    Hunks are applied in order, each against the result of the previous ones.
+    Raises _PatchRejected if any hunk does not apply or the result is unusable.
+    """
+    hunks = _FIX_HUNK.findall(reply)
+    if not hunks:
+        raise _PatchRejected("no hunks in reply")
+    patched = body
+    for search, replace in hunks:
+        search = search[:-1] if search.endswith("\n") else search
+        replace = replace[:-1] if replace.endswith("\n") else replace
+        if not search.strip():
+            raise _PatchRejected("empty search block")
+        start, end = _locate_hunk(patched, search)
+        patched = patched[:start] + replace + patched[end:]
+    if patched == body:
+        raise _PatchRejected("hunks change nothing")
+    if (not patched.lstrip().startswith("\\begin{document}")
+            or patched.count("\\end{document}") != 1):
+        raise _PatchRejected("document markers edited")
+    return patched, len(hunks)
+
+
+def _request_patch(client, model: str, req: GenerateAndCompileRequest, progress: _JobProgress,
+                   stage: str, problem_label: str, problem: str, source: str,
+                   diagnostics: list[LogDiagnostic] | None, temperature: float = 0.2) -> str | None:
+    """Ask Claude for hunks fixing source; None when the reply was cut off at max_tokens."""
+    warn_fix = stage == "warn_fix"
+    excerpts = _diagnostic_excerpts(source, diagnostics, ("warning", "badbox") if warn_fix else ("error",))
+    with _llm_slots, client.messages.stream(
+        model=model,
+        max_tokens=min(req.max_tokens, AUTOFIX_PATCH_MAX_TOKENS),
+        temperature=temperature,
+        system=[_cached_text(AUTOFIX_WARNINGS_PATCH_SYSTEM if warn_fix else AUTOFIX_PATCH_SYSTEM)],
+        messages=[{"role": "user", "content": _fix_prompt(problem_label, problem, source, excerpts)}],
+    ) as stream:
+        reply = _stream_text(stream, progress, stage)
+        truncated = stream.get_final_message().stop_reason == "max_tokens"
+    return None if truncated else reply
+
+
+def _record_patch(applied: bool) -> None:
+    with _anthropic_lock:
+        _llm_usage["fix_patches_applied_total" if applied else "fix_patches_rejected_total"] += 1
+
+
+def _request_fix(client, model: str, req: GenerateAndCompileRequest, progress: _JobProgress,
+                 stage: str, problem_label: str, problem: str, source: str,
+                 diagnostics: list[LogDiagnostic] | None, mode: str | None = None,
+                 temperature: float = 0.2) -> str:
+    """Ask Claude to fix source; returns the new source with the preamble kept.
+
+    stage is "auto_fix" (compile errors) or "warn_fix" (warnings). In patch
+    mode (mode, else AUTOFIX_MODE) Claude answers with hunks for the body, a
+    fraction of the output tokens of a full body; if they do not apply
+    cleanly the full body is requested as before.
+    """
+    warn_fix = stage == "warn_fix"
+    tag = stage.replace("_", "-")
+    preamble_end = source.find("\\begin{document}")
+    preamble = source[:preamble_end] if preamble_end != -1 else req.preamble
+    full_stage = stage
+
+    if (mode or AUTOFIX_MODE) == "patch" and preamble_end != -1:
+        reply = _request_patch(client, model, req, progress, stage, problem_label, problem, source,
+                               diagnostics, temperature)
+        try:
+            if reply is None:
+                raise _PatchRejected("reply hit max_tokens")
+            patched, hunks = _apply_fix_hunks(source[preamble_end:], reply)
+        except _PatchRejected as e:
+            _record_patch(False)
+            _log.info(f"[{tag}] doc_id={req.doc_id!r} patch rejected ({e}) — requesting full body")
+            progress.emit(f"{stage}_patch_rejected", reason=str(e))
+            full_stage = f"{stage}_full"
+        else:
+            _record_patch(True)
+            _log.info(f"[{tag}] doc_id={req.doc_id!r} applied {hunks} hunk(s)")
+            progress.emit(f"{stage}_patch_applied", hunks=hunks)
+            return preamble + _sanitize_latex(patched)
+
+    with _llm_slots, client.messages.stream(
+        model=model,
+        max_tokens=req.max_tokens,
+        temperature=temperature,
+        system=[_cached_text(AUTOFIX_WARNINGS_SYSTEM if warn_fix else AUTOFIX_SYSTEM)],
+        messages=[{"role": "user", "content": _fix_prompt(problem_label, problem, source)}],
+    ) as stream:
+        fix_text = _stream_text(stream, progress, full_stage)
+    fixed_body = _sanitize_latex(_extract_latex_body(fix_text))
+    _log.info(f"[{tag}] doc_id={req.doc_id!r} Claude returned full body ({len(fixed_body)} chars)")
+    return preamble + fixed_body
+
+
+# ---------------------------------------------------------------------------
+# Speculative compilation — check prefixes of the body while Claude streams it
+# ---------------------------------------------------------------------------
+
+# While the body streams in, its prefix up to the last safe boundary (before a
+# \section, or after a top-level environment closes) is closed with
+# \end{document} and checked with a single draftmode pass against the same
+# preamble. The first failing prefix starts the fix early: local rules are
+# remembered and, in patch mode, Claude is asked for hunks while generation
+# continues; both are applied to the full body before its first compile.
+SPECULATIVE_COMPILE = os.environ.get("SPECULATIVE_COMPILE", "1") != "0"
+# New body text needed before another check (a \section boundary always qualifies)
+SPECULATIVE_MIN_CHARS = int(os.environ.get("SPECULATIVE_MIN_CHARS", "2000"))
+SPECULATIVE_TIMEOUT = int(os.environ.get("SPECULATIVE_TIMEOUT", "20"))
+
+_TOP_LEVEL_SECTION = re.compile(r"^[ \t]*\\(?:section|chapter)\*?\s*[\[{]")
+_ENV_TOKEN = re.compile(r"\\(begin|end)\{([^}]+)\}")
+_UNESCAPED_PERCENT = re.compile(r"(?<!\\)%.*")
+
+
+class _BodyBoundaries:
+    """Safe cut points of a document body, fed one line at a time.
+
+    feed() tells whether the body can be cut just before the line (it starts a
+    top-level \\section) and just after it (it closes a top-level environment).
+    """
+
+    def __init__(self):
+        self._envs: list[str] = []
+        self._braces = 0
+
+    def feed(self, line: str) -> tuple[bool, bool]:
+        before = not self._envs and self._braces == 0 and bool(_TOP_LEVEL_SECTION.match(line))
+        code = _UNESCAPED_PERCENT.sub("", line)
+        self._braces += code.count("{") - code.count("\\{") - code.count("}") + code.count("\\}")
+        opened = bool(self._envs)
+        for m in _ENV_TOKEN.finditer(code):
+            if m.group(2) == "document":
+                continue
+            if m.group(1) == "begin":
+                self._envs.append(m.group(2))
+            elif m.group(2) in self._envs:
+                del self._envs[len(self._envs) - 1 - self._envs[::-1].index(m.group(2)):]
+        return before, opened and not self._envs and self._braces == 0
+
+
+def _draft_check(latex_source: str) -> CompileResponse:
+    """One draftmode pass over latex_source: errors and diagnostics, no PDF.
+
+    Images are left out; the templates' draft graphicx only needs their names.
+    """
+    tmpdir = _acquire_workdir("spec_")
+    try:
+        with open(os.path.join(tmpdir, "document.tex"), "w", encoding="utf-8") as f:
+            f.write(latex_source)
+        fmt = _prepare_format(tmpdir, "document.tex", latex_source)
+        cmd = _pdflatex_cmd(tmpdir, "document.tex", fmt, draftmode=True)
+        result = _run_job(cmd, tmpdir, SPECULATIVE_TIMEOUT)
+        if fmt and result.returncode != 0 and _is_format_load_error(
+                result.stdout.decode("utf-8", errors="replace") if result.stdout else ""):
+            result = _run_job(_pdflatex_cmd(tmpdir, "document.tex", None, draftmode=True), tmpdir, SPECULATIVE_TIMEOUT)
+        scan = _scan_log(os.path.join(tmpdir, "document.log"))
+        diagnostics = (scan.diagnostics() if scan else None) or None
+        if result.returncode != 0:
+            return CompileResponse(success=False, error=_format_latex_errors(scan)[:3000] or None, passes=1,
+                                   diagnostics=diagnostics, error_code=_tex_error_code(scan))
+        return CompileResponse(success=True, passes=1, diagnostics=diagnostics)
+    except subprocess.TimeoutExpired:
+        return CompileResponse(success=False, error="Speculative check timed out", error_code="timeout")
+    except _JobLimitExceeded as e:
+        return CompileResponse(success=False, error=str(e), error_code=e.code)
+    finally:
+        _release_workdir(tmpdir)
+
+
+class _Speculation:
+    """Speculative checks of one generation stream; feed() gets its text chunks."""
+
+    def __init__(self, req: GenerateAndCompileRequest, progress: _JobProgress, client, model: str):
+        self.req = req
+        self.progress = progress
+        self.client = client
+        self.model = model
+        self.failure: tuple[str, CompileResponse] | None = None  # (prefix source, result)
+        self.hunks: str | None = None
+        self.checks = 0
+        self._partial = ""
+        self._lines: list[str] = []
+        self._in_body = False
+        self._boundaries = _BodyBoundaries()
+        self._boundary = 0  # lines in the longest safe prefix
+        self._section_boundary = False
+        self._checked = 0
+        self._checked_chars = 0
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._abort = threading.Event()  # kills a check still running when finish() is called
+
+    def feed(self, text: str) -> None:
+        if self._stopped or self.failure:
+            return
+        *complete, self._partial = (self._partial + text).split("\n")
+        for line in complete:
+            self._take_line(line)
+        if complete:
+            self._maybe_check()
+
+    def _take_line(self, line: str) -> None:
+        if not self._in_body:
+            # Whatever precedes the body (fences, a stray preamble) is not checked
+            if "\\begin{document}" not in line:
+                return
+            self._in_body = True
+            line = line[line.find("\\begin{document}"):]
+        elif line.lstrip().startswith("```"):
+            return
+        before, after = self._boundaries.feed(line)
+        if before and self._lines:
+            self._boundary = len(self._lines)
+            self._section_boundary = True
+        self._lines.append(line)
+        if after:
+            self._boundary = len(self._lines)
+
+    def _maybe_check(self) -> None:
+        with self._lock:
+            if self._stopped or self._thread is not None or self._boundary <= self._checked:
+                return
+            prefix_chars = sum(len(line) + 1 for line in self._lines[:self._boundary])
+            if not self._section_boundary and prefix_chars - self._checked_chars < SPECULATIVE_MIN_CHARS:
+                return
+            # Only on spare capacity: a speculative check never delays a real compile,
+            # and it counts against the generate jobs' compile budget (released in _run)
+            if _pool_active >= COMPILE_CONCURRENCY or not _gen_compile_slots.acquire(blocking=False):
+                return
+            self._checked, self._checked_chars = self._boundary, prefix_chars
+            self._section_boundary = False
+            prefix = "\n".join(self._lines[:self._boundary])
+            self._thread = threading.Thread(target=self._run, args=(prefix,), daemon=True)
+            self._thread.start()
+
+    def _run(self, prefix: str) -> None:
+        source = _sanitize_latex(self.req.preamble + prefix + "\n\\end{document}\n")
+        try:
+            started = time.monotonic()
+            try:
+                with _abort_jobs_on(self._abort):
+                    result = _pooled(_draft_check, source, reject_when_full=False)
+            finally:
+                _gen_compile_slots.release()
+            self.checks += 1
+            self.progress.emit(
+                "speculative_check",
+                body_chars=len(prefix),
+                success=result.success,
+                seconds=round(time.monotonic() - started, 2),
+                error=(result.error or "")[:500] or None,
+            )
+            if result.success or result.error_code != "tex_error":
+                return
+            self.failure = (source, result)
+            _log.info(f"[speculate] doc_id={self.req.doc_id!r} prefix of {len(prefix)} chars fails: "
+                      f"{(result.error or '')[:200]}")
+            _, rules = _apply_local_fixes(source, result.error or "", record=False)
+            if not rules and AUTOFIX_MODE == "patch" and not self._stopped:
+                # Generation is still running: ask for the fix now, apply it to the full body later
+                self.hunks = _request_patch(
+                    self.client, self.model, self.req, self.progress, "early_fix",
+                    "ERRO DE COMPILAÇÃO", result.error or "", source, result.diagnostics,
+                )
+        except _CompileCancelled:
+            pass  # finish() came first; the real compile takes over
+        except Exception as e:
+            _log.warning(f"[speculate] doc_id={self.req.doc_id!r} check abandoned: {e}")
+        finally:
+            with self._lock:
+                self._thread = None
+            if not self.failure:
+                self._maybe_check()
+
+    def finish(self) -> tuple[str, CompileResponse] | None:
+        """Stop checking; wait for an early fix in flight. Returns the failure, if any.
+
+        A check still compiling is killed, so its pdflatex and compile slot are
+        free before the real compile starts.
+        """
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+            if not self.failure:
+                self._abort.set()
+        if thread is not None:
+            thread.join()
+        return self.failure
+
+    def apply(self, latex_source: str) -> str:
+        """latex_source with the early fix of the failing prefix applied, if it applies."""
+        if self.failure is None:
+            return latex_source
+        _, result = self.failure
+        fixed, rules = _apply_local_fixes(latex_source, result.error or "")
+        if rules:
+            _log.info(f"[speculate] doc_id={self.req.doc_id!r} applied local rules {', '.join(rules)} before compiling")
+            self.progress.emit("early_fix_applied", kind="local", rules=rules)
+            return fixed
+        split = latex_source.find("\\begin{document}")
+        if not self.hunks or split == -1:
+            return latex_source
+        try:
+            patched, hunks = _apply_fix_hunks(latex_source[split:], self.hunks)
+        except _PatchRejected as e:
+            _record_patch(False)
+            self.progress.emit("early_fix_rejected", reason=str(e))
+            return latex_source
+        _record_patch(True)
+        _log.info(f"[speculate] doc_id={self.req.doc_id!r} applied {hunks} early hunk(s) before compiling")
+        self.progress.emit("early_fix_applied", kind="patch", hunks=hunks)
+        return latex_source[:split] + _sanitize_latex(patched)
 
-        for _ in range(2):
-            result = subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode", "-halt-on-error",
-                 "-output-directory", tmpdir, tex_path],
-                capture_output=True, timeout=60, cwd=tmpdir,
-            )
-            if result.returncode != 0:
-                log_path = os.path.join(tmpdir, "document.log")
-                stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
-                stderr = result.stderr.decode("utf-8", errors="replace") if result.stderr else ""
-                error_log = ""
-                if os.path.exists(log_path):
-                    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                        lines = f.readlines()
-                    error_lines = []
-                    capture = False
-                    for line in lines:
-                        if line.startswith("!") or capture:
-                            error_lines.append(line.rstrip())
-                            capture = True
-                            if len(error_lines) > 5:
-                                capture = False
-                        if len(error_lines) > 30:
-                            break
-                    error_log = "\n".join(error_lines) if error_lines else stdout[-2000:]
-                else:
-                    error_log = stdout[-2000:] if stdout else stderr[-2000:]
-                return CompileResponse(success=False, error=error_log[:3000])
 
-        if not os.path.exists(pdf_path):
-            return CompileResponse(success=False, error="PDF not generated")
+# ---------------------------------------------------------------------------
+# Error isolation — find the smallest failing fragment before asking for a fix
+# ---------------------------------------------------------------------------
 
-        log_path = os.path.join(tmpdir, "document.log")
-        warnings = _extract_warnings(log_path) or None
-        with open(pdf_path, "rb") as f:
-            pdf_bytes = f.read()
+# pdflatex often reports an error where a frame or tcolorbox ends, far from its
+# cause. The body is cut at safe boundaries into pieces that are checked alone
+# (draftmode, same preamble and format) in parallel; the first failing piece is
+# halved until a single top-level chunk is left. The fixer then gets that
+# fragment and its own error instead of the whole document.
+ISOLATE_ERRORS = os.environ.get("ISOLATE_ERRORS", "1") != "0"
+ISOLATE_MAX_PIECES = int(os.environ.get("ISOLATE_MAX_PIECES", "8"))
+# Parallel checks per job
+ISOLATE_CONCURRENCY = int(os.environ.get("ISOLATE_CONCURRENCY", "4"))
+# Checks in flight across all jobs of the worker, each holding a compile pool
+# slot. Its own budget: under GENERATE_COMPILE_CONCURRENCY (1 by default) the
+# pieces would run one at a time. Half the pool by default, so /compile keeps
+# its share.
+ISOLATE_PARALLELISM = int(os.environ.get("ISOLATE_PARALLELISM", "0")) or max(1, COMPILE_CONCURRENCY // 2)
+
+_isolate_slots = threading.BoundedSemaphore(ISOLATE_PARALLELISM)
+
+
+class _ErrorFragment:
+    """Lines [start, end) of a document that fail on their own, as a standalone source."""
+
+    def __init__(self, lines: list[str], start: int, end: int, preamble: str, result: CompileResponse):
+        self.start = start
+        self.end = end
+        self.source = _fragment_source(preamble, lines, start, end)
+        self.result = result
+
+    def splice(self, latex_source: str, fixed_fragment: str) -> str:
+        """latex_source with this fragment replaced by the body of fixed_fragment."""
+        begin = fixed_fragment.find("\\begin{document}")
+        finish = fixed_fragment.rfind("\\end{document}")
+        if begin == -1 or finish <= begin:
+            return latex_source
+        body = fixed_fragment[begin + len("\\begin{document}"):finish]
+        body = body[1:] if body.startswith("\n") else body
+        body = body[:-1] if body.endswith("\n") else body
+        lines = latex_source.split("\n")
+        return "\n".join(lines[:self.start] + [body] + lines[self.end:])
+
+
+def _fragment_source(preamble: str, lines: list[str], start: int, end: int) -> str:
+    return preamble + "\\begin{document}\n" + "\n".join(lines[start:end]) + "\n\\end{document}\n"
+
+
+def _isolate_check(latex_source: str) -> CompileResponse:
+    """_draft_check of one piece, inside the isolation budget (_isolate_slots)."""
+    with _isolate_slots:
+        return _pooled(_draft_check, latex_source, reject_when_full=False)
+
+
+def _isolate_error(progress: _JobProgress, attempt: int, latex_source: str) -> _ErrorFragment | None:
+    """Smallest fragment of latex_source that fails to compile by itself.
+
+    None when the body has a single chunk, or every piece compiles alone (the
+    error comes from how pieces interact), so the whole document is fixed.
+    """
+    lines = latex_source.split("\n")
+    begin = next((i for i, line in enumerate(lines) if "\\begin{document}" in line), None)
+    finish = next((i for i in range(len(lines) - 1, -1, -1) if "\\end{document}" in lines[i]), None)
+    if begin is None or finish is None or finish <= begin + 1:
+        return None
+    preamble = latex_source[:latex_source.find("\\begin{document}")]
+
+    # Cut points (line indices) inside the body
+    boundaries = _BodyBoundaries()
+    cuts = [begin + 1]
+    for i in range(begin + 1, finish):
+        before, after = boundaries.feed(lines[i])
+        if before and i > cuts[-1]:
+            cuts.append(i)
+        if after and i + 1 < finish:
+            cuts.append(i + 1)
+    cuts.append(finish)
+    chunks = [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+    if len(chunks) < 2:
+        return None
+
+    started = time.monotonic()
+    checks = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, ISOLATE_CONCURRENCY), thread_name_prefix="isolate")
+
+    def first_failure(groups: list[list[tuple[int, int]]]) -> tuple[list[tuple[int, int]], CompileResponse] | None:
+        nonlocal checks
+        progress.check_cancelled()
+        sources = [_fragment_source(preamble, lines, group[0][0], group[-1][1]) for group in groups]
+        results = list(pool.map(_isolate_check, sources))
+        checks += len(results)
+        for group, result in zip(groups, results):
+            if not result.success and result.error_code == "tex_error":
+                return group, result
+        return None
 
-        return CompileResponse(
-            success=True,
-            pdf_base64=base64.b64encode(pdf_bytes).decode("ascii"),
-            pdf_size_bytes=len(pdf_bytes),
-            warnings=warnings,
-        )
-    except subprocess.TimeoutExpired:
-        return CompileResponse(success=False, error="Compilation timed out (60s)")
-    except Exception as e:
-        return CompileResponse(success=False, error=f"Server error: {str(e)}")
+    try:
+        size = -(-len(chunks) // max(1, ISOLATE_MAX_PIECES))
+        progress.emit("isolation_started", attempt=attempt, chunks=len(chunks))
+        found = first_failure([chunks[i:i + size] for i in range(0, len(chunks), size)])
+        while found and len(found[0]) > 1:
+            group = found[0]
+            half = len(group) // 2
+            narrower = first_failure([group[:half], group[half:]])
+            if narrower is None:
+                break  # fails only as a whole
+            found = narrower
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        pool.shutdown(wait=False)
+
+    seconds = round(time.monotonic() - started, 2)
+    if found is None:
+        _log.info(f"[isolate] no piece fails alone ({checks} checks, {seconds}s) — fixing the whole document")
+        progress.emit("isolation_finished", attempt=attempt, found=False, checks=checks, seconds=seconds)
+        return None
+    group, result = found
+    fragment = _ErrorFragment(lines, group[0][0], group[-1][1], preamble, result)
+    _log.info(f"[isolate] error isolated to lines {fragment.start + 1}-{fragment.end} "
+              f"({checks} checks, {seconds}s)")
+    progress.emit("isolation_finished", attempt=attempt, found=True, checks=checks, seconds=seconds,
+                  first_line=fragment.start + 1, last_line=fragment.end,
+                  error=(result.error or "")[:500] or None)
+    return fragment
 
 
-_NOISE_WARNINGS = [
-    "Label(s) may have changed",
-    "There were multiply-defined labels",
-    "destination with the same identifier",
-    "Rerun to get",
-]
+# ---------------------------------------------------------------------------
+# Fix fan-out — several fix candidates per round, the first that compiles wins
+# ---------------------------------------------------------------------------
 
+# Candidates per auto-fix round; 1 keeps the serial fix → compile loop
+AUTOFIX_FANOUT = int(os.environ.get("AUTOFIX_FANOUT", "1"))
+# "mode:temperature" per candidate, reused cyclically
+AUTOFIX_FANOUT_STRATEGIES = [
+    (mode, float(temperature))
+    for mode, _, temperature in (
+        item.strip().partition(":")
+        for item in os.environ.get("AUTOFIX_FANOUT_STRATEGIES", "patch:0.2,full:0.2,patch:0.7,full:0.7").split(",")
+        if item.strip()
+    )
+] or [("patch", 0.2)]
+# Per job, on top of the worker-wide GENERATE_LLM_CONCURRENCY and
+# GENERATE_COMPILE_CONCURRENCY (raise the latter for compiles to overlap)
+AUTOFIX_FANOUT_LLM = int(os.environ.get("AUTOFIX_FANOUT_LLM", "2"))
+AUTOFIX_FANOUT_COMPILES = int(os.environ.get("AUTOFIX_FANOUT_COMPILES", "2"))
 
-def _filter_significant_warnings(warnings: list[str]) -> list[str]:
-    """Keep only warnings worth fixing; drop noise-only entries."""
-    return [w for w in warnings if not any(n in w for n in _NOISE_WARNINGS)]
 
+class _CandidateDropped(Exception):
+    """Another candidate of the round already compiled."""
 
-AUTOFIX_WARNINGS_SYSTEM = """Você é um especialista em LaTeX. O código abaixo compilou com sucesso, mas gerou os avisos listados.
 
-REGRAS — corrija os avisos SEM alterar o conteúdo do documento:
-1. Overfull \\hbox: reduza largura de colunas ou envolva tabular em \\adjustbox{max width=\\linewidth}{...}.
-2. Overfull \\vbox (tabela longa): converta \\begin{tabular} para \\begin{longtable} adicionando \\endfirsthead/\\endhead.
-3. Font shape undefined (T1/cmss/b/n, TS1/...): substitua caracteres ² por \\textsuperscript{2}, ³ por \\textsuperscript{3}.
-4. enumitem "Negative labelwidth": troque leftmargin=0pt por leftmargin=1.5em em description.
-5. Underfull \\hbox: aumente larguras de colunas estreitas ou adicione \\raggedright na coluna.
-6. LaTeX Font Warning "not available ... substituted": adicione \\normalfont ou troque \\bfseries por \\mdseries naquele contexto.
-7. NUNCA altere o conteúdo textual (seções, itens, dados).
-8. NUNCA coloque longtable dentro de adjustbox, tcolorbox ou qualquer grupo.
+class _CandidateProgress:
+    """Progress of one fix candidate: events tagged with it, stopped once another wins."""
 
-Retorne o código LaTeX COMPLETO corrigido (de \\begin{document} até \\end{document}), sem explicações, sem fence blocks."""
+    def __init__(self, progress: _JobProgress, stop: threading.Event, candidate: int):
+        self.progress = progress
+        self.stop = stop
+        self.candidate = candidate
 
+    def emit(self, event: str, **data) -> None:
+        self.progress.emit(event, candidate=self.candidate, **data)
 
-AUTOFIX_SYSTEM = """Você é um especialista em LaTeX. O código abaixo falhou na compilação com pdflatex.
+    def check_cancelled(self) -> None:
+        self.progress.check_cancelled()
+        if self.stop.is_set():
+            raise _CandidateDropped()
 
-REGRAS DE CORREÇÃO:
-1. Corrija os erros mantendo o conteúdo e estilo.
-2. Se o documento está TRUNCADO (texto cortado), COMPLETE o conteúdo faltante.
-3. NUNCA use \\begin{axis}/pgfplots — substitua por tabelas com booktabs.
-4. NUNCA coloque longtable dentro de adjustbox, tcolorbox ou qualquer grupo.
-5. NUNCA use condicionais TeX (\\ifnum, \\ifcase, \\else, \\fi, \\or).
-6. NUNCA use \\foreach com rnd ou \\pgfmathparse inline em cores.
-7. NUNCA use \\multirowcell — use \\multirow{N}{*}{texto}.
-8. Todas as tcolorbox (infobox, alertbox, etc.) já são breakable — NÃO adicione breakable.
-9. \\rowcolor DEVE ser o PRIMEIRO comando de uma linha de tabela (nunca após &).
-10. Para tabelas que transbordam: envolva tabular em \\adjustbox{max width=\\linewidth}{...}.
-11. Se usar tabularx, SEMPRE inclua pelo menos uma coluna X.
-12. NUNCA use colunas X em longtable — X é exclusivo de tabularx.
 
-Retorne o código LaTeX corrigido COMPLETO (de \\begin{document} até \\end{document}), sem explicações, sem fence blocks."""
+def _fix_candidates(client, model: str, req: GenerateAndCompileRequest, progress: _JobProgress, attempt: int,
+                    failed: CompileResponse, latex_source: str, images: list[ImagePayload] | None,
+                    fragment: _ErrorFragment | None = None) -> tuple[CompileResponse, str] | None:
+    """One fan-out round: AUTOFIX_FANOUT fixes of latex_source, each compiled as soon as it arrives.
+
+    With a fragment, candidates fix only it and splice it back in before compiling.
+
+    Returns (result, source) of the first candidate that compiles, killing the
+    others' Claude streams and pdflatex runs; if none compiles, the candidate
+    with the fewest errors. None if no candidate produced a source.
+    """
+    stop = threading.Event()
+    llm_slots = threading.BoundedSemaphore(max(1, AUTOFIX_FANOUT_LLM))
+    compile_slots = threading.BoundedSemaphore(max(1, AUTOFIX_FANOUT_COMPILES))
+
+    def candidate(index: int) -> tuple[CompileResponse, str]:
+        mode, temperature = AUTOFIX_FANOUT_STRATEGIES[index % len(AUTOFIX_FANOUT_STRATEGIES)]
+        cand = _CandidateProgress(progress, stop, index)
+        with _abort_jobs_on(stop):
+            with llm_slots:
+                cand.check_cancelled()
+                cand.emit("fix_candidate_started", attempt=attempt, mode=mode, temperature=temperature)
+                target, error = (fragment.source, fragment.result) if fragment else (latex_source, failed)
+                source = _request_fix(
+                    client, model, req, cand, "auto_fix", "ERRO DE COMPILAÇÃO", error.error or "",
+                    target, error.diagnostics, mode=mode, temperature=temperature,
+                )
+                if fragment:
+                    source = fragment.splice(latex_source, source)
+            with compile_slots:
+                cand.check_cancelled()
+                result, source = _compile_with_local_fixes(cand, attempt, source, images)
+        return result, source
+
+    with _anthropic_lock:
+        _llm_usage["fix_candidates_started_total"] += AUTOFIX_FANOUT
+    pool = ThreadPoolExecutor(max_workers=AUTOFIX_FANOUT, thread_name_prefix="fix-candidate")
+    futures = {pool.submit(candidate, i): i for i in range(AUTOFIX_FANOUT)}
+    finished: list[tuple[CompileResponse, str]] = []
+    cancelled = False
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            if not done:
+                try:
+                    progress.check_cancelled()
+                except _JobCancelled:
+                    cancelled = True
+                    break
+                continue
+            for future in done:
+                index = futures[future]
+                try:
+                    result, source = future.result()
+                except _JobCancelled:
+                    cancelled = True
+                    continue
+                except _CandidateDropped:
+                    continue
+                except Exception as e:
+                    _log.warning(f"[auto-fix] doc_id={req.doc_id!r} candidate {index} failed: {e}")
+                    continue
+                if result.error_code == "cancelled":
+                    continue
+                if result.success and result.pdf_base64 and not stop.is_set():
+                    stop.set()
+                    with _anthropic_lock:
+                        _llm_usage["fix_candidates_won_total"] += 1
+                    _log.info(f"[auto-fix] doc_id={req.doc_id!r} candidate {index} compiled first")
+                    progress.emit("fix_candidate_won", attempt=attempt, candidate=index)
+                    return result, source
+                finished.append((result, source))
+            if cancelled:
+                break
+    finally:
+        stop.set()  # losers stop streaming and their pdflatex runs are killed
+        pool.shutdown(wait=False, cancel_futures=True)
+    if cancelled:
+        raise _JobCancelled()
+    if not finished:
+        return None
+    # Closest miss: a TeX error (not a timeout or limit) with the fewest errors
+    return min(finished, key=lambda f: (f[0].error_code != "tex_error",
+                                        sum(1 for d in f[0].diagnostics or [] if d.severity == "error")))
 
 
 def _is_credit_error(e: Exception) -> bool:
@@ -1047,10 +5099,29 @@ def _is_credit_error(e: Exception) -> bool:
     return "credit balance is too low" in str(e).lower()
 
 
-def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
-    """Sync: generate LaTeX with Claude, compile + auto-fix. Returns dict."""
-    import anthropic
+def _do_generate_and_compile(req: GenerateAndCompileRequest, progress: _JobProgress = _NO_PROGRESS) -> dict:
+    """Sync: generate LaTeX with Claude, compile + auto-fix. Returns dict.
+
+    Stage events go to progress; the job stops early once it is cancelled.
+    """
+    try:
+        result = _generate_and_compile_steps(req, progress)
+    except _JobCancelled:
+        _log.info(f"[generate] doc_id={req.doc_id!r} cancelled by client")
+        result = {"success": False, "error": "Cancelled", "error_code": "cancelled", "attempts": 0}
+        progress.emit("cancelled")
+        return result
+    progress.emit(
+        "completed" if result["success"] else "failed",
+        success=result["success"],
+        attempts=result.get("attempts", 0),
+        pdf_size_bytes=result.get("pdf_size_bytes"),
+        error=(result.get("error") or "")[:500] or None,
+    )
+    return result
+
 
+def _generate_and_compile_steps(req: GenerateAndCompileRequest, progress: _JobProgress) -> dict:
     # --- Step 1: Generate LaTeX with Claude (streaming) ---
     # Try primary service key first; fall back to user key on credit error.
     keys_to_try: list[tuple[str, str]] = [(ANTHROPIC_API_KEY, CLAUDE_MODEL)]
@@ -1061,27 +5132,37 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
     ai_content = None
     ai_model = CLAUDE_MODEL
     last_gen_error = None
+    speculation = None
 
     for api_key, model in keys_to_try:
         if not api_key:
             continue
-        client = anthropic.Anthropic(api_key=api_key)
+        client = _anthropic_client(api_key)
         _log.info(f"[generate] doc_id={req.doc_id!r} Calling {model} (max_tokens={req.max_tokens}, key=...{api_key[-6:]})")
+        progress.check_cancelled()
+        progress.emit("generation_started", model=model)
+        speculation = _Speculation(req, progress, client, model) if SPECULATIVE_COMPILE else None
         try:
-            with client.messages.stream(
+            with _llm_slots, client.messages.stream(
                 model=model,
                 max_tokens=req.max_tokens,
                 temperature=0.7,
-                system=req.system_prompt,
+                system=[_cached_text(req.system_prompt)],
                 messages=[{"role": "user", "content": req.user_prompt}],
             ) as stream:
-                ai_content = stream.get_final_text()
+                ai_content = _stream_text(stream, progress, "generation",
+                                          speculation.feed if speculation else None)
                 ai_model = stream.get_final_message().model
             _log.info(f"[generate] Claude returned {len(ai_content)} chars")
             last_gen_error = None
             break  # success — stop trying keys
+        except _JobCancelled:
+            raise
         except Exception as e:
             last_gen_error = e
+            if speculation:
+                speculation.finish()
+                speculation = None
             if _is_credit_error(e) and req.fallback_api_key and api_key != req.fallback_api_key:
                 _log.warning(f"[generate] doc_id={req.doc_id!r} Credit exhausted on service key — retrying with user key")
                 continue
@@ -1103,14 +5184,28 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
             body = body[:insert_idx] + "\n" + req.signature_block + "\n\n" + body[insert_idx:]
 
     current_source = _sanitize_latex(req.preamble + body)
+    if speculation and speculation.finish():
+        current_source = speculation.apply(current_source)
+
+    # Decode images once; every compile attempt below links them from the store
+    try:
+        images = _intern_images(req.images)
+    except (ValueError, OSError) as e:
+        return {"success": False, "error": f"Imagens inválidas: {e}", "ai_model": ai_model, "attempts": 0}
 
     # --- Step 3: Compile → Claude fixes → recompile loop (up to 5 attempts) ---
     MAX_ATTEMPTS = 5
     last_error = None
+    last_error_code = None
+    fanned_out = None  # result and source of the last fan-out round, already compiled
 
     for attempt in range(1, MAX_ATTEMPTS + 1):
         _log.info(f"[compile] doc_id={req.doc_id!r} Attempt {attempt}/{MAX_ATTEMPTS}...")
-        result = _compile_in_tmpdir(current_source, req.images)
+        if fanned_out:
+            result, current_source = fanned_out
+            fanned_out = None
+        else:
+            result, current_source = _compile_with_local_fixes(progress, attempt, current_source, images)
 
         if result.success and result.pdf_base64:
             _log.info(f"[compile] doc_id={req.doc_id!r} SUCCESS attempt {attempt}! PDF={result.pdf_size_bytes} bytes")
@@ -1120,6 +5215,7 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
             best_pdf_b64 = result.pdf_base64
             best_pdf_size = result.pdf_size_bytes
             best_warnings = result.warnings
+            best_diagnostics = result.diagnostics
 
             significant = _filter_significant_warnings(result.warnings or [])
             MAX_WARN_FIXES = 2
@@ -1127,43 +5223,27 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
                 if not significant:
                     break
                 _log.info(f"[warn-fix] doc_id={req.doc_id!r} pass {wfix}/{MAX_WARN_FIXES}: {len(significant)} significant warning(s)")
+                progress.check_cancelled()
+                progress.emit("warn_fix_started", warn_fix_pass=wfix, significant_warnings=len(significant))
                 try:
-                    with client.messages.stream(
-                        model=ai_model,
-                        max_tokens=req.max_tokens,
-                        temperature=0.2,
-                        system=AUTOFIX_WARNINGS_SYSTEM,
-                        messages=[{
-                            "role": "user",
-                            "content": (
-                                "AVISOS DE COMPILAÇÃO:\n"
-                                + "\n".join(significant)
-                                + "\n\nCÓDIGO LATEX:\n"
-                                + best_source
-                            ),
-                        }],
-                    ) as wfix_stream:
-                        wfix_text = wfix_stream.get_final_text()
-
-                    wfix_body = _extract_latex_body(wfix_text)
-                    wfix_body = _sanitize_latex(wfix_body)
-                    preamble_end = best_source.find("\\begin{document}")
-                    wfix_source = (
-                        best_source[:preamble_end] + wfix_body
-                        if preamble_end != -1
-                        else req.preamble + wfix_body
+                    wfix_source = _request_fix(
+                        client, ai_model, req, progress, "warn_fix",
+                        "AVISOS DE COMPILAÇÃO", "\n".join(significant), best_source, best_diagnostics,
                     )
-                    wfix_result = _compile_in_tmpdir(wfix_source, req.images)
+                    wfix_result = _timed_compile(progress, attempt, f"warn_fix_{wfix}", wfix_source, images)
                     if wfix_result.success and wfix_result.pdf_base64:
                         best_source = wfix_source
                         best_pdf_b64 = wfix_result.pdf_base64
                         best_pdf_size = wfix_result.pdf_size_bytes
                         best_warnings = wfix_result.warnings
+                        best_diagnostics = wfix_result.diagnostics
                         significant = _filter_significant_warnings(wfix_result.warnings or [])
                         _log.info(f"[warn-fix] doc_id={req.doc_id!r} pass {wfix} OK, remaining significant: {len(significant)}")
                     else:
                         _log.warning(f"[warn-fix] doc_id={req.doc_id!r} pass {wfix} broke compilation — keeping previous version")
                         break
+                except _JobCancelled:
+                    raise
                 except Exception as wfix_err:
                     _log.error(f"[warn-fix] doc_id={req.doc_id!r} Claude call failed: {wfix_err}")
                     break
@@ -1179,6 +5259,7 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
             }
 
         last_error = result.error
+        last_error_code = result.error_code
         _log.warning(f"[compile] doc_id={req.doc_id!r} Attempt {attempt} FAILED: {(result.error or '')[:200]}")
 
         if attempt == MAX_ATTEMPTS:
@@ -1186,27 +5267,30 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
 
         # Ask Claude to fix the error
         _log.info(f"[auto-fix] doc_id={req.doc_id!r} Asking Claude to fix...")
+        progress.check_cancelled()
+        progress.emit("auto_fix_started", attempt=attempt, candidates=max(1, AUTOFIX_FANOUT))
         try:
-            with client.messages.stream(
-                model=ai_model,
-                max_tokens=req.max_tokens,
-                temperature=0.2,
-                system=AUTOFIX_SYSTEM,
-                messages=[{
-                    "role": "user",
-                    "content": f"ERRO DE COMPILAÇÃO:\n{result.error}\n\nCÓDIGO LATEX COM ERRO:\n{current_source}",
-                }],
-            ) as fix_stream:
-                fix_text = fix_stream.get_final_text()
-            fixed_body = _extract_latex_body(fix_text)
-            fixed_body = _sanitize_latex(fixed_body)
-            _log.info(f"[auto-fix] doc_id={req.doc_id!r} Claude returned fix ({len(fixed_body)} chars)")
-
-            preamble_end = current_source.find("\\begin{document}")
-            if preamble_end != -1:
-                current_source = current_source[:preamble_end] + fixed_body
+            fragment = None
+            if ISOLATE_ERRORS and result.error_code == "tex_error":
+                fragment = _isolate_error(progress, attempt, current_source)
+            if AUTOFIX_FANOUT > 1:
+                fanned_out = _fix_candidates(client, ai_model, req, progress, attempt + 1, result,
+                                             current_source, images, fragment)
+                if fanned_out is None:
+                    raise RuntimeError("no fix candidate produced a source")
+            elif fragment:
+                fixed = _request_fix(
+                    client, ai_model, req, progress, "auto_fix",
+                    "ERRO DE COMPILAÇÃO", fragment.result.error or "", fragment.source, fragment.result.diagnostics,
+                )
+                current_source = fragment.splice(current_source, fixed)
             else:
-                current_source = req.preamble + fixed_body
+                current_source = _request_fix(
+                    client, ai_model, req, progress, "auto_fix",
+                    "ERRO DE COMPILAÇÃO", result.error or "", current_source, result.diagnostics,
+                )
+        except _JobCancelled:
+            raise
         except Exception as fix_err:
             _log.error(f"[auto-fix] doc_id={req.doc_id!r} Claude call failed: {fix_err}")
             last_error = f"Auto-fix failed: {str(fix_err)}"
@@ -1217,50 +5301,633 @@ def _do_generate_and_compile(req: GenerateAndCompileRequest) -> dict:
         "success": False,
         "latex_source": current_source,
         "error": last_error,
+        "error_code": last_error_code,
         "attempts": MAX_ATTEMPTS,
         "ai_model": ai_model,
     }
 
 
-def _send_callback(callback_url: str, callback_token: str, result: dict) -> None:
-    """POST result dict to callback_url with Bearer auth token."""
+# ---------------------------------------------------------------------------
+# Generate job queue — SQLite-backed, worked by a dedicated thread pool
+# ---------------------------------------------------------------------------
+
+# Shared by all workers; on a mounted volume, queued jobs also survive machine restarts
+JOB_QUEUE_DB = os.environ.get("JOB_QUEUE_DB", os.path.join(tempfile.gettempdir(), "aee-jobs.sqlite3"))
+# Per uvicorn worker: job threads, concurrent Claude calls, and compile slots
+# generate jobs may hold at once (the rest stay free for /compile)
+JOB_QUEUE_WORKERS = int(os.environ.get("JOB_QUEUE_WORKERS", "4"))
+GENERATE_LLM_CONCURRENCY = int(os.environ.get("GENERATE_LLM_CONCURRENCY", "4"))
+GENERATE_COMPILE_CONCURRENCY = int(os.environ.get("GENERATE_COMPILE_CONCURRENCY", "1"))
+JOB_QUEUE_POLL_SECONDS = float(os.environ.get("JOB_QUEUE_POLL_SECONDS", "1"))
+JOB_QUEUE_HEARTBEAT_SECONDS = 10.0
+# A running job whose worker stopped heartbeating for this long is run again
+JOB_QUEUE_STALE_SECONDS = float(os.environ.get("JOB_QUEUE_STALE_SECONDS", "60"))
+JOB_QUEUE_MAX_RUNS = int(os.environ.get("JOB_QUEUE_MAX_RUNS", "3"))
+JOB_QUEUE_RETENTION_SECONDS = int(os.environ.get("JOB_QUEUE_RETENTION_SECONDS", str(24 * 3600)))
+# A request identical to a job that succeeded this recently gets that job's result
+JOB_DEDUP_SECONDS = int(os.environ.get("JOB_DEDUP_SECONDS", "600"))
+
+_JOB_ACTIVE = ("queued", "running")
+# pid alone repeats across container restarts
+_job_owner = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_llm_slots = threading.BoundedSemaphore(max(1, GENERATE_LLM_CONCURRENCY))
+_gen_compile_slots = threading.BoundedSemaphore(max(1, GENERATE_COMPILE_CONCURRENCY))
+_job_wakeup = threading.Event()
+_job_stop = threading.Event()
+_job_threads: list[threading.Thread] = []
+_dedup_lock = threading.Lock()
+_dedup_stats = {"attached_total": 0, "reused_total": 0}
+
+
+@contextmanager
+def _jobs_db():
+    conn = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
     try:
-        payload = json_lib.dumps(result).encode("utf-8")
-        http_req = urllib.request.Request(
-            callback_url,
-            data=payload,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {callback_token}",
-                # Cloudflare blocks Python-urllib (error 1010 bot protection)
-                "User-Agent": "AEE-Pro-Compiler/1.0",
-            },
-            method="POST",
+        yield conn
+    finally:
+        conn.close()
+
+
+def _init_job_queue() -> None:
+    os.makedirs(os.path.dirname(JOB_QUEUE_DB) or ".", exist_ok=True)
+    with _jobs_db() as db:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " doc_id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"  # queued, running, done, failed, cancelled
+            " request TEXT,"  # dropped when the job finishes (holds callback token and keys); NULL for sync runs
+            " request_hash TEXT,"
+            " callback TEXT,"  # webhook of the latest request attached to the job, overrides request's
+            " result TEXT,"
+            " owner TEXT,"
+            " runs INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " heartbeat REAL)"
         )
-        urllib.request.urlopen(http_req, timeout=30)
-        _log.info(f"[callback] Sent to {callback_url}")
-    except Exception as e:
-        _log.error(f"[callback] Failed to send to {callback_url}: {e}")
+        for column in ("request_hash", "callback"):  # databases from before dedup
+            try:
+                db.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+            except sqlite3.OperationalError:
+                pass  # already there
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        # Webhook outbox: one row per finished job with a callback_url, payload read from jobs.result
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS callbacks ("
+            " doc_id TEXT PRIMARY KEY,"
+            " url TEXT NOT NULL,"
+            " token TEXT,"  # dropped once delivered, pulled or given up
+            " encoding TEXT NOT NULL,"
+            " status TEXT NOT NULL,"  # pending, delivered, pulled, failed
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_at REAL NOT NULL,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " finished_at REAL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS callbacks_due ON callbacks (status, next_at)")
 
 
-def _process_and_callback(req: GenerateAndCompileRequest) -> None:
-    """Background task: generate+compile then call webhook."""
-    result = _do_generate_and_compile(req)
-    if req.callback_url:
-        _send_callback(req.callback_url, req.callback_token, result)
+def _dedup_snapshot() -> dict[str, int]:
+    with _dedup_lock:
+        return dict(_dedup_stats)
+
+
+def _request_hash(req: GenerateAndCompileRequest) -> str:
+    """What the generation depends on: prompts, preamble, images and model settings.
+
+    Delivery fields (callback URL and token, fallback key, force) are left out,
+    so a Worker retry with a fresh token still matches.
+    """
+    payload = req.model_dump(include={"system_prompt", "user_prompt", "preamble", "max_tokens",
+                                      "signature_block", "fallback_model"})
+    payload["images"] = [(img.filename, img.sha256) for img in req.images or []]
+    return hashlib.sha256(json_lib.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _enqueue_job(req: GenerateAndCompileRequest, run_here: bool = False,
+                 progress: _JobProgress | None = None) -> tuple[str, str | None]:
+    """Queue req under its doc_id, or coalesce it with the same request.
+
+    Returns (outcome, stored result json), outcome being one of
+      queued    new job (with run_here, registered as running on this worker instead)
+      attached  the identical request is already queued or running (req's webhook,
+                if any, replaces the job's)
+      reused    the identical request succeeded within JOB_DEDUP_SECONDS (result
+                given; its webhook is sent again to req's callback)
+      conflict  another request is active for this doc_id; with force, req supersedes
+                it instead (queued as above; the old run stops at its next check
+                and its result is dropped)
+    req.images must already be interned. A new job's event log (progress) is
+    started before the row is visible, so no worker can emit into the old one.
+    """
+    request_hash = _request_hash(req)
+    now = time.time()
+    with _jobs_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT status, request_hash, result, finished_at FROM jobs WHERE doc_id = ?", (req.doc_id,)
+        ).fetchone()
+        same = row is not None and row[1] == request_hash and not req.force
+        if row and row[0] in _JOB_ACTIVE and req.force:
+            _log.info(f"[jobs] doc_id={req.doc_id!r} superseding the {row[0]} job (force)")
+        elif row and row[0] in _JOB_ACTIVE:
+            if not same:
+                db.execute("ROLLBACK")
+                return "conflict", None
+            if req.callback_url:
+                # A Worker retry carries a fresh token; the first one may have expired
+                db.execute("UPDATE jobs SET callback = ? WHERE doc_id = ?", (json_lib.dumps({
+                    "callback_url": req.callback_url,
+                    "callback_token": req.callback_token,
+                    "callback_encoding": req.callback_encoding,
+                }), req.doc_id))
+            db.execute("COMMIT")
+            with _dedup_lock:
+                _dedup_stats["attached_total"] += 1
+            return "attached", None
+        if same and row[0] == "done" and row[3] and row[3] >= now - JOB_DEDUP_SECONDS:
+            if req.callback_url:
+                _queue_callback(db, req)
+            db.execute("COMMIT")
+            with _dedup_lock:
+                _dedup_stats["reused_total"] += 1
+            _callback_wakeup.set()
+            return "reused", row[2]
+        (progress or _JobProgress(req.doc_id)).start()
+        if run_here:
+            db.execute(
+                "INSERT OR REPLACE INTO jobs (doc_id, status, request_hash, owner, runs, created_at, started_at,"
+                " heartbeat) VALUES (?, 'running', ?, ?, 1, ?, ?, ?)",
+                (req.doc_id, request_hash, _job_owner, now, now, now),
+            )
+        else:
+            db.execute(
+                "INSERT OR REPLACE INTO jobs (doc_id, status, request, request_hash, created_at)"
+                " VALUES (?, 'queued', ?, ?, ?)",
+                (req.doc_id, req.model_dump_json(), request_hash, now),
+            )
+        db.execute("COMMIT")
+    if not run_here:
+        _job_wakeup.set()
+    return "queued", None
+
+
+def _wait_for_job(doc_id: str) -> dict:
+    """Block until doc_id's job finishes, then return its result."""
+    while not _job_stop.is_set():
+        with _jobs_db() as db:
+            row = db.execute("SELECT status, result FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            break
+        if row[0] not in _JOB_ACTIVE:
+            return json_lib.loads(row[1]) if row[1] else {"success": False, "error": "No result stored",
+                                                          "error_code": "server_error", "attempts": 0}
+        _job_stop.wait(JOB_QUEUE_POLL_SECONDS)
+    return {"success": False, "error": "Job interrupted", "error_code": "interrupted", "attempts": 0}
+
+
+def _claim_job() -> tuple[str, str, int] | None:
+    """Take the oldest queued job for this process: (doc_id, request json, run number)."""
+    with _jobs_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT doc_id, request, runs FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            db.execute("ROLLBACK")
+            return None
+        now = time.time()
+        db.execute(
+            "UPDATE jobs SET status = 'running', owner = ?, runs = runs + 1, started_at = ?, heartbeat = ?"
+            " WHERE doc_id = ?",
+            (_job_owner, now, now, row[0]),
+        )
+        db.execute("COMMIT")
+    return row[0], row[1], row[2] + 1
+
+
+def _attached_callback(db: sqlite3.Connection, req: GenerateAndCompileRequest) -> GenerateAndCompileRequest:
+    """req with the webhook of the latest request attached to its job, if there was one."""
+    row = db.execute("SELECT callback FROM jobs WHERE doc_id = ?", (req.doc_id,)).fetchone()
+    return req.model_copy(update=json_lib.loads(row[0])) if row and row[0] else req
+
+
+def _finish_job(req: GenerateAndCompileRequest, result: dict, owner: str | None = _job_owner,
+                progress: _JobProgress | None = None) -> None:
+    """Store the result and, in the same transaction, queue its webhook.
+
+    Nothing is stored when progress shows the run was superseded: the row
+    belongs to the newer job (checked under the lock _enqueue_job takes).
+    """
+    status = "done" if result.get("success") else ("cancelled" if result.get("error_code") == "cancelled" else "failed")
+    with _jobs_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if progress is not None and progress.superseded():
+            db.execute("ROLLBACK")
+            _log.info(f"[jobs] doc_id={req.doc_id!r} superseded — result dropped")
+            return
+        req = _attached_callback(db, req)
+        finished = db.execute(
+            "UPDATE jobs SET status = ?, result = ?, request = NULL, callback = NULL, finished_at = ?, owner = NULL"
+            " WHERE doc_id = ? AND owner IS ?",
+            (status, json_lib.dumps(result), time.time(), req.doc_id, owner),
+        ).rowcount
+        if finished and req.callback_url:
+            _queue_callback(db, req)
+        db.execute("COMMIT")
+    if finished and req.callback_url:
+        _callback_wakeup.set()
+
+
+def _work_generate_job(doc_id: str, request_json: str, run: int) -> None:
+    req = GenerateAndCompileRequest.model_validate_json(request_json)
+    progress = _JobProgress(doc_id)
+    if run > JOB_QUEUE_MAX_RUNS:
+        _log.error(f"[jobs] doc_id={doc_id!r} interrupted {run - 1} times — giving up")
+        result = {"success": False, "error": f"Job interrupted {run - 1} times (worker restarts)",
+                  "error_code": "interrupted", "attempts": 0}
+        progress.resume("failed")
+    else:
+        progress.resume("started" if run == 1 else "resumed")
+        try:
+            result = _do_generate_and_compile(req, progress)
+        except Exception as e:
+            _log.error(f"[jobs] doc_id={doc_id!r} crashed: {e}")
+            result = {"success": False, "error": f"Server error: {e}", "error_code": "server_error", "attempts": 0}
+            progress.emit("failed", error=result["error"])
+    _finish_job(req, result, progress=progress)
+
+
+def _job_worker() -> None:
+    while not _job_stop.is_set():
+        try:
+            claimed = _claim_job()
+        except sqlite3.Error as e:
+            _log.warning(f"[jobs] queue unavailable: {e}")
+            claimed = None
+        if claimed is None:
+            _job_wakeup.wait(JOB_QUEUE_POLL_SECONDS)
+            _job_wakeup.clear()
+            continue
+        try:
+            _work_generate_job(*claimed)
+        except Exception as e:
+            # Bad request row or the queue failing at the end: keep this thread serving
+            _log.error(f"[jobs] doc_id={claimed[0]!r} worker error: {e}")
+            _abandon_job(claimed[0], f"Server error: {e}")
+
+
+def _abandon_job(doc_id: str, error: str) -> None:
+    """Mark our running job failed without a webhook (its request may be unreadable)."""
+    result = {"success": False, "error": error, "error_code": "server_error", "attempts": 0}
+    try:
+        with _jobs_db() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', result = ?, request = NULL, callback = NULL, finished_at = ?,"
+                " owner = NULL WHERE doc_id = ? AND owner = ? AND status = 'running'",
+                (json_lib.dumps(result), time.time(), doc_id, _job_owner),
+            )
+    except sqlite3.Error as e:
+        _log.error(f"[jobs] doc_id={doc_id!r} could not be marked failed: {e}")
+
+
+def _job_housekeeping() -> None:
+    """Heartbeat our running jobs, requeue ones whose worker died, purge old results."""
+    while not _job_stop.wait(JOB_QUEUE_HEARTBEAT_SECONDS):
+        now = time.time()
+        try:
+            with _jobs_db() as db:
+                db.execute("UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'", (now, _job_owner))
+                requeued = db.execute(
+                    "UPDATE jobs SET status = 'queued', owner = NULL"
+                    " WHERE status = 'running' AND heartbeat < ? AND request IS NOT NULL",
+                    (now - JOB_QUEUE_STALE_SECONDS,),
+                ).rowcount
+                _fail_sync_runs(db, "status = 'running' AND heartbeat < ?", (now - JOB_QUEUE_STALE_SECONDS,))
+                db.execute(
+                    "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?",
+                    (now - JOB_QUEUE_RETENTION_SECONDS,),
+                )
+                db.execute(
+                    "DELETE FROM callbacks WHERE status != 'pending' AND finished_at < ?",
+                    (now - JOB_QUEUE_RETENTION_SECONDS,),
+                )
+        except sqlite3.Error as e:
+            _log.warning(f"[jobs] housekeeping failed: {e}")
+            continue
+        if requeued:
+            _log.warning(f"[jobs] requeued {requeued} job(s) left running by a stopped worker")
+            _job_wakeup.set()
+
+
+def _fail_sync_runs(db: sqlite3.Connection, where: str, params: tuple) -> None:
+    """Finish the sync runs matching where as interrupted; their HTTP request is gone."""
+    result = {"success": False, "error": "Job interrupted (worker restart)", "error_code": "interrupted",
+              "attempts": 0}
+    db.execute(
+        f"UPDATE jobs SET status = 'failed', result = ?, finished_at = ?, owner = NULL"
+        f" WHERE request IS NULL AND {where}",
+        (json_lib.dumps(result), time.time(), *params),
+    )
+
+
+@app.on_event("startup")
+def _start_job_queue() -> None:
+    _init_job_queue()
+    for i in range(JOB_QUEUE_WORKERS):
+        t = threading.Thread(target=_job_worker, name=f"aee-job-{i}", daemon=True)
+        t.start()
+        _job_threads.append(t)
+    t = threading.Thread(target=_job_housekeeping, name="aee-job-housekeeping", daemon=True)
+    t.start()
+    _job_threads.append(t)
+
+
+@app.on_event("shutdown")
+def _stop_job_queue() -> None:
+    """Hand our running jobs back to the queue; they restart on the next worker."""
+    _job_stop.set()
+    _job_wakeup.set()
+    try:
+        with _jobs_db() as db:
+            n = db.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, runs = runs - 1"
+                " WHERE owner = ? AND status = 'running' AND request IS NOT NULL",
+                (_job_owner,),
+            ).rowcount
+            _fail_sync_runs(db, "owner = ? AND status = 'running'", (_job_owner,))
+    except sqlite3.Error:
+        return
+    if n:
+        _log.info(f"[jobs] returned {n} running job(s) to the queue on shutdown")
+
+
+def _job_queue_snapshot() -> dict:
+    counts = {status: 0 for status in ("queued", "running", "done", "failed", "cancelled")}
+    try:
+        with _jobs_db() as db:
+            for status, n in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = n
+    except sqlite3.Error:
+        pass
+    return {
+        "workers": JOB_QUEUE_WORKERS,
+        "llm_concurrency": GENERATE_LLM_CONCURRENCY,
+        "compile_concurrency": GENERATE_COMPILE_CONCURRENCY,
+        **counts,
+        **{f"dedup_{name}": n for name, n in _dedup_snapshot().items()},
+    }
+
+
+# ---------------------------------------------------------------------------
+# Webhook delivery — SQLite outbox, retried with backoff over pooled connections
+# ---------------------------------------------------------------------------
+
+# A finished job's webhook is queued in the same transaction as its result, so
+# a restart or a Worker outage no longer loses it: delivery threads retry with
+# exponential backoff and jitter, and GET /jobs/{doc_id}/result serves results
+# whose callback never got through.
+CALLBACK_WORKERS = int(os.environ.get("CALLBACK_WORKERS", "2"))
+CALLBACK_TIMEOUT = float(os.environ.get("CALLBACK_TIMEOUT", "30"))
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", "12"))
+CALLBACK_BACKOFF_BASE = float(os.environ.get("CALLBACK_BACKOFF_BASE", "5"))
+CALLBACK_BACKOFF_MAX = float(os.environ.get("CALLBACK_BACKOFF_MAX", "600"))
+# Body format when the request does not choose: json, gzip (gzip-compressed JSON)
+# or multipart (result JSON plus the PDF as a binary part)
+CALLBACK_ENCODING = os.environ.get("CALLBACK_ENCODING", "json")
+# Bodies smaller than this are sent as plain JSON whatever the encoding
+CALLBACK_COMPACT_MIN_BYTES = int(os.environ.get("CALLBACK_COMPACT_MIN_BYTES", str(64 * 1024)))
+
+_CALLBACK_ENCODINGS = ("json", "gzip", "multipart")
+# Client errors worth retrying; any other 4xx will not go away by itself
+_CALLBACK_RETRY_4XX = (408, 425, 429)
+_callback_wakeup = threading.Event()
+_callback_conns = threading.local()  # per delivery thread: {(scheme, netloc): connection}
+
+
+class _CallbackFailed(Exception):
+    def __init__(self, message: str, permanent: bool = False, retry_after: float | None = None):
+        super().__init__(message)
+        self.permanent = permanent
+        self.retry_after = retry_after
+
+
+def _queue_callback(db: sqlite3.Connection, req: GenerateAndCompileRequest) -> None:
+    """Add req's webhook to the outbox, inside the caller's transaction."""
+    encoding = req.callback_encoding or CALLBACK_ENCODING
+    if encoding not in _CALLBACK_ENCODINGS:
+        encoding = "json"
+    now = time.time()
+    db.execute(
+        "INSERT OR REPLACE INTO callbacks (doc_id, url, token, encoding, status, attempts, next_at, created_at)"
+        " VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)",
+        (req.doc_id, req.callback_url, req.callback_token, encoding, now, now),
+    )
+
+
+def _callback_body(doc_id: str, result_json: str, encoding: str) -> tuple[bytes, dict[str, str]]:
+    """Request body and content headers for a result in the given encoding."""
+    payload = result_json.encode("utf-8")
+    if len(payload) < CALLBACK_COMPACT_MIN_BYTES or encoding == "json":
+        return payload, {"Content-Type": "application/json"}
+    if encoding == "gzip":
+        return gzip.compress(payload, compresslevel=6), {"Content-Type": "application/json",
+                                                         "Content-Encoding": "gzip"}
+    result = json_lib.loads(result_json)
+    pdf_b64 = result.pop("pdf_base64", None)
+    boundary = uuid.uuid4().hex
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="result"\r\n'
+        f"Content-Type: application/json\r\n\r\n".encode("ascii") + json_lib.dumps(result).encode("utf-8"),
+    ]
+    if pdf_b64:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="pdf"; filename="{doc_id}.pdf"\r\n'
+            f"Content-Type: application/pdf\r\n\r\n".encode("ascii") + base64.b64decode(pdf_b64)
+        )
+    body = b"\r\n".join(parts) + f"\r\n--{boundary}--\r\n".encode("ascii")
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def _callback_connection(scheme: str, netloc: str, fresh: bool = False) -> http.client.HTTPConnection:
+    """This thread's keep-alive connection to netloc (a new one when fresh)."""
+    pool = getattr(_callback_conns, "pool", None)
+    if pool is None:
+        pool = _callback_conns.pool = {}
+    conn = pool.get((scheme, netloc))
+    if conn is not None and not fresh:
+        return conn
+    if conn is not None:
+        conn.close()
+    cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    conn = pool[(scheme, netloc)] = cls(netloc, timeout=CALLBACK_TIMEOUT)
+    return conn
+
+
+def _post_callback(url: str, body: bytes, headers: dict[str, str]) -> None:
+    """POST body to url, reusing this thread's connection. Raises _CallbackFailed."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        raise _CallbackFailed(f"invalid callback URL {url!r}", permanent=True)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    for fresh in (False, True):
+        conn = _callback_connection(parts.scheme, parts.netloc, fresh)
+        try:
+            conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()  # drain, so the connection can be reused
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            # A kept-alive connection may have been closed by the server meanwhile
+            if not fresh and not isinstance(e, TimeoutError):
+                continue
+            raise _CallbackFailed(f"{type(e).__name__}: {e}")
+        if resp.will_close:
+            conn.close()
+        if 200 <= resp.status < 300:
+            return
+        retry_after = resp.getheader("Retry-After")
+        raise _CallbackFailed(
+            f"HTTP {resp.status} {resp.reason}",
+            permanent=400 <= resp.status < 500 and resp.status not in _CALLBACK_RETRY_4XX,
+            retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+        )
+
+
+def _callback_delay(attempts: int) -> float:
+    """Seconds before retry number attempts + 1: exponential, capped, with jitter."""
+    delay = min(CALLBACK_BACKOFF_MAX, CALLBACK_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _claim_callback() -> tuple[str, str, str, str, int] | None:
+    """Lease the next due webhook: (doc_id, url, token, encoding, attempt number)."""
+    now = time.time()
+    with _jobs_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT doc_id, url, token, encoding, attempts FROM callbacks"
+            " WHERE status = 'pending' AND next_at <= ? ORDER BY next_at LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            db.execute("ROLLBACK")
+            return None
+        # Leased past the request timeout; if this worker dies, another one retries
+        db.execute(
+            "UPDATE callbacks SET attempts = attempts + 1, next_at = ? WHERE doc_id = ?",
+            (now + CALLBACK_TIMEOUT * 2 + 5, row[0]),
+        )
+        db.execute("COMMIT")
+    return row[0], row[1], row[2] or "", row[3], row[4] + 1
+
+
+def _deliver_callback(doc_id: str, url: str, token: str, encoding: str, attempt: int) -> None:
+    with _jobs_db() as db:
+        row = db.execute("SELECT result FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+    started = time.monotonic()
+    try:
+        if row is None or row[0] is None:
+            raise _CallbackFailed("job result no longer stored", permanent=True)
+        body, headers = _callback_body(doc_id, row[0], encoding)
+        _post_callback(url, body, {
+            **headers,
+            "Authorization": f"Bearer {token}",
+            # Cloudflare blocks Python-urllib (error 1010 bot protection)
+            "User-Agent": "AEE-Pro-Compiler/1.0",
+            # Retries resend the same result; receivers can ignore repeats
+            "Idempotency-Key": doc_id,
+            "X-AEE-Delivery-Attempt": str(attempt),
+        })
+    except _CallbackFailed as e:
+        gave_up = e.permanent or attempt >= CALLBACK_MAX_ATTEMPTS
+        with _jobs_db() as db:
+            if gave_up:
+                db.execute(
+                    "UPDATE callbacks SET status = 'failed', token = NULL, last_error = ?, finished_at = ?"
+                    " WHERE doc_id = ? AND status = 'pending'",
+                    (str(e), time.time(), doc_id),
+                )
+            else:
+                delay = max(e.retry_after or 0, _callback_delay(attempt))
+                db.execute(
+                    "UPDATE callbacks SET last_error = ?, next_at = ? WHERE doc_id = ? AND status = 'pending'",
+                    (str(e), time.time() + delay, doc_id),
+                )
+        if gave_up:
+            _log.error(f"[callback] doc_id={doc_id!r} giving up after {attempt} attempt(s): {e}"
+                       f" — result stays available on GET /jobs/{doc_id}/result")
+        else:
+            _log.warning(f"[callback] doc_id={doc_id!r} attempt {attempt} to {url} failed: {e} — retrying")
+        return
+    with _jobs_db() as db:
+        # Like the failure paths: never overwrite a row another worker already settled
+        db.execute(
+            "UPDATE callbacks SET status = 'delivered', token = NULL, last_error = NULL, finished_at = ?"
+            " WHERE doc_id = ? AND status = 'pending'",
+            (time.time(), doc_id),
+        )
+    _log.info(f"[callback] Sent to {url} ({encoding}, {len(body) // 1024}KB, attempt {attempt}, "
+              f"{time.monotonic() - started:.2f}s)")
+
+
+def _callback_worker() -> None:
+    while not _job_stop.is_set():
+        try:
+            claimed = _claim_callback()
+        except sqlite3.Error as e:
+            _log.warning(f"[callback] outbox unavailable: {e}")
+            claimed = None
+        if claimed is None:
+            _callback_wakeup.wait(JOB_QUEUE_POLL_SECONDS)
+            _callback_wakeup.clear()
+            continue
+        try:
+            _deliver_callback(*claimed)
+        except Exception as e:
+            # The lease expires and the webhook is tried again
+            _log.error(f"[callback] doc_id={claimed[0]!r} delivery crashed: {e}")
+
+
+@app.on_event("startup")
+def _start_callback_delivery() -> None:
+    for i in range(CALLBACK_WORKERS):
+        t = threading.Thread(target=_callback_worker, name=f"aee-callback-{i}", daemon=True)
+        t.start()
+        _job_threads.append(t)
+
+
+def _callback_snapshot() -> dict:
+    counts = {status: 0 for status in ("pending", "delivered", "pulled", "failed")}
+    try:
+        with _jobs_db() as db:
+            for status, n in db.execute("SELECT status, COUNT(*) FROM callbacks GROUP BY status"):
+                counts[status] = n
+    except sqlite3.Error:
+        pass
+    return {"workers": CALLBACK_WORKERS, "encoding": CALLBACK_ENCODING, **counts}
 
 
 @app.post("/generate-and-compile")
 def generate_and_compile(
     req: GenerateAndCompileRequest,
-    background_tasks: BackgroundTasks,
     authorization: str = Header(default=""),
 ):
     """Generate LaTeX with Claude, compile locally, auto-fix iteratively.
 
-    If callback_url is set: returns 202 immediately and processes in background,
-    POSTing the result to callback_url when done.
+    If callback_url is set: queues the job, returns 202 immediately, and a job
+    worker POSTs the result to callback_url when done (status on GET /jobs/{doc_id}).
     Otherwise: processes synchronously and returns the result directly.
+    Either way, with a doc_id the stages can be followed on GET /jobs/{doc_id}/events.
+
+    Repeats of a request for the same doc_id (double clicks, Worker retries) do
+    not generate twice: while the first is active they attach to it, and for
+    JOB_DEDUP_SECONDS after it succeeded they get its result, unless force is set.
+    A different request while one is active is a 409, unless force is set: then
+    it replaces the active job, which stops at its next check.
     """
     if AUTH_TOKEN:
         token = authorization.removeprefix("Bearer ").strip()
@@ -1270,17 +5937,44 @@ def generate_and_compile(
     if not ANTHROPIC_API_KEY:
         raise HTTPException(status_code=503, detail="ANTHROPIC_API_KEY not configured")
 
+    if req.callback_url and not req.doc_id:
+        req.doc_id = uuid.uuid4().hex
+    progress = _JobProgress(req.doc_id)
+    if req.doc_id:
+        try:
+            # Images go to the asset store so rows and hashes only hold references
+            req = req.model_copy(update={"images": _intern_images(req.images)})
+            outcome, stored = _enqueue_job(req, run_here=not req.callback_url, progress=progress)
+        except (ValueError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"Imagens inválidas: {e}")
+        if outcome == "conflict":
+            raise HTTPException(status_code=409, detail=f"Job already in progress for doc_id {req.doc_id}")
+        if outcome != "queued":
+            _log.info(f"[jobs] doc_id={req.doc_id!r} duplicate request {outcome}")
+
     if req.callback_url:
-        # Async mode: acknowledge immediately, process in background thread
-        background_tasks.add_task(_process_and_callback, req)
+        # Async mode: acknowledge immediately, a queue worker picks it up
+        body = {"status": "accepted", "doc_id": req.doc_id}
+        if outcome != "queued":
+            body["deduplicated"] = outcome
         return Response(
-            content=json_lib.dumps({"status": "accepted", "doc_id": req.doc_id}),
+            content=json_lib.dumps(body),
             status_code=202,
             media_type="application/json",
         )
 
     # Sync mode (backward compat / local dev): process and return result
-    result = _do_generate_and_compile(req)
+    if req.doc_id and outcome == "attached":
+        result = _wait_for_job(req.doc_id)
+    elif req.doc_id and outcome == "reused":
+        result = json_lib.loads(stored)
+    else:
+        result = {"success": False, "error": "Server error", "error_code": "server_error", "attempts": 0}
+        try:
+            result = _do_generate_and_compile(req, progress)
+        finally:
+            if req.doc_id:
+                _finish_job(req, result, progress=progress)
     return Response(
         content=json_lib.dumps(result),
         status_code=200,
@@ -1288,6 +5982,167 @@ def generate_and_compile(
     )
 
 
+@app.get("/jobs/{doc_id}")
+def job_status(
+    doc_id: str,
+    authorization: str = Header(default=""),
+):
+    """Status of a queued /generate-and-compile job, with its result once finished."""
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    with _jobs_db() as db:
+        row = db.execute(
+            "SELECT status, result, runs, created_at, started_at, finished_at FROM jobs WHERE doc_id = ?",
+            (doc_id,),
+        ).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    status, result, runs, created_at, started_at, finished_at = row
+    body = {
+        "doc_id": doc_id,
+        "status": status,
+        "runs": runs,
+        "created_at": created_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "result": json_lib.loads(result) if result else None,
+    }
+    if status == "queued":
+        with _jobs_db() as db:
+            (ahead,) = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (created_at,)
+            ).fetchone()
+        body["queue_position"] = ahead + 1
+    with _jobs_db() as db:
+        callback = db.execute(
+            "SELECT status, attempts, next_at, last_error FROM callbacks WHERE doc_id = ?", (doc_id,)
+        ).fetchone()
+    if callback:
+        body["callback"] = {"status": callback[0], "attempts": callback[1],
+                            "next_at": callback[2] if callback[0] == "pending" else None,
+                            "last_error": callback[3]}
+    return body
+
+
+@app.get("/jobs/{doc_id}/events")
+async def job_events(
+    doc_id: str,
+    request: Request,
+    authorization: str = Header(default=""),
+    last_event_id: str = Header(default="0"),
+):
+    """Server-Sent Events with the stages of a /generate-and-compile job.
+
+    Replays the job's events so far, then follows it until completed, failed
+    or cancelled. Reconnecting clients resume after Last-Event-ID.
+    """
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    log_path, _ = _progress_paths(doc_id)
+    if not os.path.exists(log_path):
+        raise HTTPException(status_code=404, detail="Not found")
+    after = int(last_event_id) if last_event_id.isdigit() else 0
+    return StreamingResponse(
+        _tail_progress(request, log_path, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.delete("/jobs/{doc_id}")
+def cancel_job(
+    doc_id: str,
+    authorization: str = Header(default=""),
+):
+    """Ask a job to stop; it finishes with a cancelled event and webhook.
+
+    A job still waiting in the queue is cancelled on the spot.
+    """
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    log_path, cancel_path = _progress_paths(doc_id)
+    if not os.path.exists(log_path):
+        raise HTTPException(status_code=404, detail="Not found")
+    open(cancel_path, "w").close()
+
+    result = {"success": False, "error": "Cancelled", "error_code": "cancelled", "attempts": 0}
+    with _jobs_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT request FROM jobs WHERE doc_id = ? AND status = 'queued'", (doc_id,)).fetchone()
+        if row is not None:
+            req = _attached_callback(db, GenerateAndCompileRequest.model_validate_json(row[0]))
+            db.execute(
+                "UPDATE jobs SET status = 'cancelled', result = ?, request = NULL, callback = NULL, finished_at = ?"
+                " WHERE doc_id = ?",
+                (json_lib.dumps(result), time.time(), doc_id),
+            )
+            if req.callback_url:
+                _queue_callback(db, req)
+        db.execute("COMMIT")
+    if row is not None:
+        _JobProgress(doc_id).resume("cancelled")
+        _callback_wakeup.set()
+    return {"cancelled": True}
+
+
+@app.get("/jobs/{doc_id}/result")
+def job_result(
+    doc_id: str,
+    authorization: str = Header(default=""),
+):
+    """The result of a finished job, as its webhook would deliver it.
+
+    For results whose callback failed or is still retrying: once pulled, the
+    webhook is no longer sent.
+    """
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    with _jobs_db() as db:
+        row = db.execute("SELECT status, result FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        if row[0] in _JOB_ACTIVE:
+            raise HTTPException(status_code=409, detail=f"Job still {row[0]}")
+        db.execute(
+            "UPDATE callbacks SET status = 'pulled', token = NULL, finished_at = ?"
+            " WHERE doc_id = ? AND status IN ('pending', 'failed')",
+            (time.time(), doc_id),
+        )
+    return Response(content=row[1] or "{}", status_code=200, media_type="application/json")
+
+
+@app.get("/callbacks")
+def list_callbacks(
+    status: str = "failed",
+    authorization: str = Header(default=""),
+):
+    """Webhooks in a given state (failed by default), so their results can be pulled."""
+    if AUTH_TOKEN:
+        token = authorization.removeprefix("Bearer ").strip()
+        if token != AUTH_TOKEN:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    with _jobs_db() as db:
+        rows = db.execute(
+            "SELECT doc_id, attempts, next_at, last_error, created_at, finished_at FROM callbacks"
+            " WHERE status = ? ORDER BY created_at LIMIT 500",
+            (status,),
+        ).fetchall()
+    return [
+        {"doc_id": doc_id, "status": status, "attempts": attempts,
+         "next_at": next_at if status == "pending" else None, "last_error": last_error,
+         "created_at": created_at, "finished_at": finished_at}
+        for doc_id, attempts, next_at, last_error, created_at, finished_at in rows
+    ]
+
+
 # ---------------------------------------------------------------------------
 # POST /compile-dossie — assemble a student dossier from existing PDFs
 # ---------------------------------------------------------------------------
@@ -1310,6 +6165,9 @@ class CompileDossieResponse(BaseModel):
     pdf_base64: str | None = None
     pdf_size_bytes: int | None = None
     error: str | None = None
+    passes: int | None = None
+    optimization: PdfOptimization | None = None
+    error_code: str | None = None  # as in CompileResponse
 
 
 MAX_DOSSIE_DOCS = 30
@@ -1494,9 +6352,16 @@ def _build_dossie_latex(req: CompileDossieRequest, pdf_filenames: list[str]) ->
 @app.post("/compile-dossie", response_model=CompileDossieResponse)
 def compile_dossie(
     req: CompileDossieRequest,
+    request: Request,
+    output: str = "",
+    optimize: str = "",
     authorization: str = Header(default=""),
 ):
-    """Assemble multiple PDFs into a single dossier with cover page and ToC."""
+    """Assemble multiple PDFs into a single dossier with cover page and ToC.
+
+    Supports the same binary mode as /compile (?output=pdf or Accept header)
+    and the same ?optimize= levels.
+    """
     if AUTH_TOKEN:
         token = authorization.removeprefix("Bearer ").strip()
         if token != AUTH_TOKEN:
@@ -1511,7 +6376,30 @@ def compile_dossie(
             error=f"Máximo de {MAX_DOSSIE_DOCS} documentos por dossiê",
         )
 
-    tmpdir = tempfile.mkdtemp(prefix="dossie_")
+    level = _optimize_level(optimize)
+    if not _wants_pdf(request, output):
+        return _pooled(_compile_dossie_request, req, None, level)
+
+    # Binary mode: keep the PDF in the result store so it can be streamed and re-fetched
+    key = hashlib.sha256(
+        b"dossie\0" + level.encode("ascii") + b"\0" + req.model_dump_json().encode("utf-8")
+    ).hexdigest()
+    cached = _compile_cache_get(key, include_pdf=False)
+    if cached is not None:
+        return _binary_reply(request, key, cached)
+    resp = _pooled(_compile_dossie_request, req, key, level)
+    return _binary_reply(request, key, resp)
+
+
+def _compile_dossie_request(req: CompileDossieRequest, cache_key: str | None = None,
+                            optimize: str = "off") -> BaseModel:
+    """Write the PDFs and wrapper into a fresh tmpdir and compile the dossier.
+
+    With cache_key the PDF is moved into the result cache instead of being
+    base64-encoded, and a cache-shaped CompileResponse is returned.
+    """
+    # The merged PDF holds every input PDF again: large dossiers go to disk
+    tmpdir = _acquire_workdir("dossie_", 2 * sum(len(p.data_base64) * 3 // 4 for p in req.pdfs))
     try:
         # Write each PDF to tmpdir
         pdf_filenames: list[str] = []
@@ -1535,51 +6423,38 @@ def compile_dossie(
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(latex_source)
 
-        # Compile twice (for ToC resolution)
-        for pass_num in range(2):
-            result = subprocess.run(
-                [
-                    "pdflatex",
-                    "-interaction=nonstopmode",
-                    "-halt-on-error",
-                    "-output-directory", tmpdir,
-                    tex_path,
-                ],
-                capture_output=True,
-                timeout=120,
-                cwd=tmpdir,
-            )
+        fmt = _prepare_format(tmpdir, "dossie.tex", latex_source)
 
-            if result.returncode != 0:
-                stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
-                log_path = os.path.join(tmpdir, "dossie.log")
-                error_log = ""
-                if os.path.exists(log_path):
-                    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                        lines = f.readlines()
-                    error_lines = []
-                    capture = False
-                    for line in lines:
-                        if line.startswith("!") or capture:
-                            error_lines.append(line.rstrip())
-                            capture = True
-                            if len(error_lines) > 5:
-                                capture = False
-                        if len(error_lines) > 30:
-                            break
-                    error_log = "\n".join(error_lines) if error_lines else stdout[-2000:]
-                else:
-                    error_log = stdout[-2000:]
-                return CompileDossieResponse(
-                    success=False,
-                    error=f"Falha na compilação (pass {pass_num + 1}): {error_log[:3000]}",
-                )
+        # Compile until the ToC and cover positions settle
+        result, passes = _run_latex_passes(tmpdir, "dossie.tex", 120, fmt)
+
+        if result.returncode != 0:
+            stdout = result.stdout.decode("utf-8", errors="replace") if result.stdout else ""
+            scan = _scan_log(os.path.join(tmpdir, "dossie.log"))
+            error_log = _format_latex_errors(scan) or stdout[-2000:]
+            return CompileDossieResponse(
+                success=False,
+                error=f"Falha na compilação (pass {passes}): {error_log[:3000]}",
+                passes=passes,
+                error_code=_tex_error_code(scan),
+            )
 
         if not os.path.exists(pdf_path):
             return CompileDossieResponse(
                 success=False,
                 error="PDF do dossiê não foi gerado",
+                error_code="no_pdf",
+            )
+
+        optimization = _optimize_pdf(pdf_path, optimize)
+
+        if cache_key:
+            resp = CompileResponse(
+                success=True, pdf_size_bytes=os.path.getsize(pdf_path), passes=passes,
+                optimization=optimization,
             )
+            _compile_cache_put_pdf(cache_key, resp, pdf_path)
+            return resp
 
         with open(pdf_path, "rb") as f:
             pdf_bytes = f.read()
@@ -1588,20 +6463,26 @@ def compile_dossie(
             success=True,
             pdf_base64=base64.b64encode(pdf_bytes).decode("ascii"),
             pdf_size_bytes=len(pdf_bytes),
+            passes=passes,
+            optimization=optimization,
         )
 
     except subprocess.TimeoutExpired:
         return CompileDossieResponse(
             success=False,
             error="Compilação do dossiê excedeu o tempo limite (120s)",
+            error_code="timeout",
         )
+    except _JobLimitExceeded as e:
+        return CompileDossieResponse(success=False, error=str(e), error_code=e.code)
     except Exception as e:
         return CompileDossieResponse(
             success=False,
             error=f"Erro no servidor: {str(e)}",
+            error_code="server_error",
         )
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        _release_workdir(tmpdir)
 
 
 if __name__ == "__main__":
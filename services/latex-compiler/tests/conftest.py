@@ -0,0 +1,15 @@
+"""Point every on-disk store of the server at a throwaway directory before it is imported.
+
+    pip install -r requirements-dev.txt && python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+_ROOT = tempfile.mkdtemp(prefix="aee-tests-")
+for _name in ("ASSET_STORE_DIR", "IMAGE_CACHE_DIR", "FMT_CACHE_DIR", "WORKSPACE_DIR", "COMPILE_CACHE_DIR",
+              "PROGRESS_DIR"):
+    os.environ.setdefault(_name, os.path.join(_ROOT, _name.lower()))
+os.environ.setdefault("JOB_QUEUE_DB", os.path.join(_ROOT, "jobs.sqlite3"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
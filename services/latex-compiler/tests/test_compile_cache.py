@@ -0,0 +1,46 @@
+import base64
+
+import server
+from server import CompileResponse, FilePayload, ImagePayload, _compile_cache_key
+
+SOURCE = "\\documentclass{article}\n\\begin{document}\nx\n\\end{document}\n"
+PNG = base64.b64encode(b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4).decode("ascii")
+
+
+def test_key_ignores_line_endings_and_trailing_blanks():
+    assert _compile_cache_key(SOURCE) == _compile_cache_key(SOURCE.replace("\n", "  \r\n") + "\n\n")
+    assert _compile_cache_key(SOURCE) != _compile_cache_key(SOURCE.replace("x", "y"))
+
+
+def test_key_hashes_decoded_image_bytes():
+    wrapped = "\n".join(PNG[i:i + 76] for i in range(0, len(PNG), 76))
+    plain = _compile_cache_key(SOURCE, [ImagePayload(filename="a.png", data_base64=PNG)])
+    assert plain == _compile_cache_key(SOURCE, [ImagePayload(filename="a.png", data_base64=wrapped)])
+    assert plain != _compile_cache_key(SOURCE, [ImagePayload(filename="b.png", data_base64=PNG)])
+    assert plain != _compile_cache_key(SOURCE)
+
+
+def test_key_follows_image_settings(monkeypatch):
+    images = [ImagePayload(filename="a.png", data_base64=PNG)]
+    before = _compile_cache_key(SOURCE, images)
+    monkeypatch.setattr(server, "IMAGE_TARGET_DPI", server.IMAGE_TARGET_DPI + 100)
+    assert _compile_cache_key(SOURCE, images) != before
+
+
+def test_key_covers_files_and_namespace():
+    files = [FilePayload(filename="refs.bib", content="@book{a}")]
+    key = _compile_cache_key(SOURCE, additional_files=files)
+    assert key != _compile_cache_key(SOURCE)
+    assert key != _compile_cache_key(SOURCE, additional_files=[FilePayload(filename="refs.bib", content="@book{b}")])
+    assert _compile_cache_key(SOURCE, namespace="tmpdir") != _compile_cache_key(SOURCE)
+
+
+def test_only_input_determined_failures_are_cached():
+    tex_error = CompileResponse(success=False, error="LaTeX compilation failed", error_code="tex_error")
+    server._compile_cache_put("a" * 64, tex_error)
+    assert server._compile_cache_get("a" * 64).error_code == "tex_error"
+
+    for code in ("timeout", "cancelled", "server_error", "killed", "system_memory", None):
+        key = (code or "none")[0] * 63 + "b"
+        server._compile_cache_put(key, CompileResponse(success=False, error="x", error_code=code))
+        assert server._compile_cache_get(key) is None, code
@@ -0,0 +1,45 @@
+import pytest
+
+from server import _PatchRejected, _apply_fix_hunks, _locate_hunk
+
+BODY = "\\begin{document}\n  \\section{A}\n  Texto um.\n  \\section{B}\n  Texto dois.\n\\end{document}\n"
+
+
+def _hunk(search: str, replace: str) -> str:
+    return f"<<<<<<< BUSCAR\n{search}\n=======\n{replace}\n>>>>>>> SUBSTITUIR\n"
+
+
+def test_locate_exact():
+    start, end = _locate_hunk(BODY, "Texto um.")
+    assert BODY[start:end] == "Texto um."
+
+
+def test_locate_ignores_indentation_and_excerpt_numbers():
+    start, end = _locate_hunk(BODY, "    3| \\section{A}\n    4| Texto um.")
+    assert BODY[start:end] == "  \\section{A}\n  Texto um."
+
+
+def test_locate_rejects_ambiguous_and_missing():
+    with pytest.raises(_PatchRejected, match="ambiguous"):
+        _locate_hunk(BODY, "\\section")
+    with pytest.raises(_PatchRejected, match="not found"):
+        _locate_hunk(BODY, "Texto três.")
+
+
+def test_hunks_apply_in_order():
+    reply = _hunk("Texto um.", "Texto 1.") + "\n" + _hunk("Texto 1.\n  \\section{B}", "Texto 1.\n  \\section{Bê}")
+    patched, count = _apply_fix_hunks(BODY, reply)
+    assert count == 2
+    assert "Texto 1." in patched and "\\section{Bê}" in patched
+
+
+def test_reply_without_hunks_is_rejected():
+    with pytest.raises(_PatchRejected, match="no hunks"):
+        _apply_fix_hunks(BODY, "\\begin{document}\nnovo corpo\n\\end{document}")
+
+
+def test_noop_and_marker_edits_are_rejected():
+    with pytest.raises(_PatchRejected, match="change nothing"):
+        _apply_fix_hunks(BODY, _hunk("Texto um.", "Texto um."))
+    with pytest.raises(_PatchRejected, match="markers"):
+        _apply_fix_hunks(BODY, _hunk("Texto dois.\n\\end{document}", "Texto dois."))
@@ -0,0 +1,91 @@
+from server import _apply_local_fixes
+
+PREAMBLE = "\\documentclass{article}\n\\usepackage{longtable,tabularx,colortbl}\n"
+
+
+def _doc(body: str) -> str:
+    return PREAMBLE + "\\begin{document}\n" + body + "\\end{document}\n"
+
+
+def _line_of(source: str, text: str) -> int:
+    return source[:source.index(text)].count("\n") + 1
+
+
+def test_unicode_characters_are_replaced():
+    source = _doc("a → b\n")
+    fixed, applied = _apply_local_fixes(
+        source, "ERRO na linha 4: Package inputenc Error: Unicode character → (U+2192)", record=False
+    )
+    assert applied == ["unicode_char"]
+    assert "\\ensuremath{\\rightarrow}" in fixed
+
+
+def test_x_column_only_in_the_table_at_the_error():
+    source = _doc(
+        "\\begin{tabular}{l X}\na & b \\\\\n\\end{tabular}\n\n"
+        "\\begin{tabular}{X r}\nc & d \\\\\n\\end{tabular}\n"
+    )
+    line = _line_of(source, "c & d")
+    fixed, applied = _apply_local_fixes(source, f"ERRO na linha {line}: Illegal pream-token (X): `c' used",
+                                        record=False)
+    assert applied == ["x_column_outside_tabularx"]
+    assert "\\begin{tabular}{l X}" in fixed
+    assert "\\begin{tabular}{p{4cm} r}" in fixed
+
+
+def test_tabularx_without_x_widens_the_widest_column():
+    source = _doc("\\begin{tabularx}{\\textwidth}{p{2cm} p{5cm}}\na & b \\\\\n\\end{tabularx}\n")
+    line = _line_of(source, "\\end{tabularx}")
+    fixed, applied = _apply_local_fixes(
+        source, f"ERRO na linha {line}: Package tabularx Warning: X Columns too narrow", record=False
+    )
+    assert applied == ["tabularx_without_x"]
+    assert "{p{2cm} X}" in fixed
+
+
+def test_misplaced_rowcolor_becomes_cellcolor():
+    source = _doc(
+        "\\begin{tabular}{ll}\n"
+        "\\rowcolor{gray} A & B \\\\\n"
+        "C & \\rowcolor{blue} D \\\\\n"
+        "\\end{tabular}\n"
+    )
+    line = _line_of(source, "C & ")
+    fixed, applied = _apply_local_fixes(source, f"ERRO na linha {line}: Misplaced \\noalign.", record=False)
+    assert applied == ["misplaced_rowcolor"]
+    assert "\\rowcolor{gray} A & B" in fixed
+    assert "\\cellcolor{blue}C & \\cellcolor{blue}D \\\\" in fixed
+
+
+def test_misplaced_noalign_without_rowcolor_leaves_the_body():
+    source = _doc("\\begin{tabular}{ll}\nA & \\hline B \\\\\n\\end{tabular}\n")
+    line = _line_of(source, "A & ")
+    fixed, applied = _apply_local_fixes(source, f"ERRO na linha {line}: Misplaced \\noalign.", record=False)
+    assert applied == []
+    assert fixed == source
+
+
+def test_nested_longtable_becomes_tabular():
+    source = _doc(
+        "\\begin{center}\n\\begin{longtable}{ll}\nA & B \\\\ \\endhead\nC & D \\\\\n\\end{longtable}\n\\end{center}\n"
+    )
+    line = _line_of(source, "\\end{longtable}")
+    fixed, applied = _apply_local_fixes(
+        source, f"ERRO na linha {line}: Package longtable Error: longtable not in 1-column mode.", record=False
+    )
+    assert applied == ["longtable_in_group"]
+    assert "\\begin{tabular}{ll}" in fixed and "\\end{tabular}" in fixed
+    assert "\\endhead" not in fixed and "longtable" not in fixed.split("\\begin{document}")[1]
+
+
+def test_multirowcell():
+    source = _doc("\\multirowcell{2}{a\\\\b} & c \\\\\n")
+    fixed, applied = _apply_local_fixes(source, "ERRO: Undefined control sequence \\multirowcell", record=False)
+    assert applied == ["multirowcell"]
+    assert "\\multirow{2}{*}{a\\\\b}" in fixed
+
+
+def test_no_document_or_no_signature():
+    assert _apply_local_fixes("sem corpo", "ERRO: Misplaced \\noalign.", record=False) == ("sem corpo", [])
+    source = _doc("x\n")
+    assert _apply_local_fixes(source, "ERRO na linha 4: Emergency stop.", record=False) == (source, [])
@@ -0,0 +1,81 @@
+import server
+from server import _LogScan
+
+
+def _scan(text: str) -> _LogScan:
+    scan = _LogScan()
+    for line in text.split("\n"):
+        scan.feed(line)
+    return scan
+
+
+def test_error_gets_line_and_context():
+    scan = _scan(
+        "(./document.tex\n"
+        "! Undefined control sequence.\n"
+        "<recently read> \\palavraschaves\n"
+        "l.42 \\palavraschaves\n"
+        "                    {Educação}\n"
+        ")"
+    )
+    [error] = scan.errors
+    assert error.message == "Undefined control sequence."
+    assert error.line == 42
+    assert error.file == "document.tex"
+    assert error.context[-1].startswith("l.42")
+
+
+def test_package_error_names_the_package():
+    scan = _scan("! Package tabularx Error: X Columns too narrow (table too wide)\nl.7 \\end{tabularx}")
+    assert scan.errors[0].package == "tabularx"
+    assert scan.errors[0].line == 7
+
+
+def test_warnings_track_the_file_they_come_from():
+    scan = _scan(
+        "(./document.tex (./capitulo.tex\n"
+        "Overfull \\hbox (12.5pt too wide) in paragraph at lines 10--12\n"
+        ")\n"
+        "LaTeX Warning: Reference `fig:x' on page 1 undefined on input line 30.\n"
+        ")"
+    )
+    [badbox] = scan.by_kind["overfull"]
+    assert badbox.file == "capitulo.tex"
+    assert badbox.overfull_pt == 12.5
+    assert badbox.line == 10
+    [latex] = scan.by_kind["latex"]
+    assert latex.file == "document.tex"
+    assert latex.line == 30
+
+
+def test_wrapped_package_warning_is_joined():
+    scan = _scan(
+        "Package hyperref Warning: Token not allowed in a PDF string\n"
+        "(hyperref)                removing `\\textbf' on input line 55.\n"
+        "Underfull \\hbox (badness 10000) in paragraph at lines 3--4"
+    )
+    [warning] = scan.by_kind["package"]
+    assert "removing" in warning.message
+    assert warning.line == 55
+    assert scan.counts["underfull"] == 1
+
+
+def test_rerun_hints():
+    assert _scan("Package longtable Warning: Table widths have changed. Rerun LaTeX.").rerun_requested
+    # The kernel's label warning is covered by the .aux snapshot instead
+    assert not _scan("LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.").rerun_requested
+
+
+def test_diagnostics_are_bounded():
+    scan = _scan("\n".join(f"LaTeX Warning: warning {i}" for i in range(server.MAX_DIAGNOSTICS_PER_KIND + 10)))
+    assert scan.counts["latex"] == server.MAX_DIAGNOSTICS_PER_KIND + 10
+    assert len(scan.by_kind["latex"]) == server.MAX_DIAGNOSTICS_PER_KIND
+    assert len(scan.warnings()) <= server.MAX_WARNINGS
+
+
+def test_scan_log_reads_a_file(tmp_path):
+    log = tmp_path / "document.log"
+    log.write_text("! Emergency stop.\nl.1 x\n", encoding="utf-8")
+    scan = server._scan_log(str(log))
+    assert scan.errors[0].line == 1
+    assert server._scan_log(str(tmp_path / "missing.log")) is None
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+from server import _parse_range
+
+PDF = b"%PDF-1.5\n" + bytes(range(256)) * 8
+KEY = "c" * 64
+
+
+def test_parse_range():
+    assert _parse_range("", "page") is None
+    assert _parse_range("3", "page") == (3, 3)
+    assert _parse_range(" 2 - 5 ", "page") == (2, 5)
+    assert _parse_range("4-", "section") == (4, None)
+
+
+@pytest.mark.parametrize("spec", ["0", "5-2", "a", "1-2-3", "-3"])
+def test_parse_range_rejects(spec):
+    with pytest.raises(HTTPException) as e:
+        _parse_range(spec, "page")
+    assert e.value.status_code == 400
+
+
+@pytest.fixture
+def client():
+    path = server._compile_cache_paths(KEY)[1]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(PDF)
+    yield TestClient(server.app)
+    os.remove(path)
+
+
+def test_whole_pdf(client):
+    resp = client.get(f"/pdf/{KEY}")
+    assert resp.status_code == 200
+    assert resp.content == PDF
+    assert resp.headers["accept-ranges"] == "bytes"
+
+
+@pytest.mark.parametrize("header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=100-", 100, len(PDF) - 1),
+    ("bytes=-50", len(PDF) - 50, len(PDF) - 1),
+    ("bytes=2000-999999", 2000, len(PDF) - 1),
+])
+def test_byte_ranges(client, header, start, end):
+    resp = client.get(f"/pdf/{KEY}", headers={"Range": header})
+    assert resp.status_code == 206
+    assert resp.content == PDF[start:end + 1]
+    assert resp.headers["content-range"] == f"bytes {start}-{end}/{len(PDF)}"
+
+
+def test_unsatisfiable_and_ignored_ranges(client):
+    resp = client.get(f"/pdf/{KEY}", headers={"Range": f"bytes={len(PDF)}-"})
+    assert resp.status_code == 416
+    assert resp.headers["content-range"] == f"bytes */{len(PDF)}"
+    # Malformed or multi-range headers get the whole file
+    assert client.get(f"/pdf/{KEY}", headers={"Range": "bytes=0-1,5-6"}).status_code == 200
+    assert client.get(f"/pdf/{KEY}", headers={"Range": "bytes=-"}).status_code == 200
+
+
+def test_unknown_key(client):
+    assert client.get("/pdf/" + "d" * 64).status_code == 404
+    assert client.get("/pdf/not-a-key").status_code == 404
@@ -0,0 +1,28 @@
+from server import _rerun_snapshot
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+
+
+def test_missing_and_empty_files_are_none(tmp_path):
+    _write(tmp_path / "document.toc", "  \n")
+    snap = _rerun_snapshot(str(tmp_path), "document")
+    assert set(snap) == {".toc", ".lof", ".lot", ".out", ".aux"}
+    assert all(value is None for value in snap.values())
+
+
+def test_toc_change_is_seen(tmp_path):
+    _write(tmp_path / "document.toc", "\\contentsline {section}{A}{1}\n")
+    before = _rerun_snapshot(str(tmp_path), "document")
+    _write(tmp_path / "document.toc", "\\contentsline {section}{A}{2}\n")
+    assert _rerun_snapshot(str(tmp_path), "document")[".toc"] != before[".toc"]
+
+
+def test_only_significant_aux_lines_count(tmp_path):
+    _write(tmp_path / "document.aux", "\\relax\n\\newlabel{fig:a}{{1}{1}}\n\\@writefile{toc}{x}\n")
+    before = _rerun_snapshot(str(tmp_path), "document")
+    _write(tmp_path / "document.aux", "\\relax\n\\newlabel{fig:a}{{1}{1}}\n\\@writefile{toc}{y}\n")
+    assert _rerun_snapshot(str(tmp_path), "document") == before
+    _write(tmp_path / "document.aux", "\\relax\n\\newlabel{fig:a}{{1}{2}}\n")
+    assert _rerun_snapshot(str(tmp_path), "document")[".aux"] != before[".aux"]
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import server
+from server import CompileRequest, FilePayload, ImagePayload, _read_manifest, _sync_workspace
+
+SOURCE = "\\documentclass{article}\n\\begin{document}\n\\input{cap1}\n\\end{document}\n"
+
+
+@pytest.fixture(autouse=True)
+def no_image_normalization(monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_NORMALIZE", False)
+
+
+def _sync(path, **fields):
+    return _sync_workspace(CompileRequest(latex_source=SOURCE, **fields), str(path))
+
+
+def test_first_sync_writes_everything(tmp_path):
+    logo = server._store_asset(b"\x89PNG logo")
+    source, files = _sync(tmp_path, additional_files=[FilePayload(filename="cap1.tex", content="Um")],
+                          images=[ImagePayload(filename="logo.png", sha256=logo)])
+    assert set(files) == {"cap1.tex", "images/logo.png"}
+    assert _read_manifest(str(tmp_path)) == files
+    assert (tmp_path / "cap1.tex").read_text(encoding="utf-8") == "Um"
+    assert (tmp_path / "images" / "logo.png").read_bytes() == b"\x89PNG logo"
+    assert (tmp_path / "document.tex").read_text(encoding="utf-8") == source
+
+
+def test_unchanged_files_are_kept_and_not_rewritten(tmp_path):
+    _sync(tmp_path, additional_files=[FilePayload(filename="cap1.tex", content="Um")])
+    before = os.stat(tmp_path / "cap1.tex")
+    _, files = _sync(tmp_path, additional_files=[FilePayload(filename="cap1.tex", content="Um")])
+    assert os.stat(tmp_path / "cap1.tex").st_ino == before.st_ino
+    # Not mentioned: kept from the earlier compile
+    _, files = _sync(tmp_path)
+    assert "cap1.tex" in files and (tmp_path / "cap1.tex").exists()
+
+
+def test_removed_and_replaced_files(tmp_path):
+    _sync(tmp_path, additional_files=[FilePayload(filename="cap1.tex", content="Um"),
+                                      FilePayload(filename="cap2.tex", content="Dois"),
+                                      FilePayload(filename="cap3.tex", content="Três")])
+    _, files = _sync(tmp_path, removed_files=["cap2.tex"])
+    assert set(files) == {"cap1.tex", "cap3.tex"}
+    assert not (tmp_path / "cap2.tex").exists()
+    _, files = _sync(tmp_path, replace_files=True, additional_files=[FilePayload(filename="cap1.tex", content="1")])
+    assert set(files) == {"cap1.tex"}
+    assert not (tmp_path / "cap3.tex").exists()
+    assert (tmp_path / "cap1.tex").read_text(encoding="utf-8") == "1"
+
+
+def test_rejected_request_leaves_the_workspace_alone(tmp_path):
+    _sync(tmp_path, additional_files=[FilePayload(filename="cap1.tex", content="Um")])
+    manifest = _read_manifest(str(tmp_path))
+    with pytest.raises(ValueError):
+        _sync(tmp_path, replace_files=True, images=[ImagePayload(filename="x.png", sha256="e" * 64)])
+    assert _read_manifest(str(tmp_path)) == manifest
+    assert (tmp_path / "cap1.tex").read_text(encoding="utf-8") == "Um"
+
+
+def test_internal_names_are_ignored(tmp_path):
+    _, files = _sync(tmp_path, additional_files=[FilePayload(filename=".aee-manifest.json", content="{}"),
+                                                 FilePayload(filename="../fora.tex", content="x")])
+    assert set(files) == {"fora.tex"}
+    assert not (tmp_path.parent / "fora.tex").exists()